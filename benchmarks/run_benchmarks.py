@@ -0,0 +1,308 @@
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+import numpy as np
+import pandas as pd
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__))) #repository with the tools package
+sys.path.insert(0, ROOT)
+from tools import functions as ct
+from tools import parameters
+from tools.accumulator import ClusterAccumulator
+from tools import significance
+from tools.catalog import compare_catalog
+from synthetic import make_cluster
+'''
+Benchmarks of the cluster parameter functions and the full measureCluster pipeline on synthetic clusters.
+Every function is timed for a range of cluster sizes, giving scaling curves of time and peak memory against the number of craters.
+The startup benchmarks time importing the package in a fresh interpreter (python -X importtime) and check which large libraries each import loads.
+The results are written as json, with the commit they were measured on, and can be compared with the results of another commit:
+
+    python benchmarks/run_benchmarks.py --output new.json --compare old.json
+'''
+
+#largest cluster each benchmark is run for, the full dispersion keeps all N^2/2 separations in memory
+MAX_N = {'d_eff': None, 'F_value': None, 'dispersion': 20000, 'dispersion_stats': 100000, 'dispersion_sampled': None, 'BestFitEllipse': 100000, 'ellipse_sequential': 500, 'ellipse_hull': 100000, 'ellipse_adaptive': None, 'measureCluster': 20000, 'accumulator_edit': 20000, 'significance': 5000, 'render_cluster': 20000}
+
+#startup benchmarks: statement run in a fresh interpreter and the large libraries it is allowed to load
+IMPORTS = {'import tools': ('import tools', []),
+           'import functions': ('from tools import functions', ['numpy']),
+           'tools.d_eff': ('import tools; tools.d_eff', ['numpy']),
+           'import parameters': ('from tools import parameters', ['numpy', 'pandas'])}
+LIBRARIES = ['numpy', 'pandas', 'matplotlib', 'scipy', 'sklearn', 'sqlite3', 'openpyxl', 'pyarrow']
+
+def _sequential_ellipse(coord_array, seed, tolerance = 0.1, n_bootstrap = 301):
+    '''
+    Reference for the speed of BestFitEllipse: the same bootstrap with the Kachiyan algorithm run on one sample after the other, as before the samples were solved together.
+    Samples without an enclosing ellipse are skipped. Returns the mean radii of the samples.
+    '''
+    rng = np.random.default_rng(seed)
+    (N, d) = np.shape(coord_array)
+    coord_array = coord_array - coord_array.mean(axis = 0)
+    radii = []
+    for sample in rng.integers(0, N, size = (n_bootstrap, N)):
+        P = coord_array[sample]
+        Q = np.vstack([P.T, np.ones(N)])
+        u = np.full(N, 1.0/N)
+        err = 1.0 + tolerance
+        try:
+            while err > tolerance:
+                V = np.dot(Q, np.dot(np.diag(u), Q.T))
+                M = np.diag(np.dot(Q.T, np.dot(np.linalg.inv(V), Q)))
+                j = np.argmax(M)
+                step_size = (M[j] - d - 1.0)/((d + 1.0)*(M[j] - 1.0))
+                new_u = (1.0 - step_size)*u
+                new_u[j] += step_size
+                err = np.linalg.norm(new_u - u)
+                u = new_u
+            center = np.dot(P.T, u)
+            A = np.linalg.inv(np.dot(P.T, np.dot(np.diag(u), P)) - np.outer(center, center))/d
+        except np.linalg.LinAlgError: #all craters of the sample on one line
+            continue
+        radii.append(1.0/np.sqrt(np.linalg.svd(A)[1]))
+    return np.mean(radii, axis = 0)
+
+def _benchmarks(cluster, seed):
+    #the functions to benchmark, each called on a fresh copy of the cluster
+    latc, lonc = cluster['y_coord'].mean(), cluster['x_coord'].mean()
+    withDiam = cluster.assign(Diam_m = (cluster['Diam_km']*1000).round(2))
+    metres = ct.to_metres(cluster, latc, lonc) #coordinates in metres as used by measureCluster for the best fit ellipse
+    last = withDiam.iloc[-1]
+    accumulators = []
+    def edit():
+        #adding a crater to a mapped cluster, refitting the ellipse and removing the crater again
+        if not accumulators: #built on the first call, only for the sizes the benchmark is run for
+            accumulators.append(ClusterAccumulator.from_frame(withDiam.iloc[:-1], latc, lonc, rng = seed))
+        accumulator = accumulators[0]
+        accumulator.add(last['x_coord'], last['y_coord'], last['Diam_m'], -1)
+        accumulator.parameters()
+        accumulator.remove(-1)
+    renderers = []
+    def render():
+        #plotting the cluster and its best fit ellipse on the reused figure of a ClusterRenderer
+        if not renderers: #matplotlib is only loaded and the ellipse only fitted when this benchmark is run
+            from tools.render import ClusterRenderer
+            renderers.append((ClusterRenderer(), ct.BestFitEllipse(metres, rng = seed) if len(metres) > 5 else None))
+        renderer, ellipse = renderers[0]
+        renderer.render(metres[['x_coord', 'y_coord']].to_numpy(), 'SYN', os.devnull, ellipse)
+    benchmarks = {'d_eff': lambda: ct.d_eff(withDiam),
+                  'F_value': lambda: ct.F_value(withDiam),
+                  'dispersion': lambda: ct.dispersion(cluster),
+                  'dispersion_stats': lambda: ct.dispersion_stats(cluster),
+                  'dispersion_sampled': lambda: ct.dispersion_sampled(cluster, rng = seed),
+                  'BestFitEllipse': lambda: ct.BestFitEllipse(metres, rng = seed),
+                  'ellipse_sequential': lambda: _sequential_ellipse(metres[['x_coord', 'y_coord']].to_numpy(), seed),
+                  'ellipse_hull': lambda: ct.BestFitEllipse(metres, rng = seed, method = 'hull', hull_above = 0),
+                  'ellipse_adaptive': lambda: ct.BestFitEllipse(metres, rng = seed, method = 'hull', hull_above = 0, stop_tolerance = 0.01),
+                  'measureCluster': lambda: parameters.measureCluster(cluster.copy(), 'SYN', latc, lonc, rng = seed),
+                  'accumulator_edit': edit,
+                  'render_cluster': render}
+    if len(cluster) > 5: #999 simulations in this process, the spatial statistics need more than 5 craters
+        benchmarks['significance'] = lambda: significance.spatial_statistics(cluster, latc, lonc, seed = seed, workers = 1)
+    return benchmarks
+
+def measure(func, repeats):
+    '''
+    Times func and records its peak memory. The memory is measured in a separate call, as tracing slows the function down.
+    Returns the best and median time in seconds and the peak of traced memory in bytes.
+    '''
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    tracemalloc.start()
+    func()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return min(times), float(np.median(times)), peak
+
+def run(sizes, shapes, functions = None, repeats = 3, seed = 0, time_budget = 30.0):
+    '''
+    Runs the benchmarks for all cluster sizes and shapes and returns a list of results.
+    Sizes above MAX_N of a function are skipped, fewer repeats are used once a single call takes longer than time_budget/repeats.
+    '''
+    results = []
+    for shape in shapes:
+        for n in sizes:
+            cluster = make_cluster(n, seed, shape)
+            for name, func in _benchmarks(cluster, seed).items():
+                if functions is not None and name not in functions:
+                    continue
+                if MAX_N[name] is not None and n > MAX_N[name]:
+                    continue
+                start = time.perf_counter()
+                func() #warm up, also gives the time of a single call
+                first = time.perf_counter() - start
+                n_repeats = max(1, min(repeats, int(time_budget/max(first, 1e-9))))
+                best, median, peak = measure(func, n_repeats)
+                results.append({'function': name, 'n': n, 'shape': shape, 'repeats': n_repeats,
+                                'seconds_min': best, 'seconds_median': median, 'peak_bytes': peak})
+                print(name.ljust(20) + shape.ljust(14) + str(n).rjust(7) + '  ' + format(best, '.6f') + ' s  ' + format(peak/2**20, '.2f') + ' MB', flush = True)
+    return results
+
+def speedups(results, name = 'BestFitEllipse', reference = 'ellipse_sequential'):
+    '''
+    Prints how many times faster name is than reference for every cluster size and shape both were run for, and returns these speedups.
+    '''
+    times = {(r['function'], r['shape'], r['n']): r['seconds_min'] for r in results}
+    found = []
+    for (function, shape, n), seconds in times.items():
+        if function == reference and (name, shape, n) in times:
+            found.append({'function': name, 'reference': reference, 'shape': shape, 'n': n, 'speedup': seconds/times[(name, shape, n)]})
+            print(name.ljust(20) + shape.ljust(14) + str(n).rjust(7) + '  ' + format(found[-1]['speedup'], '.1f') + ' times faster than ' + reference, flush = True)
+    return found
+
+def import_time(statement):
+    '''
+    Runs statement in a fresh interpreter with python -X importtime.
+    Returns the time of all imports in seconds, as reported by the interpreter, and the large libraries (see LIBRARIES) that were loaded.
+    '''
+    code = statement + '; import sys; print(",".join(m for m in ' + repr(LIBRARIES) + ' if m in sys.modules))'
+    process = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], capture_output = True, text = True, cwd = ROOT, check = True)
+    total = 0
+    for line in process.stderr.splitlines():
+        #lines are 'import time: self [us] | cumulative | imported package', nested imports are indented
+        if line.startswith('import time:') and '|' in line:
+            self_us, cumulative, package = line[len('import time:'):].split('|')
+            if cumulative.strip().isdigit() and not package[1:].startswith(' '):
+                total += int(cumulative)
+    loaded = process.stdout.strip()
+    return total/1e6, loaded.split(',') if loaded else []
+
+def run_imports(names = None, repeats = 3):
+    '''
+    Runs the startup benchmarks and returns a list of results in the same form as run, with the libraries each import loaded.
+    Imports loading a library they are not allowed to are printed as over budget.
+    '''
+    results = []
+    for name, (statement, allowed) in IMPORTS.items():
+        if names is not None and name not in names:
+            continue
+        times = []
+        for _ in range(repeats):
+            seconds, loaded = import_time(statement)
+            times.append(seconds)
+        over = [library for library in loaded if library not in allowed]
+        results.append({'function': name, 'n': 0, 'shape': 'startup', 'repeats': repeats, 'seconds_min': min(times),
+                        'seconds_median': float(np.median(times)), 'peak_bytes': 0, 'loaded': loaded, 'over_budget': over})
+        print(name.ljust(20) + 'startup'.ljust(14) + '0'.rjust(7) + '  ' + format(min(times), '.6f') + ' s  ' + ','.join(loaded)
+              + ('  over budget: ' + ','.join(over) if over else ''), flush = True)
+    return results
+
+def check_tables():
+    '''
+    Checks that compute_catalog reproduces the stored parameter sheet of the test tables in DataTables from their main list.
+    Returns the values that differ as given by catalog.compare_catalog, the benchmark exits with 1 if there are any.
+    '''
+    main_df = pd.read_excel(os.path.join(ROOT, 'DataTables', 'Testlist.xlsx'), index_col = [0, 1])
+    stored = pd.read_excel(os.path.join(ROOT, 'DataTables', 'TestParameters.xlsx'), index_col = 0)
+    differences = compare_catalog(main_df, stored, rng = 0)
+    print('stored parameters ' + ('reproduced' if differences.empty else 'differ:\n' + differences.to_string(index = False)), flush = True)
+    return differences
+
+def check_hull(sizes = (50, 2000), shapes = ('elliptical', 'subclustered'), seed = 0, rtol = 1e-9):
+    '''
+    Checks that the 'hull' method of BestFitEllipse, used for all cluster sizes here, gives the same ellipse as the 'khachiyan' method.
+    Returns the clusters whose centre, radii or angle differ by more than rtol, the benchmark exits with 1 if there are any.
+    '''
+    failed = []
+    for shape in shapes:
+        for n in sizes:
+            cluster = make_cluster(n, seed, shape)
+            metres = ct.to_metres(cluster, cluster['y_coord'].mean(), cluster['x_coord'].mean())
+            centre, radii, rotation, angle = ct.BestFitEllipse(metres, rng = seed)
+            hull_centre, hull_radii, hull_rotation, hull_angle = ct.BestFitEllipse(metres, rng = seed, method = 'hull', hull_above = 0)
+            if not (np.allclose(hull_radii, radii, rtol = rtol, atol = 0) and np.allclose(hull_centre - centre, 0, atol = rtol*radii.max())
+                    and abs(hull_angle - angle) <= rtol*180):
+                failed.append({'shape': shape, 'n': n, 'radii': list(radii), 'hull_radii': list(hull_radii), 'angle': angle, 'hull_angle': hull_angle})
+    print('hull ellipses ' + ('equal the khachiyan ellipses' if not failed else 'differ: ' + str(failed)), flush = True)
+    return failed
+
+def check_store():
+    '''
+    Checks that the excel and SQLite stores keep the cluster given last when a cluster is appended twice at once,
+    and that parameters.readClusterFile reads it back from the store by its HiRise ID.
+    Returns the stores that fail, the benchmark exits with 1 if there are any.
+    '''
+    import shutil
+    import tempfile
+    from tools.store import ExcelStore, SQLiteStore
+    main_df = pd.read_excel(os.path.join(ROOT, 'DataTables', 'Testlist.xlsx'), index_col = [0, 1])
+    craters = main_df.loc[[main_df.index.get_level_values(0)[0]]].reset_index()
+    craters['HiRiseID'] = 'DUPLICATE'
+    first = craters.set_index(['HiRiseID', 'crater_no'])
+    last = craters.iloc[:2].set_index(['HiRiseID', 'crater_no'])
+    failed = []
+    directory = tempfile.mkdtemp()
+    try:
+        shutil.copy(os.path.join(ROOT, 'DataTables', 'Testlist.xlsx'), directory)
+        shutil.copy(os.path.join(ROOT, 'DataTables', 'TestParameters.xlsx'), directory)
+        stores = {'excel': ExcelStore(os.path.join(directory, 'Testlist.xlsx'), os.path.join(directory, 'TestParameters.xlsx')),
+                  'sqlite': SQLiteStore(os.path.join(directory, 'store.sqlite'))}
+        for name, store in stores.items():
+            try:
+                store.append([first, last], [{'HiRise_ID': 'DUPLICATE', 'R1': 1.0}, {'HiRise_ID': 'DUPLICATE', 'R1': 2.0}])
+                stored = store.read_parameters(HiRiseIDs = ['DUPLICATE'])
+                ClusterData, HiRiseID = parameters.readClusterFile('DUPLICATE', store)
+                if len(store.read_craters(HiRiseIDs = ['DUPLICATE'])) != 2 or list(stored['R1']) != [2.0] or len(ClusterData) != 2:
+                    failed.append(name)
+            except Exception as error:
+                failed.append(name + ': ' + repr(error))
+    finally:
+        shutil.rmtree(directory)
+    print('stores ' + ('keep the cluster given last' if not failed else 'fail: ' + str(failed)), flush = True)
+    return failed
+
+def _commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output = True, text = True, cwd = os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        return None
+
+def compare(old, new):
+    '''
+    Prints the ratio of new to old times and peak memory for the benchmarks found in both result files.
+    '''
+    old_results = {(r['function'], r['shape'], r['n']): r for r in old['results']}
+    print('function            shape            n   time new/old  memory new/old')
+    for r in new['results']:
+        key = (r['function'], r['shape'], r['n'])
+        if key in old_results:
+            o = old_results[key]
+            print(r['function'].ljust(20) + r['shape'].ljust(14) + str(r['n']).rjust(7) + '  '
+                  + format(r['seconds_min']/o['seconds_min'], '.3f').rjust(12) + '  ' + format(r['peak_bytes']/max(o['peak_bytes'], 1), '.3f').rjust(14))
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(prog = 'run_benchmarks', description = 'Benchmark the cluster parameter functions on synthetic clusters')
+    parser.add_argument('--sizes', type = int, nargs = '+', default = [5, 50, 500, 5000], help = 'numbers of craters, up to 100000')
+    parser.add_argument('--shapes', nargs = '+', default = ['elliptical', 'subclustered'], choices = ['elliptical', 'subclustered'])
+    parser.add_argument('--functions', nargs = '+', default = None, choices = list(MAX_N) + list(IMPORTS), help = 'functions and startup imports to benchmark, defaults to all')
+    parser.add_argument('--repeats', type = int, default = 3)
+    parser.add_argument('--seed', type = int, default = 0)
+    parser.add_argument('-o', '--output', default = 'bench_results.json', help = 'json file to write the results to')
+    parser.add_argument('--compare', default = None, help = 'json results of an earlier run to compare with')
+    args = parser.parse_args(argv)
+
+    output = {'commit': _commit(), 'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'), 'python': platform.python_version(),
+              'numpy': np.__version__, 'pandas': pd.__version__, 'machine': platform.machine(), 'seed': args.seed,
+              'results': run_imports(args.functions, args.repeats) + run(args.sizes, args.shapes, args.functions, args.repeats, args.seed)}
+    output['speedups'] = speedups(output['results'])
+    differences = check_tables()
+    output['table_check'] = differences.to_dict('records')
+    output['hull_check'] = check_hull(seed = args.seed)
+    output['store_check'] = check_store()
+    with open(args.output, 'w') as file:
+        json.dump(output, file, indent = 1)
+    if args.compare is not None:
+        with open(args.compare) as file:
+            compare(json.load(file), output)
+    #exit code 1 if an import loads a library outside its budget, the stored parameters are not reproduced, the hull ellipses differ or a store fails
+    return 1 if any(r.get('over_budget') for r in output['results']) or not differences.empty or output['hull_check'] or output['store_check'] else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
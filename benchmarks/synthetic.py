@@ -0,0 +1,89 @@
+import numpy as np
+import pandas as pd
+'''
+Seeded generator of synthetic crater clusters for the benchmarks.
+The clusters have the columns of a CraterTools export (Diam_km, x_coord, y_coord, tag, crater_no),
+with x_coord the longitude and y_coord the latitude in degrees, so they can be passed straight to measureCluster.
+'''
+
+Rmars = 3390000 #radius of Mars in metres
+
+def make_cluster(n, rng = None, shape = 'elliptical', lat = None, lon = None, size = 200.0, ellipticity = 3.0, n_sub = 5):
+    '''
+    Creates a synthetic cluster of n craters.
+    Crater positions are normally distributed in an ellipse of random orientation ('elliptical')
+    or around n_sub centres inside such an ellipse ('subclustered').
+    Diameters follow a power law between 0.5 and 20 metres, like the craters of real clusters.
+
+    :param n: number of craters
+    :type n: int
+    :param rng: random generator or seed, defaults to None
+    :type rng: numpy.random.Generator or int
+    :param shape: 'elliptical' or 'subclustered', defaults to 'elliptical'
+    :type shape: str
+    :param lat: latitude of the cluster centre in degrees, defaults to None for a random latitude between -60 and 60
+    :type lat: float
+    :param lon: longitude of the cluster centre in degrees, defaults to None for a random longitude between -180 and 180
+    :type lon: float
+    :param size: standard deviation of the crater positions along the major axis in metres, defaults to 200
+    :type size: float
+    :param ellipticity: ratio of major to minor axis, defaults to 3
+    :type ellipticity: float
+    :param n_sub: number of subclusters for the 'subclustered' shape, defaults to 5
+    :type n_sub: int
+    '''
+    rng = np.random.default_rng(rng)
+    if lat is None:
+        lat = rng.uniform(-60, 60)
+    if lon is None:
+        lon = rng.uniform(-180, 180)
+    angle = rng.uniform(0, np.pi)
+    rotation = np.array([[np.cos(angle), -np.sin(angle)], [np.sin(angle), np.cos(angle)]])
+    axes = np.array([size, size/ellipticity])
+    if shape == 'elliptical':
+        xy = rng.normal(size=(n, 2))*axes
+    elif shape == 'subclustered':
+        centres = rng.normal(size=(n_sub, 2))*axes
+        members = rng.integers(0, n_sub, n)
+        xy = centres[members] + rng.normal(size=(n, 2))*axes/(2*n_sub)
+    else:
+        raise ValueError("shape must be 'elliptical' or 'subclustered'")
+    xy = xy @ rotation.T #metres east and north of the centre
+    deg = Rmars*(np.pi/180) #metres per degree of latitude
+    #power law diameters by inverse transform sampling, cumulative exponent -2:
+    d_min, d_max = 0.5, 20.0
+    u = rng.uniform(size=n)
+    diam = d_min*(1 - u*(1 - (d_min/d_max)**2))**-0.5
+    return pd.DataFrame({'Diam_km': np.round(diam, 2)/1000,
+                         'x_coord': lon + xy[:, 0]/(deg*np.cos(np.radians(lat))),
+                         'y_coord': lat + xy[:, 1]/deg,
+                         'tag': 'standard',
+                         'crater_no': np.arange(1, n + 1)})
+
+def make_catalog(n_clusters, rng = None, sizes = (5, 200), shape = 'elliptical'):
+    '''
+    Creates a main list of synthetic clusters, indexed by (HiRiseID, crater_no) like the one written by writeClusterAttributes.
+    Returns the main list and a table of the central coordinates with the columns HiRise_ID, central_latitude and central_longitude.
+
+    :param n_clusters: number of clusters
+    :type n_clusters: int
+    :param rng: random generator or seed, defaults to None
+    :type rng: numpy.random.Generator or int
+    :param sizes: smallest and largest number of craters per cluster, defaults to (5, 200)
+    :type sizes: tuple of int
+    :param shape: 'elliptical' or 'subclustered', defaults to 'elliptical'
+    :type shape: str
+    '''
+    rng = np.random.default_rng(rng)
+    clusters = []
+    centres = []
+    for i in range(n_clusters):
+        HiRiseID = 'SYN_' + str(i).zfill(6) + '_0000'
+        cluster = make_cluster(int(rng.integers(sizes[0], sizes[1] + 1)), rng, shape)
+        cluster['Diam_m'] = np.round(cluster['Diam_km']*1000, 2)
+        cluster['HiRiseID'] = HiRiseID
+        clusters.append(cluster.drop(columns=['Diam_km', 'tag']))
+        #latitude from y_coord and longitude from x_coord, as in the parameter sheet
+        centres.append({'HiRise_ID': HiRiseID, 'central_latitude': cluster['y_coord'].mean(), 'central_longitude': cluster['x_coord'].mean()})
+    main = pd.concat(clusters, ignore_index=True).set_index(['HiRiseID', 'crater_no'])
+    return main, pd.DataFrame(centres)
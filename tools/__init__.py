@@ -1,2 +1,27 @@
-from .functions import *
-from .parameters import *
+import importlib
+'''
+The functions of functions.py and parameters.py can be used directly from the package, i.e. tools.d_eff or tools.measureCluster.
+They are imported on first use, so importing tools loads nothing and the parameter functions only load NumPy.
+Matplotlib, pandas and the storage backends are loaded by the functions that need them.
+'''
+
+#functions available from the package and the module they are in:
+_functions = dict.fromkeys(['d_eff', 'F_value', 'Rmars', 'to_metres', 'dispersion', 'dispersion_stats', 'dispersion_sampled',
+                            'dispersion_auto', 'BestFitEllipse'], 'functions')
+_functions.update(dict.fromkeys(['vprint', 'getParameters', 'checkCentre', 'getBatchParameters', 'readClusterFile', 'measureCluster',
+                                 'formatClusterData', 'writeClusterTables', 'writeClusterAttributes', 'measureStream', 'measureBatch',
+                                 'ClusterParametersBatch', 'ClusterParametersStream', 'ClusterParameters'], 'parameters'))
+_submodules = ['accumulator', 'cache', 'catalog', 'cluster', 'curvefit', 'functions', 'parameters', 'render', 'runlog', 'significance', 'spatial', 'store', 'stream', 'subclustering']
+__all__ = list(_functions)
+
+def __getattr__(name):
+    if name in _submodules:
+        return importlib.import_module('.' + name, __name__)
+    if name in _functions:
+        value = getattr(importlib.import_module('.' + _functions[name], __name__), name)
+        globals()[name] = value #later lookups do not go through __getattr__
+        return value
+    raise AttributeError('module ' + repr(__name__) + ' has no attribute ' + repr(name))
+
+def __dir__():
+    return sorted(set(globals()) | set(_functions) | set(_submodules))
@@ -0,0 +1,437 @@
+import heapq
+import numpy as np
+from numpy import linalg
+from . import functions as ct
+'''
+Incremental parameters of a cluster that is being mapped, for live feedback while craters are added, moved or removed.
+A ClusterAccumulator keeps running sums instead of the craters' full calculations, so each edit costs O(N) instead of O(N^2):
+the sum of cubed diameters for d_eff, a max-heap of the diameters and the number of craters larger than D/2 for F_value,
+and the sum and sum of squares of the separations of all crater pairs for the dispersion.
+The best fit ellipse uses a Poisson bootstrap (each crater is drawn a Poisson(1) number of times into each sample),
+so adding or removing a crater changes the samples by one crater instead of drawing new ones,
+and the Kachiyan algorithm is started from the weights of the previous fit.
+'''
+
+def _khachiyan_shared(QQ, u, member, tolerance = 0.1, warm = False):
+    '''
+    Runs the Kachiyan algorithm for many weightings of the same points at once, starting from the weights u.
+    Points outside a sample (member False) keep a weight of 0. Returns the weights and the number of iterations of each sample.
+    With warm, weights that already meet the tolerance are kept as they are, so refitting unchanged samples does not move the ellipse.
+
+    :param QQ: array of shape (N, 9) of the outer products of the lifted points
+    :type QQ: numpy array
+    :param u: starting weights of shape (B, N), each row summing to 1
+    :type u: numpy array
+    :param member: array of shape (B, N), True for the points in each sample
+    :type member: numpy array
+    :param tolerance: gives the tolerance for the Kachiyan algorithm, defaults to 0.1
+    :type tolerance: float
+    :param warm: u are the weights of a previous fit, defaults to False
+    :type warm: bool
+    '''
+    d = 2
+    u = u.copy()
+    iterations = np.zeros(len(u), dtype=int)
+    active = np.arange(len(u))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        while len(active) > 0:
+            ua = u[active]
+            V = (ua @ QQ).reshape(-1, d+1, d+1)
+            M = linalg.inv(V).reshape(-1, (d+1)**2) @ QQ.T #q^T V^-1 q of all points
+            M[~member[active]] = -np.inf
+            j = np.argmax(M, axis=1)
+            rows = np.arange(len(active))
+            maximum = M[rows, j]
+            step_size = (maximum - d - 1.0) / ((d + 1.0) * (maximum - 1.0))
+            new_u = (1.0 - step_size[:, None]) * ua
+            new_u[rows, j] += step_size
+            err = np.linalg.norm(new_u - ua, axis=1)
+            if warm: #only the samples the edits moved away from the tolerance are iterated
+                moving = err > tolerance
+                active, new_u, err = active[moving], new_u[moving], err[moving]
+                warm = False
+            u[active] = new_u
+            iterations[active] += 1
+            active = active[err > tolerance]
+    return u, iterations
+
+class ClusterAccumulator:
+    """
+    Parameters of a cluster updated crater by crater.
+    Coordinates are in degrees like the columns x_coord and y_coord of a CraterTools export, diameters in metres.
+
+    :param latc: central latitude of image
+    :type latc: float
+    :param lonc: central longitude of image
+    :type lonc: float
+    :param HiRiseID: HiRise Observation ID of the cluster, defaults to None
+    :type HiRiseID: str
+    :param tolerance: gives the tolerance for the Kachiyan algorithm of the best fit ellipse, defaults to 0.1
+    :type tolerance: float
+    :param n_bootstrap: number of bootstrap samples for the best fit ellipse, defaults to 301
+    :type n_bootstrap: int
+    :param rng: random generator or seed for the bootstrap samples, defaults to None
+    :type rng: numpy.random.Generator or int
+    """
+    def __init__(self, latc, lonc, HiRiseID = None, tolerance = 0.1, n_bootstrap = 301, rng = None):
+        self.latc = latc
+        self.lonc = lonc
+        self.HiRiseID = HiRiseID
+        self.tolerance = tolerance
+        self.n_bootstrap = n_bootstrap
+        self.rng = np.random.default_rng(rng)
+        self._slots = {} #position of each crater in the arrays, by crater number
+        self._free = [] #positions of removed craters to reuse
+        self._size = 0 #positions used so far
+        self._diam = np.zeros(0)
+        self._x = np.zeros(0)
+        self._y = np.zeros(0)
+        self._active = np.zeros(0, dtype=bool)
+        self._QQ = np.zeros((0, 9)) #outer products of the craters in metres, lifted for the Kachiyan algorithm
+        self._origin = None #metres of the first crater, the lifted points are relative to it so V stays well conditioned far from the centre of the image
+        self._counts = np.zeros((n_bootstrap, 0)) #number of draws of each crater into each bootstrap sample
+        self._u = np.zeros((n_bootstrap, 0)) #Kachiyan weights of the last fit
+        self._fitted = False
+        self._added = set() #positions added since the last fit
+        self._cube_sum = 0.0
+        self._heap = [] #(-diameter, crater_no), entries of removed craters are skipped when they come to the top
+        self._d_max = np.nan
+        self._n_half = 0 #number of craters of at least half the largest diameter
+        self._sep_sum = 0.0
+        self._sep_sq_sum = 0.0
+        self._next_no = 1
+
+    @classmethod
+    def from_frame(cls, ClusterData, latc, lonc, HiRiseID = None, diameter = 'Diam_m', x = 'x_coord', y = 'y_coord', **kwargs):
+        """
+        Creates an accumulator from the craters of a cluster, i.e. as read by parameters.readClusterFile.
+
+        :param ClusterData: dataframe containing all craters of a cluster, with a crater_no column
+        :type ClusterData: pandas dataframe
+        :param latc: central latitude of image
+        :type latc: float
+        :param lonc: central longitude of image
+        :type lonc: float
+        :param diameter: name of the column giving the diameter in metres, Diam_km is converted like in measureCluster if it is missing, defaults to 'Diam_m'
+        :type diameter: str
+        """
+        accumulator = cls(latc, lonc, HiRiseID, **kwargs)
+        accumulator.extend(*accumulator._columns(ClusterData, diameter, x, y))
+        return accumulator
+
+    def __len__(self):
+        return len(self._slots)
+
+    def __contains__(self, crater_no):
+        return crater_no in self._slots
+
+    def _columns(self, ClusterData, diameter, x, y):
+        #crater numbers, coordinates and diameters in metres of a dataframe
+        if diameter not in ClusterData.columns and 'Diam_km' in ClusterData.columns:
+            diameters = (ClusterData['Diam_km']*1000).round(2).to_numpy(dtype=float)
+        else:
+            diameters = ClusterData[diameter].to_numpy(dtype=float)
+        if 'crater_no' in ClusterData.columns:
+            numbers = ClusterData['crater_no'].tolist()
+        else:
+            numbers = ClusterData.index.get_level_values('crater_no').tolist()
+        return ClusterData[x].to_numpy(dtype=float), ClusterData[y].to_numpy(dtype=float), diameters, numbers
+
+    def _reserve(self, n):
+        #positions for n new craters, growing the arrays by doubling
+        reused = [self._free.pop() for _ in range(min(n, len(self._free)))]
+        n_new = n - len(reused)
+        if self._size + n_new > len(self._diam):
+            capacity = max(2*len(self._diam), self._size + n_new, 16)
+            grow = capacity - len(self._diam)
+            self._diam = np.concatenate([self._diam, np.zeros(grow)])
+            self._x = np.concatenate([self._x, np.zeros(grow)])
+            self._y = np.concatenate([self._y, np.zeros(grow)])
+            self._active = np.concatenate([self._active, np.zeros(grow, dtype=bool)])
+            self._QQ = np.concatenate([self._QQ, np.zeros((grow, 9))])
+            self._counts = np.concatenate([self._counts, np.zeros((self.n_bootstrap, grow))], axis=1)
+            self._u = np.concatenate([self._u, np.zeros((self.n_bootstrap, grow))], axis=1)
+        slots = reused + list(range(self._size, self._size + n_new))
+        self._size += n_new
+        return np.array(slots, dtype=int)
+
+    def add(self, x, y, diameter, crater_no = None):
+        """
+        Adds a crater and returns its crater number.
+
+        :param x: longitude of the crater in degrees (x_coord)
+        :type x: float
+        :param y: latitude of the crater in degrees (y_coord)
+        :type y: float
+        :param diameter: diameter of the crater in metres
+        :type diameter: float
+        :param crater_no: number of the crater, defaults to None for the next free number
+        :type crater_no: int
+        """
+        if crater_no is None:
+            crater_no = self._next_no
+        return self.extend([x], [y], [diameter], [crater_no])[0]
+
+    def extend(self, x, y, diameters, crater_nos = None):
+        """
+        Adds many craters at once and returns their crater numbers.
+
+        :param x: longitudes of the craters in degrees (x_coord)
+        :type x: array
+        :param y: latitudes of the craters in degrees (y_coord)
+        :type y: array
+        :param diameters: diameters of the craters in metres
+        :type diameters: array
+        :param crater_nos: numbers of the craters, defaults to None for the next free numbers
+        :type crater_nos: list
+        """
+        x = np.asarray(x, dtype=float)
+        y = np.asarray(y, dtype=float)
+        diameters = np.asarray(diameters, dtype=float)
+        if crater_nos is None:
+            crater_nos = list(range(self._next_no, self._next_no + len(x)))
+        crater_nos = list(crater_nos)
+        duplicates = [no for no in crater_nos if no in self._slots]
+        if duplicates or len(set(crater_nos)) < len(crater_nos):
+            raise KeyError('craters already in the cluster: ' + ', '.join(map(str, duplicates or crater_nos)))
+        #separations to the craters already in the cluster and among the new craters:
+        existing = np.flatnonzero(self._active[:self._size])
+        for start in range(0, len(x), 1024):
+            sep = ct._separation(x[start:start+1024, None], y[start:start+1024, None], self._x[None, existing], self._y[None, existing])
+            self._sep_sum += sep.sum()
+            self._sep_sq_sum += (sep**2).sum()
+        for sep in ct._pair_blocks(np.column_stack([x, y])):
+            self._sep_sum += sep.sum()
+            self._sep_sq_sum += (sep**2).sum()
+        slots = self._reserve(len(x))
+        self._diam[slots] = diameters
+        self._x[slots] = x
+        self._y[slots] = y
+        self._active[slots] = True
+        #converting to metres like functions.to_metres:
+        xm = (x - self.latc)*ct.Rmars*(np.pi/180)
+        ym = (y - self.lonc)*ct.Rmars*(np.pi/180)*np.sin(np.radians(90 - y))
+        if self._origin is None and len(x) > 0:
+            self._origin = np.array([xm[0], ym[0]])
+        Q = np.column_stack([xm - self._origin[0], ym - self._origin[1], np.ones(len(x))]) if len(x) > 0 else np.zeros((0, 3))
+        self._QQ[slots] = (Q[:, :, None]*Q[:, None, :]).reshape(len(x), 9)
+        self._counts[:, slots] = self.rng.poisson(1.0, (self.n_bootstrap, len(x)))
+        self._u[:, slots] = 0
+        self._added.update(slots.tolist())
+        for no, slot in zip(crater_nos, slots.tolist()):
+            self._slots[no] = slot
+            heapq.heappush(self._heap, (-self._diam[slot], no))
+            if isinstance(no, (int, np.integer)):
+                self._next_no = max(self._next_no, int(no) + 1)
+        self._cube_sum += (diameters**3).sum()
+        if len(diameters) > 0:
+            if not diameters.max() <= self._d_max: #a new largest crater (or the first craters)
+                self._d_max = diameters.max()
+                self._count_half()
+            else:
+                self._n_half += int((diameters >= self._d_max/2).sum())
+        return crater_nos
+
+    def remove(self, crater_no):
+        """
+        Removes a crater, raises a KeyError if it is not in the cluster.
+
+        :param crater_no: number of the crater
+        :type crater_no: int
+        """
+        slot = self._slots.pop(crater_no)
+        self._active[slot] = False
+        others = np.flatnonzero(self._active[:self._size])
+        sep = ct._separation(self._x[slot], self._y[slot], self._x[others], self._y[others])
+        self._sep_sum -= sep.sum()
+        self._sep_sq_sum -= (sep**2).sum()
+        diameter = self._diam[slot]
+        self._cube_sum -= diameter**3
+        self._counts[:, slot] = 0
+        self._u[:, slot] = 0
+        self._added.discard(slot)
+        self._free.append(slot)
+        if not self._slots:
+            self._reset_sums()
+            return
+        #finding the largest crater left on the heap:
+        while not self._valid(self._heap[0]):
+            heapq.heappop(self._heap)
+        d_max = -self._heap[0][0]
+        if d_max != self._d_max:
+            self._d_max = d_max
+            self._count_half()
+        else:
+            self._n_half -= int(diameter >= self._d_max/2)
+        if len(self._heap) > 2*len(self._slots) + 16: #dropping the entries of removed craters
+            self._heap = [entry for entry in self._heap if self._valid(entry)]
+            heapq.heapify(self._heap)
+
+    def move(self, crater_no, x, y, diameter):
+        """
+        Changes the position and diameter of a crater.
+
+        :param crater_no: number of the crater
+        :type crater_no: int
+        :param x: new longitude in degrees (x_coord)
+        :type x: float
+        :param y: new latitude in degrees (y_coord)
+        :type y: float
+        :param diameter: new diameter in metres
+        :type diameter: float
+        """
+        self.remove(crater_no)
+        self.add(x, y, diameter, crater_no)
+
+    def sync(self, ClusterData, diameter = 'Diam_m', x = 'x_coord', y = 'y_coord'):
+        """
+        Updates the accumulator to the craters of a new export of the cluster, only changed craters are recalculated.
+        Returns the numbers of edits as (added, moved, removed).
+
+        :param ClusterData: dataframe containing all craters of the cluster, with a crater_no column
+        :type ClusterData: pandas dataframe
+        :param diameter: name of the column giving the diameter in metres, Diam_km is converted like in measureCluster if it is missing, defaults to 'Diam_m'
+        :type diameter: str
+        """
+        xs, ys, diameters, numbers = self._columns(ClusterData, diameter, x, y)
+        removed = set(self._slots) - set(numbers)
+        for no in removed:
+            self.remove(no)
+        new = []
+        moved = 0
+        for i, no in enumerate(numbers):
+            slot = self._slots.get(no)
+            if slot is None:
+                new.append(i)
+            elif (self._x[slot], self._y[slot], self._diam[slot]) != (xs[i], ys[i], diameters[i]):
+                self.move(no, xs[i], ys[i], diameters[i])
+                moved += 1
+        if new:
+            self.extend(xs[new], ys[new], diameters[new], [numbers[i] for i in new])
+        return len(new), moved, len(removed)
+
+    def _valid(self, entry):
+        #heap entry of a crater still in the cluster with that diameter
+        slot = self._slots.get(entry[1])
+        return slot is not None and self._diam[slot] == -entry[0]
+
+    def _count_half(self):
+        self._n_half = int((self._diam[:self._size][self._active[:self._size]] >= self._d_max/2).sum())
+
+    def _reset_sums(self):
+        #an empty cluster, also clearing the rounding errors of the running sums
+        self._cube_sum = 0.0
+        self._sep_sum = 0.0
+        self._sep_sq_sum = 0.0
+        self._heap = []
+        self._d_max = np.nan
+        self._n_half = 0
+
+    def refresh(self):
+        """
+        Recalculates the running sums from the craters, to remove the rounding errors of many edits.
+        """
+        slots = np.flatnonzero(self._active[:self._size])
+        self._reset_sums()
+        if len(slots) == 0:
+            return
+        diameters = self._diam[slots]
+        self._cube_sum = (diameters**3).sum()
+        for sep in ct._pair_blocks(np.column_stack([self._x[slots], self._y[slots]])):
+            self._sep_sum += sep.sum()
+            self._sep_sq_sum += (sep**2).sum()
+        self._heap = [(-d, no) for no, d in zip(self._slots, self._diam[list(self._slots.values())])]
+        heapq.heapify(self._heap)
+        self._d_max = diameters.max()
+        self._count_half()
+
+    def d_eff(self):
+        """
+        Effective diameter of the cluster as functions.d_eff gives it.
+        """
+        return round(max(self._cube_sum, 0.0)**(1/3), 3)
+
+    def F_value(self):
+        """
+        Largest diameter, number of craters larger than half of it and their fraction, as functions.F_value gives them.
+        """
+        n = len(self._slots)
+        return self._d_max, self._n_half, (self._n_half/n if n > 0 else np.nan)
+
+    def dispersion(self):
+        """
+        Dispersion (standard deviation of the separations of all crater pairs) and mean separation in metres, NaN for less than two craters.
+        """
+        n = len(self._slots)
+        pairs = n*(n - 1)/2
+        if pairs == 0:
+            return np.nan, np.nan
+        mean = self._sep_sum/pairs
+        return np.sqrt(max(self._sep_sq_sum/pairs - mean**2, 0.0)), mean
+
+    def ellipse(self, info = None):
+        """
+        Best fit ellipse of the Poisson bootstrap samples, returned like functions.BestFitEllipse as centre, radii, rotation matrix and angle.
+        The Kachiyan algorithm starts from the weights of the previous fit, so an edit takes a few iterations.
+
+        :param info: dictionary to add the number of samples used and the Kachiyan iteration counts (mean, max, total) to, defaults to None
+        :type info: dict
+        """
+        slots = np.flatnonzero(self._active[:self._size])
+        if len(slots) < 3:
+            raise ValueError('the best fit ellipse needs at least 3 craters')
+        counts = self._counts[:, slots]
+        member = counts > 0
+        QQ = self._QQ[slots]
+        #samples of craters that do not span the plane (less than 3 different craters or all on one line) have no ellipse, as in functions.BestFitEllipse:
+        share = member/np.maximum(member.sum(axis=1, keepdims=True), 1)
+        mean = share @ QQ[:, [2, 5]]
+        scatter = (share @ QQ[:, [0, 1, 3, 4]]).reshape(-1, 2, 2) - mean[:, :, None]*mean[:, None, :]
+        scale = np.trace(scatter, axis1=1, axis2=2)/2
+        valid = np.flatnonzero((member.sum(axis=1) > 2) & (linalg.det(scatter) > 1e-12*scale**2))
+        member = member[valid]
+        counts = counts[valid]
+        cold = counts/counts.sum(axis=1, keepdims=True) #weights of a new fit, as for repeated craters in functions.BestFitEllipse
+        u = self._u[np.ix_(valid, slots)]
+        if self._fitted:
+            added = np.isin(slots, list(self._added))
+            u[:, added] = cold[:, added]
+        warm = ((u > 0) | ~member).all(axis=1) #every crater of the sample has a weight, samples skipped in the last fit start again
+        u[warm] /= u[warm].sum(axis=1, keepdims=True)
+        u[~warm] = cold[~warm]
+        u, iterations = _khachiyan_shared(QQ, u, member, self.tolerance, warm = self._fitted)
+        self._u[:] = 0
+        self._u[np.ix_(valid, slots)] = u
+        self._fitted = True
+        self._added.clear()
+        d = 2
+        center = u @ QQ[:, [2, 5]]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            A = linalg.inv((u @ QQ[:, [0, 1, 3, 4]]).reshape(-1, d, d) - center[:, :, None]*center[:, None, :])/d
+        finite = np.isfinite(A).all(axis=(1, 2)) #dropping samples of collinear craters
+        center = center + self._origin
+        U, s, rotation = linalg.svd(A[finite])
+        if info is not None:
+            info.update({'samples': len(iterations), 'mean_iterations': float(iterations.mean()),
+                         'max_iterations': int(iterations.max()), 'total_iterations': int(iterations.sum())})
+        return ct._average_ellipse(center[finite], 1.0/np.sqrt(s), rotation)
+
+    def parameters(self, ellipse = True):
+        """
+        Returns the parameters of the cluster as a dictionary with the same keys as parameters.measureCluster.
+        Dispersion is given for more than 3 craters and the radii of the best fit ellipse for more than 5 craters, if ellipse is True.
+
+        :param ellipse: fit the best fit ellipse, defaults to True
+        :type ellipse: bool
+        """
+        n = len(self._slots)
+        D, N, F = self.F_value()
+        new_cluster = {'HiRise_ID': self.HiRiseID, 'Number_Craters': n, 'd_eff': self.d_eff(), 'd_max': D, 'N>D/2': N,
+                       'F_value': F, 'central_latitude': self.latc, 'central_longitude': self.lonc}
+        if n > 3:
+            new_cluster['Dispersion'] = self.dispersion()[0]
+        if ellipse and n > 5:
+            centre, radii, rotation_matrix, rotation_angle = self.ellipse()
+            new_cluster['R1'] = radii[0]
+            new_cluster['R2'] = radii[1]
+        return new_cluster
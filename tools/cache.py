@@ -0,0 +1,230 @@
+import sys
+import os
+if __package__ in (None, ''):
+    #run as a script (python tools/cache.py), the modules are imported from the tools package
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    __package__ = 'tools'
+import hashlib
+import inspect
+import pickle
+import tempfile
+import numpy as np
+import pandas as pd
+from .cluster import Cluster
+'''
+On-disk cache for the results of measureCluster and the functions in functions.py.
+Results are stored under a key made from the crater data, the central coordinates, all parameters of the function (including defaults)
+and a hash of the source files of the calculations (SOURCES), so a cluster is only recalculated when its data, its parameters or the code changed.
+Changes to other code the results depend on (i.e. numpy or scipy) are not seen, run invalidate after updating them.
+Calls that depend on an unseeded random generator (BestFitEllipse without an integer rng) are never cached.
+The cache is bounded in size, the least recently used results are removed first.
+The directory is only scanned when the running size of the cache passes the bound, and every check_every writes for the results of other processes.
+To empty the cache run 'python tools/cache.py invalidate [directory]'.
+'''
+
+#source files of measureCluster and the functions it calls, their hash is part of every key so results of older code are not reused
+SOURCES = ['functions.py', 'cluster.py', 'parameters.py']
+
+def _source_version():
+    digest = hashlib.sha256()
+    folder = os.path.dirname(os.path.abspath(__file__))
+    for name in SOURCES:
+        with open(os.path.join(folder, name), 'rb') as file:
+            digest.update(file.read())
+    return digest.hexdigest()
+
+VERSION = _source_version()
+
+def _update(digest, value):
+    #adds a value to the hash, arrays, dataframes and clusters by their content
+    if isinstance(value, pd.DataFrame):
+        digest.update(repr(list(value.columns)).encode())
+        for column in value.columns:
+            _update(digest, value[column].to_numpy())
+    elif isinstance(value, Cluster):
+        digest.update(b'Cluster')
+        _update(digest, value._coords)
+        _update(digest, value.diameter)
+        _update(digest, (value.latc, value.lonc, value.HiRiseID))
+    elif isinstance(value, pd.Series):
+        _update(digest, value.to_numpy())
+    elif isinstance(value, np.ndarray):
+        if value.dtype.kind in 'biuf':
+            value = np.ascontiguousarray(value, dtype = float)
+            digest.update(repr(value.shape).encode())
+            digest.update(value.tobytes())
+        else:
+            digest.update(pd.util.hash_array(value.ravel()).tobytes())
+    elif isinstance(value, dict):
+        for key in sorted(value):
+            digest.update(repr(key).encode())
+            _update(digest, value[key])
+    elif isinstance(value, (list, tuple)):
+        digest.update(repr(len(value)).encode())
+        for item in value:
+            _update(digest, item)
+    elif value is None or isinstance(value, (str, bytes, bool, int, float, np.generic)):
+        digest.update(repr(value).encode())
+    else: #the repr of other objects can contain their address, which would give a new key in every run
+        raise TypeError('can not make a cache key from ' + type(value).__name__)
+    digest.update(b'|')
+
+class ResultCache:
+    """
+    Cache of results stored as pickle files in a directory.
+
+    :param directory: directory of the cache, created if it does not exist, defaults to '.cluster_cache'
+    :type directory: str
+    :param max_bytes: largest size of the cache on disk before the least recently used results are removed, defaults to 512 MB
+    :type max_bytes: int
+    :param check_every: number of writes after which the directory is scanned again, to count the results written by other processes sharing it, defaults to 256
+    :type check_every: int
+    """
+    def __init__(self, directory = '.cluster_cache', max_bytes = 512*2**20, check_every = 256):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.check_every = check_every
+        self._size = None #size of the cache at the last scan plus the results written since, None before the first scan
+        self._writes = 0 #writes since the last scan
+        os.makedirs(directory, exist_ok = True)
+
+    def key(self, *parts):
+        """
+        Makes the key of a result from any number of parts (names, numbers, arrays, dataframes, clusters), together with the hash of the source files.
+        Raises a TypeError for parts of other types.
+        """
+        digest = hashlib.sha256(VERSION.encode())
+        for part in parts:
+            _update(digest, part)
+        return digest.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + '.pkl')
+
+    def get(self, key, default = None):
+        """
+        Returns the result stored under key, or default if there is none.
+        """
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as file:
+                value = pickle.load(file)
+            os.utime(path) #marking as recently used
+        except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+            return default
+        return value
+
+    def set(self, key, value):
+        """
+        Stores a result under key and removes the least recently used results if the cache is larger than max_bytes.
+        """
+        path = self._path(key)
+        #writing to a temporary file first, so other processes never read half written results
+        handle, temp = tempfile.mkstemp(dir = self.directory, suffix = '.tmp')
+        with os.fdopen(handle, 'wb') as file:
+            pickle.dump(value, file, protocol = pickle.HIGHEST_PROTOCOL)
+            size = file.tell()
+        try:
+            size -= os.path.getsize(path) #a result written again replaces the old one
+        except FileNotFoundError:
+            pass
+        os.replace(temp, path)
+        self._writes += 1
+        if self._size is None or self._writes >= self.check_every:
+            self.evict()
+        else:
+            self._size += size
+            if self._size > self.max_bytes:
+                self.evict()
+
+    def evict(self):
+        """
+        Removes the least recently used results if the cache is larger than max_bytes, down to 90% of max_bytes so the next writes fit without scanning the directory again.
+        """
+        entries = []
+        total = 0
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith('.pkl'):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError: #removed by another process
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+                total += stat.st_size
+        entries.sort()
+        target = self.max_bytes if total <= self.max_bytes else 0.9*self.max_bytes
+        for mtime, size, path in entries:
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+        self._size = total
+        self._writes = 0
+
+    def invalidate(self, key = None):
+        """
+        Removes the result stored under key, or all results if no key is given.
+        """
+        if key is not None:
+            paths = [self._path(key)]
+        else:
+            paths = [entry.path for entry in os.scandir(self.directory) if entry.name.endswith('.pkl') or entry.name.endswith('.tmp')]
+        for path in paths:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        self._size = None #counted again at the next write
+
+    def call(self, func, ClusterData, *args, columns = None, **kwargs):
+        """
+        Calls func(ClusterData, *args, **kwargs) through the cache, i.e. cache.call(ct.BestFitEllipse, df, rng = 1).
+        The key uses the given columns of ClusterData (all columns by default) and all arguments of func including its defaults.
+
+        :param func: function taking the cluster dataframe as first argument
+        :type func: function
+        :param ClusterData: dataframe containing all craters of a cluster
+        :type ClusterData: pandas dataframe
+        :param columns: columns of ClusterData the result depends on, defaults to None for all
+        :type columns: list of str
+        """
+        bound = inspect.signature(func).bind(ClusterData, *args, **kwargs)
+        bound.apply_defaults()
+        arguments = dict(bound.arguments)
+        arguments.pop(next(iter(arguments))) #the dataframe is hashed by its columns
+        if not seeded(arguments.get('rng', 0)):
+            return func(ClusterData, *args, **kwargs)
+        data = ClusterData if columns is None else ClusterData[list(columns)]
+        key = self.key(func.__module__ + '.' + func.__qualname__, data, arguments)
+        result = self.get(key, _MISSING)
+        if result is _MISSING:
+            result = func(ClusterData, *args, **kwargs)
+            self.set(key, result)
+        return result
+
+_MISSING = object()
+
+def seeded(rng):
+    """
+    Checks if rng is an integer seed. Results depending on an unseeded or shared random generator can not be reused.
+    """
+    return isinstance(rng, (int, np.integer)) and not isinstance(rng, bool)
+
+def main(argv = None):
+    import argparse
+    parser = argparse.ArgumentParser(prog = 'ClusterCache', description = 'Manage the cache of cluster parameters')
+    parser.add_argument('command', choices = ['invalidate', 'info'], help = 'invalidate removes all cached results, info prints the number and size of cached results')
+    parser.add_argument('directory', nargs = '?', default = '.cluster_cache', help = 'cache directory, defaults to .cluster_cache')
+    args = parser.parse_args(argv)
+    cache = ResultCache(args.directory)
+    if args.command == 'invalidate':
+        cache.invalidate()
+    else:
+        sizes = [entry.stat().st_size for entry in os.scandir(args.directory) if entry.name.endswith('.pkl')]
+        print(str(len(sizes)) + ' results, ' + str(round(sum(sizes)/2**20, 2)) + ' MB')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,162 @@
+import pandas as pd
+import numpy as np
+from . import functions as ct
+from .cluster import Cluster
+'''
+Tools to calculate the parameters of all clusters in a catalog at once.
+The catalog is the main list written by parameters.writeClusterAttributes, indexed by (HiRiseID, crater_no).
+The simple parameters are calculated for all clusters together with grouped operations,
+dispersion and best fit ellipse are calculated cluster by cluster with the vectorised functions, on a Cluster (see cluster.py) of the craters of each.
+'''
+
+def central_coordinates(main_df, centres = None, x = 'x_coord', y = 'y_coord'):
+    """
+    Finds the central coordinates of the image of every cluster in the main list.
+    Returns a dataframe indexed by HiRise ID with the columns 'central_latitude' and 'central_longitude'.
+    Without a table the mean coordinates of each cluster are used, R1 and R2 depend on the centre (see measureCluster),
+    so they only reproduce the stored parameters with the central coordinates of the images.
+
+    :param main_df: main list of all craters, indexed by (HiRiseID, crater_no)
+    :type main_df: pandas dataframe
+    :param centres: table with the columns 'HiRise_ID' (or indexed by HiRise ID), 'central_latitude' and 'central_longitude', i.e. the parameters sheet, defaults to None to use the mean coordinates of each cluster
+    :type centres: pandas dataframe
+    :param x: column name giving the longitude, defaults to 'x_coord'
+    :type x: str
+    :param y: column name giving the latitude, defaults to 'y_coord'
+    :type y: str
+    """
+    grouped = main_df[[x, y]].groupby(level=0, sort=False)
+    if centres is None:
+        #latitude from y and longitude from x, as in the parameter sheet
+        coordinates = grouped.mean().rename(columns={y: 'central_latitude', x: 'central_longitude'})
+        return coordinates[['central_latitude', 'central_longitude']]
+    centres = centres.drop_duplicates('HiRise_ID').set_index('HiRise_ID') if 'HiRise_ID' in centres.columns else centres
+    coordinates = centres[['central_latitude', 'central_longitude']].reindex(list(grouped.groups))
+    missing = coordinates.index[coordinates.isna().any(axis=1)]
+    if len(missing) > 0:
+        raise KeyError('no central coordinates for clusters: ' + ', '.join(map(str, missing)))
+    return coordinates
+
+def compute_catalog(main_df, centres = None, diameter = 'Diam_m', x = 'x_coord', y = 'y_coord', tolerance = None, n_bootstrap = 301, rng = None, dispersion_mode = 'exact', exact_below = 2000,
+                    ellipse_method = 'khachiyan', stop_tolerance = None):
+    """
+    Calculates the parameters of every cluster in the main list and returns them as a dataframe with the same columns as measureCluster gives.
+    Dispersion is only calculated for clusters of more than 3 craters and the best fit ellipse for clusters of more than 5 craters, otherwise they are NaN.
+
+    :param main_df: main list of all craters, indexed by (HiRiseID, crater_no)
+    :type main_df: pandas dataframe
+    :param centres: table indexed by HiRise ID with the columns 'central_latitude' and 'central_longitude' (i.e. the parameters sheet), defaults to None to use the mean coordinates of each cluster
+    :type centres: pandas dataframe
+    :param diameter: name of the column giving the diameter in metres, defaults to 'Diam_m'
+    :type diameter: str
+    :param x: column name giving the longitude, defaults to 'x_coord'
+    :type x: str
+    :param y: column name giving the latitude, defaults to 'y_coord'
+    :type y: str
+    :param tolerance: gives the tolerance for the Kachiyan algorithm, defaults to None for 0.1
+    :type tolerance: float
+    :param n_bootstrap: number of bootstrap samples for the best fit ellipse, defaults to 301
+    :type n_bootstrap: int
+    :param rng: random generator or seed for the bootstrap samples, defaults to None
+    :type rng: numpy.random.Generator or int
+    :param dispersion_mode: 'exact', 'sampled' or 'auto' (see functions.dispersion_auto), the mode used for each cluster is given in the column Dispersion_mode, defaults to 'exact'
+    :type dispersion_mode: str
+    :param exact_below: number of craters below which the 'auto' mode calculates the dispersion exactly, defaults to 2000
+    :type exact_below: int
+    :param ellipse_method: 'khachiyan' or 'hull' (see functions.BestFitEllipse), defaults to 'khachiyan'
+    :type ellipse_method: str
+    :param stop_tolerance: stops the bootstrap of each best fit ellipse early, the number of samples used is given in the column Bootstrap_samples, defaults to None
+    :type stop_tolerance: float
+    """
+    rng = np.random.default_rng(rng)
+    df = main_df[[x, y]].astype(float)
+    if diameter in main_df.columns:
+        df['D'] = main_df[diameter].astype(float)
+    else: #main lists straight from CraterTools still have the diameter in km
+        df['D'] = (main_df['Diam_km']*1000).round(2)
+    IDs = df.index.get_level_values(0)
+    grouped = df.groupby(IDs, sort=False)
+
+    #effective diameter, largest crater and F value for all clusters at once:
+    parameters = pd.DataFrame({'Number_Craters': grouped.size()})
+    parameters['d_eff'] = ((df['D']**3).groupby(IDs, sort=False).sum()**(1/3)).round(3)
+    largest = grouped['D'].transform('max')
+    parameters['d_max'] = grouped['D'].max()
+    parameters['N>D/2'] = (df['D'] >= largest/2).groupby(IDs, sort=False).sum()
+    parameters['F_value'] = parameters['N>D/2']/parameters['Number_Craters']
+
+    #central coordinates of the images:
+    parameters = parameters.join(central_coordinates(main_df, centres, x, y))
+
+    #converting all coordinates from degrees to metres at once, as in measureCluster:
+    latc = parameters['central_latitude'].reindex(IDs).to_numpy()
+    lonc = parameters['central_longitude'].reindex(IDs).to_numpy()
+    lon = df[x].to_numpy(dtype=float)
+    lat = df[y].to_numpy(dtype=float)
+    x_metres = (lon - latc)*ct.Rmars*(np.pi/180)
+    y_metres = (lat - lonc)*ct.Rmars*(np.pi/180)*np.sin(np.radians(90 - lat))
+
+    #dispersion and best fit ellipse need the craters of each cluster, the results are placed by HiRise ID:
+    disp = np.full((len(parameters), 3), np.nan) #dispersion and its confidence interval
+    modes = np.full(len(parameters), None, dtype=object)
+    R1 = np.full(len(parameters), np.nan)
+    R2 = np.full(len(parameters), np.nan)
+    ellipses = np.full((len(parameters), 3), np.nan) #centre and angle of the best fit ellipse
+    n_samples = np.full(len(parameters), np.nan)
+    for HiRiseID, positions in grouped.indices.items():
+        i = parameters.index.get_loc(HiRiseID)
+        crater_no = len(positions)
+        if crater_no > 3:
+            *disp[i], modes[i] = ct.dispersion_auto(Cluster(lon[positions], lat[positions]), mode=dispersion_mode, exact_below=exact_below, rng=rng)
+        if crater_no > 5:
+            info = {}
+            centre, (R1[i], R2[i]), rotation_matrix, ellipses[i, 2] = ct.BestFitEllipse(Cluster(x_metres[positions], y_metres[positions]), tolerance, n_bootstrap=n_bootstrap,
+                                                                                       rng=rng, info=info, method=ellipse_method, stop_tolerance=stop_tolerance)
+            ellipses[i, :2] = centre
+            n_samples[i] = info['samples']
+    parameters['Dispersion'] = disp[:, 0]
+    parameters['Dispersion_mode'] = modes
+    parameters['R1'] = R1
+    parameters['R2'] = R2
+    parameters['Ellipse_x'] = ellipses[:, 0]
+    parameters['Ellipse_y'] = ellipses[:, 1]
+    parameters['Ellipse_angle'] = ellipses[:, 2]
+    if stop_tolerance is not None:
+        parameters['Bootstrap_samples'] = n_samples
+    if (modes == 'sampled').any(): #confidence interval of the sampled dispersions, as measureCluster gives it
+        parameters['Dispersion_low'] = np.where(modes == 'sampled', disp[:, 1], np.nan)
+        parameters['Dispersion_high'] = np.where(modes == 'sampled', disp[:, 2], np.nan)
+
+    parameters.index.name = 'HiRise_ID'
+    return parameters.reset_index()
+
+#columns compared by compare_catalog
+CHECKED_COLUMNS = ['Number_Craters', 'd_eff', 'd_max', 'N>D/2', 'F_value', 'Dispersion', 'R1', 'R2']
+
+def compare_catalog(main_df, parameters, rtol = 1e-6, ellipse_rtol = 0.1, **kwargs):
+    """
+    Calculates the parameters of every cluster in the main list with compute_catalog, using the central coordinates of the parameter sheet, and compares them with the sheet.
+    Returns a dataframe with the columns HiRise_ID, column, stored and calculated for every value that differs, empty if the sheet is reproduced.
+
+    :param main_df: main list of all craters, indexed by (HiRiseID, crater_no)
+    :type main_df: pandas dataframe
+    :param parameters: parameter sheet with the columns 'HiRise_ID', 'central_latitude' and 'central_longitude', i.e. store.read_parameters()
+    :type parameters: pandas dataframe
+    :param rtol: relative tolerance of the comparison, defaults to 1e-6
+    :type rtol: float
+    :param ellipse_rtol: relative tolerance of R1 and R2, which come from a random bootstrap, defaults to 0.1
+    :type ellipse_rtol: float
+    :param kwargs: further arguments of compute_catalog, i.e. rng or n_bootstrap
+    """
+    stored = parameters.drop_duplicates('HiRise_ID').set_index('HiRise_ID')
+    calculated = compute_catalog(main_df, stored, **kwargs).set_index('HiRise_ID')
+    rows = []
+    for column in CHECKED_COLUMNS:
+        if column not in stored.columns or column not in calculated.columns:
+            continue
+        old = stored[column].reindex(calculated.index).to_numpy(dtype=float)
+        new = calculated[column].to_numpy(dtype=float)
+        differ = ~np.isclose(new, old, rtol = ellipse_rtol if column in ('R1', 'R2') else rtol, equal_nan = True)
+        for HiRiseID, old_value, new_value in zip(calculated.index[differ], old[differ], new[differ]):
+            rows.append({'HiRise_ID': HiRiseID, 'column': column, 'stored': old_value, 'calculated': new_value})
+    return pd.DataFrame(rows, columns = ['HiRise_ID', 'column', 'stored', 'calculated'])
@@ -0,0 +1,106 @@
+import numpy as np
+from . import functions as ct
+'''
+Compact representation of the craters of one cluster, used by measureCluster in place of copies of the dataframe.
+A Cluster holds the coordinates and diameters as contiguous float64 arrays and gives them out by column name like a dataframe,
+cluster['Diam_m'] or cluster[['x_coord', 'y_coord']], so the functions in functions.py take it without copying anything.
+The coordinates in metres relative to the centre of the image are calculated once, on first use, and kept with the cluster.
+'''
+
+#columns of a cluster dataframe and the attribute giving them
+_COLUMNS = {'x_coord': 'lon', 'y_coord': 'lat', 'Diam_m': 'diameter'}
+
+class Cluster:
+    """
+    Craters of one cluster as arrays. Create it from a dataframe with Cluster.from_frame.
+
+    :param lon: x coordinates (longitude) of the craters in degrees, the column x_coord
+    :type lon: array
+    :param lat: y coordinates (latitude) of the craters in degrees, the column y_coord
+    :type lat: array
+    :param diameter: diameters of the craters in metres, the column Diam_m, defaults to None
+    :type diameter: array
+    :param latc: central latitude of image, needed for the coordinates in metres, defaults to None
+    :type latc: float
+    :param lonc: central longitude of image, needed for the coordinates in metres, defaults to None
+    :type lonc: float
+    :param HiRiseID: HiRise Observation ID of the cluster, defaults to None
+    :type HiRiseID: str
+    """
+    __slots__ = ('_coords', 'diameter', 'latc', 'lonc', 'HiRiseID', '_metres')
+
+    def __init__(self, lon, lat, diameter = None, latc = None, lonc = None, HiRiseID = None):
+        self._coords = np.empty((2, len(lon))) #both coordinates in one block, cluster[['x_coord', 'y_coord']] is a view of it
+        self._coords[0] = lon
+        self._coords[1] = lat
+        self.diameter = None if diameter is None else np.ascontiguousarray(diameter, dtype=float)
+        self.latc = latc
+        self.lonc = lonc
+        self.HiRiseID = HiRiseID
+        self._metres = None
+
+    @classmethod
+    def from_frame(cls, ClusterData, latc = None, lonc = None, HiRiseID = None, diameter = 'Diam_m', x = 'x_coord', y = 'y_coord'):
+        """
+        Creates a Cluster from a dataframe of craters, i.e. as read by parameters.readClusterFile.
+        Only the coordinates are copied, a float diameter column is used as it is.
+
+        :param ClusterData: dataframe containing all craters of a cluster
+        :type ClusterData: pandas dataframe
+        :param latc: central latitude of image, defaults to None
+        :type latc: float
+        :param lonc: central longitude of image, defaults to None
+        :type lonc: float
+        :param HiRiseID: HiRise Observation ID of the cluster, defaults to None
+        :type HiRiseID: str
+        :param diameter: name of the column giving the diameter in metres, Diam_km is converted like in measureCluster if it is missing, defaults to 'Diam_m'
+        :type diameter: str
+        :param x: column name giving the longitude, defaults to 'x_coord'
+        :type x: str
+        :param y: column name giving the latitude, defaults to 'y_coord'
+        :type y: str
+        """
+        if diameter in ClusterData.columns:
+            diameters = ClusterData[diameter].to_numpy(dtype=float)
+        elif 'Diam_km' in ClusterData.columns:
+            diameters = (ClusterData['Diam_km']*1000).round(2).to_numpy(dtype=float)
+        else:
+            diameters = None
+        return cls(ClusterData[x].to_numpy(dtype=float), ClusterData[y].to_numpy(dtype=float), diameters, latc, lonc, HiRiseID)
+
+    @property
+    def lon(self):
+        return self._coords[0]
+
+    @property
+    def lat(self):
+        return self._coords[1]
+
+    def __len__(self):
+        return self._coords.shape[1]
+
+    def __getitem__(self, key):
+        #columns by their dataframe names, a list of the two coordinates gives an array of shape (N, 2)
+        if isinstance(key, str):
+            if key not in _COLUMNS or getattr(self, _COLUMNS[key]) is None:
+                raise KeyError(key)
+            return getattr(self, _COLUMNS[key])
+        key = list(key)
+        if key == ['x_coord', 'y_coord']:
+            return self._coords.T
+        if key == ['y_coord', 'x_coord']:
+            return self._coords[::-1].T
+        return np.column_stack([self[column] for column in key])
+
+    def projected(self):
+        """
+        Returns the cluster with its coordinates converted to metres relative to the centre of the image, as functions.to_metres does for a dataframe.
+        The conversion is done on the first call and the result kept for later ones.
+        """
+        if self._metres is None:
+            if self.latc is None or self.lonc is None:
+                raise ValueError('the central coordinates of the image are needed to convert to metres')
+            x = (self.lon - self.latc)*ct.Rmars*(np.pi/180)
+            y = (self.lat - self.lonc)*ct.Rmars*(np.pi/180)*np.sin(np.radians(90 - self.lat))
+            self._metres = Cluster(x, y, self.diameter, HiRiseID = self.HiRiseID)
+        return self._metres
@@ -1,43 +1,140 @@
+import sys
+import os
+if __package__ in (None, ''):
+    #run as a script (python tools/curvefit.py), the modules are imported from the tools package
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    __package__ = 'tools'
 import pandas as pd
 import numpy as np
 import scipy.stats as st
-import matplotlib.pyplot as plt
-import math as mt
-import functions as ct
-import sklearn.metrics as sm
-
-#importing dataframe (test on one for now):
-df1 = pd.read_excel('C:/Users/jae4518/OneDrive - Imperial College London/HiRise_Images_Clusters/ClustersDataSheet/ESP_017425_2045formatted.xlsx', index_col=[0,1])
-df2 = pd.read_excel('C:/Users/jae4518/OneDrive - Imperial College London/HiRise_Images_Clusters/ClustersDataSheet/ESP_050154_1750formatted.xlsx', index_col = [0,1])
-#looping to fit a gamma curve:
-def gamma_fit(df,max_iter = 100, tol = 0.05):
-    disp, sep_array = ct.dispersion(df) #Calculating dispersion and separations for the cluster
-    a_array = np.linspace(0.1, 2, 5)
-    scale_array = np.linspace(0.1, 2, 5)
-    iter = 0
-    x = np.linspace(0,np.max(sep_array), len(sep_array))
-    while iter < max_iter:
-        grid_points = {}
-        for a in a_array: #looping over the arrays of possible values
-            for s in scale_array:
-                print('S: ',s)
-                loss = sm.mean_squared_error(sep_array,st.gamma.cdf(x,a,scale=s),multioutput='uniform_average')
-                if loss <= tol:
-                    return a, s, loss
-                grid_points[loss] = [a,s]
-        smallest = sorted(grid_points)[0]
-        second = sorted(grid_points)[1]
-        a_array = np.linspace(grid_points[smallest][0], grid_points[second][0], 5)
-        scale_array = np.linspace(grid_points[smallest][1], grid_points[second][1], 5)
-        iter +=1
-        print(iter)
-    return a,s,loss
-disp, sep_array = ct.dispersion(df1)
-x = np.linspace(0,np.max(sep_array), 100)
-a,s,loss = gamma_fit(df1)
-print(a,s, loss)
-fig = plt.figure()
-ax = fig.add_subplot(111)
-ax.plot(st.gamma.cdf(x,a =a , scale=s), label = 'Gamma distribution')
-ax.hist(sep_array, 'auto', density=True, cumulative=True)
-plt.show()
+from scipy.special import digamma, polygamma
+from concurrent.futures import ProcessPoolExecutor
+from . import functions as ct
+'''
+Fitting a gamma distribution to the separations of all crater pairs in a cluster, as given by functions.dispersion.
+The fit uses the maximum likelihood estimate (or the method of moments) instead of a grid search, so it takes milliseconds per cluster.
+The loss is the mean squared error between the empirical and the fitted cumulative distribution.
+Importing the module has no side effects, run it as a script to plot the fit for a formatted cluster sheet.
+'''
+
+def fit_gamma(sep_array, method = 'mle', max_iter = 20, tol = 1e-10):
+    '''
+    Fits a gamma distribution with its location at 0 to an array of separations.
+    Separations of 0 (craters at the same position) are left out, as the likelihood is not defined for them.
+    Returns the shape a, the scale and the loss of the fit.
+
+    :param sep_array: separations of all crater pairs in metres
+    :type sep_array: numpy array
+    :param method: 'mle' for the maximum likelihood estimate or 'moments' for the method of moments, defaults to 'mle'
+    :type method: str
+    :param max_iter: largest number of Newton iterations of the maximum likelihood estimate, defaults to 20
+    :type max_iter: int
+    :param tol: tolerance of the Newton iterations, defaults to 1e-10
+    :type tol: float
+    '''
+    sep = np.sort(np.asarray(sep_array, dtype=float))
+    sep = sep[sep > 0]
+    if len(sep) < 2:
+        raise ValueError('need at least two separations larger than 0 to fit a gamma distribution')
+    mean = sep.mean()
+    if method == 'moments':
+        a = mean**2/sep.var()
+    elif method == 'mle':
+        #solving ln(a) - digamma(a) = ln(mean) - mean(ln(sep)), starting from the approximation of Minka (2002)
+        s = np.log(mean) - np.log(sep).mean()
+        a = (3 - s + np.sqrt((s - 3)**2 + 24*s))/(12*s)
+        for _ in range(max_iter):
+            step = (np.log(a) - digamma(a) - s)/(1/a - polygamma(1, a))
+            a -= step
+            if abs(step) < tol*a:
+                break
+    else:
+        raise ValueError("method must be 'mle' or 'moments'")
+    scale = mean/a
+    ecdf = (np.arange(len(sep)) + 0.5)/len(sep) #empirical cumulative distribution at the sorted separations
+    loss = np.mean((st.gamma.cdf(sep, a, scale=scale) - ecdf)**2)
+    return a, scale, loss
+
+def gamma_fit(ClusterData, method = 'mle', x = 'x_coord', y = 'y_coord'):
+    '''
+    Fits a gamma distribution to the separations of all crater pairs of a cluster.
+    Returns the shape a, the scale and the loss of the fit.
+
+    :param ClusterData: Dataframe containing all craters in clusters
+    :type ClusterData: pandas dataframe
+    :param method: 'mle' for the maximum likelihood estimate or 'moments' for the method of moments, defaults to 'mle'
+    :type method: str
+    :param x: column name giving the longitude, defaults to 'x_coord'
+    :type x: str
+    :param y: column name giving the latitude, defaults to 'y_coord'
+    :type y: str
+    '''
+    disp, sep_array = ct.dispersion(ClusterData, x, y) #Calculating dispersion and separations for the cluster
+    return fit_gamma(sep_array, method)
+
+def _fitCluster(HiRiseID, ClusterData, method, x, y):
+    #worker of gamma_fit_catalog, clusters that can not be fitted get NaN
+    try:
+        a, scale, loss = gamma_fit(ClusterData, method, x, y)
+    except ValueError:
+        a, scale, loss = np.nan, np.nan, np.nan
+    return {'HiRise_ID': HiRiseID, 'a': a, 'scale': scale, 'loss': loss}
+
+def gamma_fit_catalog(main_df, method = 'mle', workers = None, x = 'x_coord', y = 'y_coord'):
+    '''
+    Fits a gamma distribution to the separations of every cluster in the main list, using a pool of worker processes.
+    Returns a dataframe with the columns HiRise_ID, a, scale and loss, clusters with too few craters give NaN.
+
+    :param main_df: main list of all craters, indexed by (HiRiseID, crater_no)
+    :type main_df: pandas dataframe
+    :param method: 'mle' for the maximum likelihood estimate or 'moments' for the method of moments, defaults to 'mle'
+    :type method: str
+    :param workers: number of worker processes, 1 fits in this process, defaults to None for the number of CPUs
+    :type workers: int
+    :param x: column name giving the longitude, defaults to 'x_coord'
+    :type x: str
+    :param y: column name giving the latitude, defaults to 'y_coord'
+    :type y: str
+    '''
+    coords = main_df[[x, y]]
+    grouped = coords.groupby(level=0, sort=False)
+    IDs = list(grouped.groups)
+    clusters = [coords.iloc[positions] for positions in grouped.indices.values()]
+    n_clusters = len(IDs)
+    jobs = (IDs, clusters, [method]*n_clusters, [x]*n_clusters, [y]*n_clusters)
+    if workers == 1:
+        results = list(map(_fitCluster, *jobs))
+    else:
+        with ProcessPoolExecutor(max_workers = workers) as pool:
+            results = list(pool.map(_fitCluster, *jobs, chunksize = max(1, n_clusters//64)))
+    return pd.DataFrame(results, columns = ['HiRise_ID', 'a', 'scale', 'loss'])
+
+def plot_gamma_fit(sep_array, a, scale):
+    '''
+    Plots the cumulative histogram of the separations together with the fitted gamma distribution.
+
+    :param sep_array: separations of all crater pairs in metres
+    :type sep_array: numpy array
+    :param a: shape of the gamma distribution
+    :type a: float
+    :param scale: scale of the gamma distribution
+    :type scale: float
+    '''
+    import matplotlib.pyplot as plt
+    x = np.linspace(0, np.max(sep_array), 100)
+    fig = plt.figure()
+    ax = fig.add_subplot(111)
+    ax.plot(x, st.gamma.cdf(x, a, scale=scale), label = 'Gamma distribution')
+    ax.hist(sep_array, 'auto', density=True, cumulative=True)
+    ax.legend()
+    return fig, ax
+
+if __name__ == '__main__':
+    import matplotlib.pyplot as plt
+    #fitting a formatted cluster sheet given on the command line:
+    df = pd.read_excel(sys.argv[1], index_col=[0,1])
+    disp, sep_array = ct.dispersion(df)
+    a, s, loss = fit_gamma(sep_array)
+    print(a, s, loss)
+    plot_gamma_fit(sep_array, a, s)
+    plt.show()
@@ -1,31 +1,26 @@
-import pandas as pd
 import numpy as np
-import matplotlib.pyplot as plt
-import random
 import math as mt
 from numpy import linalg
-from math import floor, log10
 """
 Tools used to format data of Crater Clusters and calculate the parameters needed.
-All functions assume a Pandas dataframe as input for the cluster data.
+All functions assume a Pandas dataframe as input for the cluster data, or a Cluster (see cluster.py) which gives the same columns without copying.
 It is set up to work on Mars, using its average radius in the dispersion function.
 """
 
 #Calculating effective diameter from a pandas database:
-#Must loop over single entries if done for a Multiindex of several clusters
+#For a Multiindex of several clusters use catalog.compute_catalog instead of looping over single entries
 def d_eff(ClusterData, diameter = 'Diam_m'):
     '''
     Function to calculate the effective diameter of a cluster.
     d_effective = (sum(d_crater^3))^1/3
 
-    :param ClusterData: Dataframe containing the craters
+    :param ClusterData: Dataframe or Cluster containing the craters
     :type ClusterData: pandas datafram
     :param diameter: name of the column in dataframe giving the diameter in metres
     :type diameter: str
     '''
-    df = ClusterData.copy() #work copy of the data to not alter the original file
-    df['D_cubed'] = df[diameter].apply(lambda x: x**3)
-    d_effective = round((df['D_cubed'].sum())**(1/3), 3) #calculating the effective diameter
+    D = np.asarray(ClusterData[diameter], dtype=float)
+    d_effective = round(np.sum(D**3)**(1/3), 3) #calculating the effective diameter
     return d_effective
 
 #Calculating F value. Ratio of craters of larger diameter than half the diameter of the largest crater in cluster_file
@@ -33,33 +28,80 @@ def d_eff(ClusterData, diameter = 'Diam_m'):
 def F_value(ClusterData, diameter = 'Diam_m'):
     '''
     This function will find the diameter of the largest crater in the cluster, the number of craters that are larger than half the largest and the fraction of how many those are.
-    :param ClusterData: Dataframe containing the craters
+    :param ClusterData: Dataframe or Cluster containing the craters
     :type ClusterData: pandas datafram
     :param diameter: name of the column in dataframe giving the diameter in metres
     :type diameter: str
     '''
     #ClusterData is the pandas Database of all craters in the cluster
     #diameter is the name of the column giving the Diameter in metre
-    df = ClusterData.copy() #create a work copy
-    D = df[diameter].max() #diameter of largest crater in cluster
-    largerDhalf = df[diameter] >=(D/2) #finding which craters are larger than D/2
-    N = 0
-    total = 0
-    for crater in largerDhalf:
-        if crater == True:
-            N += 1
-            total += 1
-        else: total +=1 #counting amount of larger craters
-    F = N/total #calculating F values
+    diameters = np.asarray(ClusterData[diameter], dtype=float)
+    D = np.max(diameters) if len(diameters) else np.nan #diameter of largest crater in cluster
+    N = int(np.count_nonzero(diameters >= D/2)) #counting the craters larger than D/2
+    F = N/len(diameters) #calculating F values
     return D, N, F
 
+Rmars = 3390000 #radius of Mars in metres
+
+def to_metres(ClusterData, latc, lonc, x = 'x_coord', y = 'y_coord'):
+    '''
+    Converts the coordinates of a cluster from degrees to metres relative to the centre of the image, as used for the best fit ellipse.
+    Returns a copy of the dataframe with the converted coordinates, the original is not changed.
+    For a Cluster use its projected method, which keeps the converted coordinates.
+
+    :param ClusterData: Dataframe containing all craters in clusters
+    :type ClusterData: pandas dataframe
+    :param latc: central latitude of image
+    :type latc: float
+    :param lonc: central longitude of image
+    :type lonc: float
+    :param x: column name giving the longitude, defaults to 'x_coord'
+    :type x: str
+    :param y: column name giving the latitude, defaults to 'y_coord'
+    :type y: str
+    '''
+    df = ClusterData.copy()
+    df[x] = (df[x] - latc)*Rmars*(np.pi/180)
+    df[y] = (df[y] - lonc)*Rmars*(np.pi/180)*np.sin(np.radians(90 - df[y]))
+    return df
+
+def _pair_blocks(coord_array, block_size = None):
+    '''
+    Generator over the separations of all crater pairs in metres, computed in blocks of rows of the pairwise matrix.
+    Each block holds the separations of craters n in [start, stop) to all craters m > n, in the same order as a nested loop over n and m.
+    Memory use is bounded by block_size * N instead of N^2.
+
+    :param coord_array: array of shape (N, 2) giving the x and y coordinates in degrees
+    :type coord_array: numpy array
+    :param block_size: number of rows of the pairwise matrix per block, defaults to about 2^20 / N
+    :type block_size: int
+    '''
+    n_craters = len(coord_array)
+    if block_size is None:
+        block_size = max(1, 2**20 // max(n_craters, 1))
+    xs = coord_array[:, 0]
+    ys = coord_array[:, 1]
+    for start in range(0, n_craters - 1, block_size):
+        stop = min(start + block_size, n_craters - 1)
+        #rows: first crater of each pair, columns: second crater of each pair
+        sep = _separation(xs[start:stop, None], ys[start:stop, None], xs[None, start+1:], ys[None, start+1:])
+        yield sep[np.triu(np.ones(sep.shape, dtype=bool))] #only keeping the pairs with m > n
+
+def _separation(xn, yn, xm, ym):
+    #separation in metres of craters n and m, coordinates in degrees
+    deg_to_m = Rmars*(np.pi/180)
+    dx = (xm - xn)*deg_to_m*np.sin(np.radians(90 - (xm + xn)/2)) #converting to metres based xy coordinates
+    dy = (ym - yn)*deg_to_m
+    return np.sqrt(dx**2 + dy**2)
+
 #Calculating the Dispersion of a cluster as the standard deviation of the separation of all possible crater combinations:
-def dispersion(ClusterData, x = 'x_coord', y = 'y_coord'):
+def dispersion(ClusterData, x = 'x_coord', y = 'y_coord', block_size = None):
     '''
     This function calculates the dispersion of a cluster from a pandas dataframe giving the x and y coordinates of .
     The dispersion is defined as the standard deviation of the distance between all possible crater pairs.
     This method gives meaningul results for clusters with more than 3 craters in a cluster.
     It is using the radius of Mars to convert from lat/lon data to metres.
+    Use dispersion_stats if the array of all separations is not needed.
 
     :param ClusterData: Dataframe containing all craters in clusters
     :type ClusterData: pandas dataframe
@@ -67,109 +109,503 @@ def dispersion(ClusterData, x = 'x_coord', y = 'y_coord'):
     :type x: str
     :param y: column name giving the latitude, defaults to 'y_coord'
     :type y: str
+    :param block_size: number of craters per block of the pairwise calculation, defaults to an automatic size
+    :type block_size: int
     '''
-    Rmars = 3390000 #radius of Mars in metres
     #x and y are the names of the column in ClusterData denoting the x and y coordinates respectively
     #Assumes that x and y are in degrees still!
-    df = ClusterData.copy() #create work copy of database
-    coord_array = np.array(df[[x, y]]) #create array of xy coordinates for craters in cluster
-    sep_list = []
-    for n in range(0, len(coord_array)): #iterating over all craters for separation calculation
-        for m in range(n+1, len(coord_array)): #calculating seperation ((x2-x1)**2 + (y2 - y1)**2)**0.5 for all combinations
-            dx= (coord_array[m,0] - coord_array[n,0]) *Rmars*(np.pi/180)*mt.sin(mt.radians(90 - ((coord_array[m,0]+ coord_array[n,0])/2))) #converting to metres based xy coordinates
-            dy = (coord_array[m,1] - coord_array[n,1]) *Rmars*(np.pi/180)
-            sep = (dx**2+ dy**2)**0.5
-            sep_list.append(sep) #adding all separations to list
-    dispersion = np.std(sep_list) #calculating dispersion as standard deviation
-    sep_array = np.array(sep_list)
+    coord_array = np.asarray(ClusterData[[x, y]], dtype=float) #create array of xy coordinates for craters in cluster
+    sep_array = np.concatenate([np.empty(0)] + list(_pair_blocks(coord_array, block_size))) #separations of all combinations
+    dispersion = np.std(sep_array) #calculating dispersion as standard deviation
     return dispersion, sep_array
 
-def BestFitEllipse(ClusterData, tolerance=0.1, lat = 'x_coord', lon = 'y_coord'):
+def dispersion_stats(ClusterData, x = 'x_coord', y = 'y_coord', bins = None, block_size = None):
+    '''
+    This function calculates the same dispersion as the dispersion function without storing the separations of all crater pairs.
+    The standard deviation and mean separation are accumulated block by block with a streaming (Welford) reduction, so memory stays O(N).
+    Returns the dispersion, the mean separation and the histogram of separations as (counts, bin_edges), or None if no bins are given.
+
+    :param ClusterData: Dataframe containing all craters in clusters
+    :type ClusterData: pandas dataframe
+    :param x: column name giving the longitude, defaults to 'x_coord'
+    :type x: str
+    :param y: column name giving the latitude, defaults to 'y_coord'
+    :type y: str
+    :param bins: number of bins between 0 and the largest possible separation or array of bin edges in metres, defaults to None
+    :type bins: int or array
+    :param block_size: number of craters per block of the pairwise calculation, defaults to an automatic size
+    :type block_size: int
+    '''
+    coord_array = np.asarray(ClusterData[[x, y]], dtype=float)
+    if bins is not None and np.ndim(bins) == 0:
+        #the extent of the cluster gives an upper bound for all separations, as the latitude correction is at most 1
+        extent = np.ptp(coord_array, axis=0) if len(coord_array) > 0 else np.zeros(2)
+        bins = np.linspace(0, Rmars*(np.pi/180)*np.hypot(extent[0], extent[1]), int(bins) + 1)
+    counts = None if bins is None else np.zeros(len(bins) - 1, dtype=np.int64)
+    total = 0
+    mean = 0.0
+    M2 = 0.0 #running sum of squared differences from the mean
+    for sep in _pair_blocks(coord_array, block_size):
+        n_block = len(sep)
+        mean_block = sep.mean()
+        delta = mean_block - mean
+        new_total = total + n_block
+        #merging the statistics of the block into the running statistics:
+        mean += delta*n_block/new_total
+        M2 += ((sep - mean_block)**2).sum() + delta**2*total*n_block/new_total
+        total = new_total
+        if counts is not None:
+            counts += np.histogram(sep, bins)[0]
+    hist = None if bins is None else (counts, np.asarray(bins, dtype=float))
+    if total == 0: #no crater pairs
+        return np.nan, np.nan, hist
+    dispersion = np.sqrt(M2/total)
+    return dispersion, mean, hist
+
+def dispersion_sampled(ClusterData, x = 'x_coord', y = 'y_coord', n_pairs = 2**18, confidence = 0.95, rng = None):
+    '''
+    This function estimates the dispersion from a random sample of crater pairs instead of all pairs, so it takes the same time for any number of craters.
+    The pairs are drawn uniformly (with replacement) from all pairs, the confidence interval of the estimate follows from the fourth moment of the sampled separations.
+    Returns the estimated dispersion and the lower and upper bound of its confidence interval, NaN for less than two craters.
+
+    :param ClusterData: Dataframe containing all craters in clusters
+    :type ClusterData: pandas dataframe
+    :param x: column name giving the longitude, defaults to 'x_coord'
+    :type x: str
+    :param y: column name giving the latitude, defaults to 'y_coord'
+    :type y: str
+    :param n_pairs: number of sampled pairs, the width of the interval shrinks with 1/sqrt(n_pairs), defaults to 2^18
+    :type n_pairs: int
+    :param confidence: confidence level of the interval, defaults to 0.95
+    :type confidence: float
+    :param rng: random generator or seed for the sampled pairs, defaults to None
+    :type rng: numpy.random.Generator or int
+    '''
+    from statistics import NormalDist
+    coord_array = np.asarray(ClusterData[[x, y]], dtype=float)
+    n_craters = len(coord_array)
+    if n_craters < 2:
+        return np.nan, np.nan, np.nan
+    rng = np.random.default_rng(rng)
+    n = rng.integers(0, n_craters, n_pairs)
+    m = (n + rng.integers(1, n_craters, n_pairs)) % n_craters #a different crater, all pairs are equally likely
+    sep = _separation(coord_array[n, 0], coord_array[n, 1], coord_array[m, 0], coord_array[m, 1])
+    mean = sep.mean()
+    variance = ((sep - mean)**2).mean()
+    dispersion = np.sqrt(variance)
+    #standard error of the standard deviation, from the variance of the sample variance:
+    m4 = ((sep - mean)**4).mean()
+    error = np.sqrt(max(m4 - variance**2, 0.0)/n_pairs)/(2*dispersion) if dispersion > 0 else 0.0
+    z = NormalDist().inv_cdf(0.5 + confidence/2)
+    return dispersion, dispersion - z*error, dispersion + z*error
+
+def dispersion_auto(ClusterData, x = 'x_coord', y = 'y_coord', mode = 'auto', exact_below = 2000, n_pairs = 2**18, confidence = 0.95, rng = None):
+    '''
+    This function calculates the dispersion exactly (dispersion_stats) or estimates it from sampled pairs (dispersion_sampled).
+    In 'auto' mode clusters of less than exact_below craters are calculated exactly, larger ones are sampled.
+    Returns the dispersion, the lower and upper bound of its confidence interval (both equal to the dispersion if exact) and the mode used, 'exact' or 'sampled'.
+
+    :param ClusterData: Dataframe containing all craters in clusters
+    :type ClusterData: pandas dataframe
+    :param x: column name giving the longitude, defaults to 'x_coord'
+    :type x: str
+    :param y: column name giving the latitude, defaults to 'y_coord'
+    :type y: str
+    :param mode: 'exact', 'sampled' or 'auto', defaults to 'auto'
+    :type mode: str
+    :param exact_below: number of craters below which 'auto' calculates the dispersion exactly, defaults to 2000
+    :type exact_below: int
+    :param n_pairs: number of sampled pairs, defaults to 2^18
+    :type n_pairs: int
+    :param confidence: confidence level of the interval, defaults to 0.95
+    :type confidence: float
+    :param rng: random generator or seed for the sampled pairs, defaults to None
+    :type rng: numpy.random.Generator or int
+    '''
+    if mode not in ('exact', 'sampled', 'auto'):
+        raise ValueError("mode must be 'exact', 'sampled' or 'auto'")
+    if mode == 'exact' or (mode == 'auto' and len(ClusterData) < exact_below):
+        dispersion = dispersion_stats(ClusterData, x, y)[0]
+        return dispersion, dispersion, dispersion, 'exact'
+    return dispersion_sampled(ClusterData, x, y, n_pairs, confidence, rng) + ('sampled',)
+
+def _moment_matrices(V, first, second):
+    #full symmetric matrices of shape (B, d+1, d+1) from the entries of their upper triangles (shape (B, K), as from _lifted_products)
+    full = np.empty((len(V), second[-1] + 1, second[-1] + 1))
+    full[:, first, second] = V
+    full[:, second, first] = V
+    return full
+
+def _lifted_products(X):
+    #products of the lifted points q = (p, 1) of the points X of shape (N, d) with themselves, one row per entry of the upper triangle of q q^T, shape (K, N),
+    #with the rows and columns of these entries and the factor of each entry in q^T W q for a symmetric W
+    (N, d) = np.shape(X)
+    lifted = np.ones((d+1, N))
+    lifted[:d] = X.T
+    first, second = np.array([(i, k) for i in range(d+1) for k in range(i, d+1)]).T
+    return lifted[first] * lifted[second], first, second, np.where(first == second, 1.0, 2.0)
+
+def _weighted_scatter(u, F, first, second):
+    #weighted mean and scatter about it of the points for weights u of shape (B, N) summing to one in each row, F and its rows and columns as from _lifted_products
+    moments = _moment_matrices(np.matmul(u, F.T), first, second)
+    d = moments.shape[1] - 1
+    center = moments[:, :d, d]
+    return center, moments[:, :d, :d] - center[:, :, None]*center[:, None, :]
+
+def _determinant(S):
+    #determinants of a stack of matrices of shape (B, d, d), in closed form for 2x2 matrices as linalg.det is slow for many small matrices
+    if S.shape[1] == 2:
+        return S[:, 0, 0]*S[:, 1, 1] - S[:, 0, 1]*S[:, 1, 0]
+    return linalg.det(S)
+
+def _symmetric_inverse(V, first, second):
+    #inverses of a stack of symmetric matrices given by the entries of their upper triangles (shape (B, K), as from _lifted_products), in the same form
+    if V.shape[1] == 6: #3x3 matrices from their adjugates, much faster than linalg.inv for many small matrices
+        a, b, c, e, f, i = V.T
+        adjugate = np.empty_like(V)
+        adjugate[:, 0] = e*i - f*f
+        adjugate[:, 1] = c*f - b*i
+        adjugate[:, 2] = b*f - c*e
+        adjugate[:, 3] = a*i - c*c
+        adjugate[:, 4] = b*c - a*f
+        adjugate[:, 5] = a*e - b*b
+        adjugate /= (a*adjugate[:, 0] + b*adjugate[:, 1] + c*adjugate[:, 2])[:, None]
+        return adjugate
+    return linalg.inv(_moment_matrices(V, first, second))[:, first, second]
+
+def _khachiyan_batch(counts, X, tolerance=0.1, candidates=None):
+    '''
+    Runs the Kachiyan algorithm for the minimum volume enclosing ellipse on a stack of bootstrap samples of the same craters at once.
+    A sample is given by how often it contains each crater, all copies of a crater start with the same weight and only the first copy gains weight,
+    which is what the algorithm does on the sample itself, so the points are the craters and V and Q^T V^-1 Q are matrix products over them.
+    The crater gaining weight is always on the convex hull of the sample, so with the hull craters as candidates Q^T V^-1 Q is only needed for them,
+    the weights of the other craters only shrink and the result is the same.
+    Samples that have converged are dropped from the working arrays, so each iteration only works on the samples that still need it.
+    Every step moves weight to one crater, so V, the weights and the size of the step are updated from that crater instead of over all craters again.
+    Returns the weights of the craters in each sample (all copies together) of shape (B, N) and the number of iterations needed for each sample.
+
+    :param counts: number of copies of each of the N craters in B samples, shape (B, N)
+    :type counts: numpy array
+    :param X: positions of the N craters, shape (N, d)
+    :type X: numpy array
+    :param tolerance: gives the tolerance for the Kachiyan algorithm, defaults to 0.1
+    :type tolerance: float
+    :param candidates: crater indices of shape (B, H) and their mask (False for padding) of the only craters that can gain weight in each sample,
+        such as the hull craters from _hull_samples, defaults to None for all craters of the sample
+    :type candidates: tuple
+    '''
+    (B, N) = np.shape(counts)
+    d = np.shape(X)[1]
+    #V = Q diag(u) Q^T and the diagonal of Q^T V^-1 Q are both sums over the products of the lifted craters,
+    #kept as rows of length N so they are matrix products over the craters:
+    F, first, second, factor = _lifted_products(X)
+    size = counts.sum(axis=1, keepdims=True) #number of points of each sample
+    if candidates is None:
+        blocked = np.where(counts == 0, -np.inf, 0.0) #added to Q^T V^-1 Q so craters missing from a sample are never chosen
+    else:
+        indices, mask = candidates
+        G = np.moveaxis(F[:, indices], 0, 1) #products of the candidates of each sample, shape (B, K, H)
+        blocked = np.where(mask, 0.0, -np.inf)
+    #every step scales all weights by 1 - step_size and adds step_size to one point, so the weights of the first copies are kept as scale*w
+    #and only the weight of that copy is written:
+    u = np.empty((B, N))
+    w = np.broadcast_to(1.0 / size, blocked.shape).copy()
+    scale = np.ones(B)
+    V = np.matmul(counts / size, F.T) #upper triangle of V = Q diag(u) Q^T for the uniform starting weights
+    square = 1.0 / size[:, 0] #sum of the squared weights of all copies, for the size of the step
+    iterations = np.zeros(B, dtype=int)
+    active = np.arange(B) #samples not converged yet, the rows of w, blocked, G, V, scale and square are theirs
+    #the points of every sample must span all d dimensions, the inverse of a singular V is inf or NaN,
+    #as are the weights of nearly degenerate samples, their ellipses are dropped by BestFitEllipse:
+    with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+        while len(active):
+            rows = np.arange(len(active))
+            inverse = _symmetric_inverse(V, first, second)*factor
+            if candidates is None:
+                M = np.matmul(inverse, F) #diagonal of Q^T V^-1 Q
+            else:
+                M = np.matmul(inverse[:, None, :], G)[:, 0, :]
+            M += blocked
+            j = np.argmax(M, axis=1)
+            maximum = M[rows, j]
+            step_size = (maximum - d - 1.0) / ((d + 1.0) * (maximum - 1.0))
+            #the weights move by step_size*(e_j - u) and V by step_size*(q_j q_j^T - V):
+            u_j = scale*w[rows, j]
+            err = step_size*np.sqrt(np.maximum(square - 2*u_j + 1.0, 0.0))
+            square = (1.0 - step_size)**2*square + 2*step_size*(1.0 - step_size)*u_j + step_size**2
+            V = (1.0 - step_size[:, None])*V + step_size[:, None]*(F[:, j].T if candidates is None else G[rows, :, j])
+            scale = (1.0 - step_size)*scale
+            w[rows, j] += step_size/scale
+            iterations[active] += 1
+            moving = err > tolerance #NaN for degenerate samples, which stop
+            if not moving.all(): #converged samples keep their weights and leave the working arrays
+                done = active[~moving]
+                #the other copies of a crater still have the starting weight, scaled down:
+                if candidates is None:
+                    u[done] = scale[~moving, None]*(w[~moving] + (counts[done] - 1.0) / size[done])
+                else: #the padding keeps the starting weight and adds nothing
+                    u[done] = scale[~moving, None]*counts[done] / size[done]
+                    np.add.at(u, (done[:, None], indices[done]), scale[~moving, None]*(w[~moving] - 1.0 / size[done]))
+                    G = G[moving]
+                active, w, blocked, V, scale, square = active[moving], w[moving], blocked[moving], V[moving], scale[moving], square[moving]
+    return u, iterations
+
+def _mvee_batch(P, mask, tolerance=0.01):
+    '''
+    Minimum volume enclosing ellipse of a stack of samples using the Kachiyan algorithm with away steps (Todd and Yildirim),
+    which can also lower the weight of a point (down to zero) and converges much faster than the plain Kachiyan algorithm.
+    A sample is solved once no point is further than tolerance outside the ellipse and no point with weight is further than tolerance inside it,
+    measured relative to the d+1 of the lifted points, so the result is close to the true minimum volume ellipse.
+    Solved samples are dropped from the working arrays, so each iteration only works on the samples that still need it.
+    Returns the weights u of shape (B, N) and the number of iterations needed for each sample.
+
+    :param P: array of shape (B, N, d) of B samples of N points each, padded samples repeat one of their points
+    :type P: numpy array
+    :param mask: boolean array of shape (B, N), False for the padding of each sample
+    :type mask: numpy array
+    :param tolerance: tolerance of the optimality conditions, defaults to 0.01
+    :type tolerance: float
+    '''
+    (B, N, d) = np.shape(P)
+    Q = np.concatenate([P, np.ones((B, N, 1))], axis=2) #lifted points
+    QQ = (Q[:, :, :, None] * Q[:, :, None, :]).reshape(B, N, (d+1)**2)
+    u = mask / mask.sum(axis=1, keepdims=True)
+    result = np.empty((B, N))
+    iterations = np.zeros(B, dtype=int)
+    active = np.arange(B) #samples not solved yet, the rows of u, QQ and mask are theirs
+    with np.errstate(divide='ignore', invalid='ignore'):
+        while len(active):
+            rows = np.arange(len(active))
+            V = np.matmul(u[:, None, :], QQ).reshape(-1, d+1, d+1)
+            M = np.matmul(QQ, linalg.inv(V).reshape(-1, (d+1)**2, 1))[:, :, 0]
+            j = np.argmax(np.where(mask, M, -np.inf), axis=1) #point furthest outside, to add weight to
+            k = np.argmin(np.where(u > 0, M, np.inf), axis=1) #point with weight furthest inside, to take weight from
+            M_j = M[rows, j]
+            M_k = M[rows, k]
+            outside = M_j/(d + 1.0) - 1.0
+            inside = 1.0 - M_k/(d + 1.0)
+            moving = np.maximum(outside, inside) > tolerance #NaN for degenerate samples, which stop
+            if not moving.all(): #solved samples keep their weights and leave the working arrays
+                result[active[~moving]] = u[~moving]
+                active, u, QQ, mask, rows = active[moving], u[moving], QQ[moving], mask[moving], rows[:moving.sum()]
+                j, k, M_j, M_k, outside, inside = j[moving], k[moving], M_j[moving], M_k[moving], outside[moving], inside[moving]
+                if not len(active):
+                    break
+            forward = outside >= inside
+            step_size = (M_j - d - 1.0) / ((d + 1.0) * (M_j - 1.0))
+            u_k = u[rows, k]
+            away_size = np.minimum((d + 1.0 - M_k) / ((d + 1.0) * (M_k - 1.0)), u_k / (1.0 - u_k)) #at most down to zero weight
+            u = np.where(forward[:, None], (1.0 - step_size[:, None]) * u, (1.0 + away_size[:, None]) * u)
+            u[rows, j] += np.where(forward, step_size, 0)
+            u[rows, k] = np.where(forward, u[rows, k], np.where(away_size < u_k / (1.0 - u_k), u[rows, k] - away_size, 0))
+            iterations[active] += 1
+    return result, iterations
+
+def _hull_order(coord_array, directions = 16):
+    #projections of all craters on 2*directions evenly spaced directions, sorted from the outermost crater inwards
+    angles = np.arange(2*directions) * np.pi / directions
+    units = np.stack([np.cos(angles), np.sin(angles)])
+    order = np.argsort(-(coord_array @ units), axis=0, kind='stable')
+    projections = np.take_along_axis(coord_array @ units, order, axis=0)
+    return units, order, projections
+
+def _hull_samples(coord_array, samples, hull_order):
+    '''
+    Reduces each bootstrap sample to the craters on its convex hull, as the minimum volume enclosing ellipse only depends on those.
+    The extreme craters of a sample in the even directions of hull_order (see _hull_order) span a polygon inside its hull,
+    a crater of the sample outside this polygon lies between two neighbouring extreme craters and projects further along the odd direction between them than one of the two.
+    These few craters are found from the sorted projections without looking at the others, their hull is then found with scipy.
+    Returns the crater indices of shape (B, H), samples with fewer hull points are padded with their first one, and the mask of the hull points,
+    which is empty for samples of craters on one line.
+
+    :param coord_array: coordinates of all craters, shape (N, 2)
+    :type coord_array: numpy array
+    :param samples: crater indices of B bootstrap samples, shape (B, N)
+    :type samples: numpy array
+    :param hull_order: directions, order and sorted projections of the craters as given by _hull_order
+    :type hull_order: tuple
+    '''
+    from scipy.spatial import ConvexHull, QhullError #loaded on first use, only needed for the hull method
+    units, order, projections = hull_order
+    (B, N) = np.shape(samples)
+    present = np.zeros((B, len(coord_array)), dtype=bool)
+    present[np.arange(B)[:, None], samples] = True
+    #extreme crater of each sample in each even direction, the first crater of the sample along the sorted projections:
+    extremes = []
+    for k in range(0, order.shape[1], 2):
+        head = present[:, order[:64, k]] #the extreme crater is almost always among the outermost ones
+        first = np.argmax(head, axis=1)
+        missing = ~head.any(axis=1)
+        if missing.any():
+            first[missing] = np.argmax(present[missing][:, order[:, k]], axis=1)
+        extremes.append(order[first, k])
+    extremes = np.stack(extremes, axis=1) #shape (B, directions), counterclockwise
+    #craters of each sample projecting at least as far as one of the two neighbouring extreme craters along each odd direction:
+    corner_projections = coord_array[extremes] @ units[:, 1::2] #shape (B, directions, directions)
+    k = np.arange(extremes.shape[1])
+    thresholds = np.minimum(corner_projections[:, k, k], corner_projections[:, (k + 1) % len(k), k])
+    candidate = np.zeros_like(present)
+    candidate[np.arange(B)[:, None], extremes] = True
+    for j in k:
+        counts = np.searchsorted(-projections[:, 2*j + 1], -thresholds[:, j], side='right')
+        candidate[:, order[:counts.max(), 2*j + 1]] |= np.arange(counts.max()) < counts[:, None]
+    candidate &= present
+    hulls = []
+    for b in range(B):
+        candidates = candidate[b].nonzero()[0]
+        try:
+            candidates = candidates[ConvexHull(coord_array[candidates]).vertices]
+        except (QhullError, ValueError): #all craters on one line, the sample has no enclosing ellipse
+            candidates = candidates[:0]
+        hulls.append(candidates)
+    H = max(max(len(hull) for hull in hulls), 1)
+    indices = np.zeros((B, H), dtype=int)
+    mask = np.zeros((B, H), dtype=bool)
+    for b, hull in enumerate(hulls):
+        if len(hull):
+            indices[b, :len(hull)] = hull
+            indices[b, len(hull):] = hull[0]
+            mask[b, :len(hull)] = True
+    return indices, mask
+
+def BestFitEllipse(ClusterData, tolerance=None, lat = 'x_coord', lon = 'y_coord', n_bootstrap = 301, rng = None, batch_size = None, info = None,
+                   method = 'khachiyan', stop_tolerance = None, min_bootstrap = 50, hull_above = 100000):
     '''
     adapted from Michael Imelfort at https://github.com/minillinim/ellipsoid/blob/master/ellipsoid.py
     This function will calculate the radii, centre point and rotation of the best fitting Ellipse around the cluster from a pandas dataframe.
-    It is using a Bootstrap of 300 iterations to minimise the impact outliers have on the final Ellipse and the Kachiyan algorithm to find the minimum volume Ellipse for each sample.
+    It is using a Bootstrap of 301 iterations to minimise the impact outliers have on the final Ellipse and the Kachiyan algorithm to find the minimum volume Ellipse for each sample.
+    All bootstrap samples are solved together as stacked arrays, degenerate samples (all craters on one line) are left out of the average.
+    The 'hull' method only looks for the crater gaining weight among the craters on the convex hull of each sample (see _khachiyan_batch) and gives the same ellipse,
+    but finding the hulls costs more than it saves for clusters of up to hull_above craters, which are solved on all their craters.
+    With a stop_tolerance the bootstrap stops early once the mean radii and rotation have settled, the number of samples used is added to info.
     This method works for clusters larger than 5 craters.
 
     :param ClusterData: Dataframe containing all craters in clusters
     :type ClusterData: pandas dataframe
-    :param tolerance: gives the tolerance for the Kachiyan algorithm, defaults to 0.1
+    :param tolerance: gives the tolerance for the Kachiyan algorithm, defaults to None for 0.1
     :type tolerance: float
     :param x: column name giving the longitude, defaults to 'x_coord'
     :type x: str
     :param y: column name giving the latitude, defaults to 'y_coord'
     :type y: str
+    :param n_bootstrap: number of bootstrap samples, or the largest number with a stop_tolerance, defaults to 301
+    :type n_bootstrap: int
+    :param rng: random generator or seed for the bootstrap samples, defaults to None for a fresh generator
+    :type rng: numpy.random.Generator or int
+    :param batch_size: number of bootstrap samples solved at once, defaults to an automatic size
+    :type batch_size: int
+    :param info: dictionary to add the number of samples used and the Kachiyan iteration counts (mean, max, total) to, defaults to None
+    :type info: dict
+    :param method: 'khachiyan' to solve each sample on all its craters, 'hull' to solve it on the craters of its convex hull, defaults to 'khachiyan'
+    :type method: str
+    :param stop_tolerance: stop once the standard errors of the mean radii are below stop_tolerance times the radii
+        and those of the mean rotation matrix below stop_tolerance (about the error of the angle in radians), defaults to None to use all n_bootstrap samples
+    :type stop_tolerance: float
+    :param min_bootstrap: smallest number of samples used with a stop_tolerance, defaults to 50
+    :type min_bootstrap: int
+    :param hull_above: the 'hull' method is only used for clusters of more craters than this, defaults to 100000
+    :type hull_above: int
     '''
 #Output:radii, rotation and centre of ellipse
-    df = ClusterData.copy() #creating a workable copy of the data
-    coord_array = np.array(df[[lat, lon]]) #create array of coordinates
-    #iterating over the coordinates to find best fitting ellipse
-    #using a Bootstrap (300 iterations) to minimise impact of outliers
-    counter = 0 #counter for the Bootstrap Samples
-    #setting up lists for results of samples for average ellipse later:
-    Rminor = []
-    Rmajor = []
-    rotation = []
-    centrex = []
-    centrey = []
-    rot1 = []
-    rot2 = []
-    rot3 = []
-    rot4 = []
-    while counter <= 300:
-            P = np.array(random.choices(coord_array, k = len(coord_array))) #choosing the sample for current iteration
-            counter +=1
-            #running the Kachiyan Algorithm over the sample:
-            (N, d) = np.shape(P)
-            d = float(d)
-
-            # Creating a working array
-            Q = np.vstack([np.copy(P.T), np.ones(N)])
-            QT = Q.T
-
-            # initializations
-            err = 1.0 + tolerance
-            u = (1.0 / N) * np.ones(N)
-
-            # Khachiyan Algorithm
-            while err > tolerance:
-                V = np.dot(Q, np.dot(np.diag(u), QT))
-                M = np.diag(np.dot(QT , np.dot(linalg.inv(V), Q)))    # M the diagonal vector of an NxN matrix
-                j = np.argmax(M)
-                maximum = M[j]
-                step_size = (maximum - d - 1.0) / ((d + 1.0) * (maximum - 1.0))
-                new_u = (1.0 - step_size) * u
-                new_u[j] += step_size
-                err = np.linalg.norm(new_u - u)
-                u = new_u
-
-            # center of the ellipse
-            center = np.dot(P.T, u)
-            centrex.append(center[0])
-            centrey.append(center[1])
-            # the A matrix for the ellipse
-            A = linalg.inv(
-                           np.dot(P.T, np.dot(np.diag(u), P)) -
-                           np.array([[a * b for b in center] for a in center])
-                           ) / d
-
-            # Get radii and rotation matrix
-            U, s, rotation = linalg.svd(A)
-            radii = 1.0/np.sqrt(s)
-            Rminor.append(radii[0])
-            Rmajor.append(radii[1])
-            rot1.append(rotation[0,0]) #mapping the rotation output to the right place to create a standard rotation matrix [0,1] [1,1] [0,0] [1,0]
-            rot2.append(rotation[0,1])
-            rot3.append(rotation[1,1])
-            rot4.append(rotation[1,0])
-            av_rot1 = np.mean(rot1)
-            av_rot2 = np.mean(rot2)
-            av_rot3 = np.mean(rot3)
-            av_rot4 = np.mean(rot4)
-    #calculate mean of parameters to find average best fit ellipse:
-    av_center = np.array([np.mean(centrex), np.mean(centrey)])
-    av_radii = np.array([np.mean(Rminor), np.mean(Rmajor)])
-    av_rotation = np.array([[av_rot1, av_rot2], [av_rot3, av_rot4]])
+    if method not in ('khachiyan', 'hull'):
+        raise ValueError("method must be 'khachiyan' or 'hull'")
+    if tolerance is None:
+        tolerance = 0.1
+    rng = np.random.default_rng(rng)
+    coord_array = np.asarray(ClusterData[[lat, lon]], dtype=float) #create array of coordinates
+    (N, d) = np.shape(coord_array)
+    if batch_size is None:
+        batch_size = max(1, 2**19 // N)
+        if stop_tolerance is not None:
+            batch_size = min(batch_size, 25) #checking the convergence every 25 samples
+    #using a Bootstrap to minimise impact of outliers, choosing all samples at once:
+    samples = rng.integers(0, N, size=(n_bootstrap, N))
+    #samples with fewer distinct craters than d+1 have no enclosing ellipse and are skipped,
+    #found by looking for a crater different from the first d distinct ones of each sample:
+    rows = np.arange(n_bootstrap)
+    other = np.ones(samples.shape, dtype=bool)
+    enough = np.ones(n_bootstrap, dtype=bool)
+    for i in range(d + 1):
+        enough &= other.any(axis=1)
+        if i < d:
+            other &= samples != samples[rows, np.argmax(other, axis=1)][:, None]
+    samples = samples[enough]
+    n_bootstrap = len(samples)
+    #the craters relative to their mean keep the moments of the samples well conditioned for clusters far from the origin:
+    origin = coord_array.mean(axis=0)
+    X = coord_array - origin
+    F, first, second = _lifted_products(X)[:3]
+    centres = []
+    radii = []
+    rotations = []
+    iteration_counts = []
+    hull_points = []
+    converged = False
+    hull = method == 'hull' and N > hull_above
+    if hull:
+        hull_order = _hull_order(X)
+    for start in range(0, n_bootstrap, batch_size):
+        batch = samples[start:start + batch_size]
+        rows = np.arange(len(batch))[:, None]
+        #number of copies of each crater in the samples of the current batch:
+        counts = np.bincount((rows*N + batch).ravel(), minlength=batch.size).reshape(batch.shape).astype(float)
+        #dropping samples of collinear craters, which have no enclosing ellipse:
+        scatter = _weighted_scatter(counts / N, F, first, second)[1]
+        spanning = _determinant(scatter) > 1e-12*(np.trace(scatter, axis1=1, axis2=2)/d)**d
+        batch, counts = batch[spanning], counts[spanning]
+        candidates = None
+        if hull:
+            indices, mask = _hull_samples(X, batch, hull_order)
+            solvable = mask.any(axis=1) #dropping samples scipy finds no hull for
+            counts, candidates = counts[solvable], (indices[solvable], mask[solvable])
+            hull_points.append(candidates[1].sum(axis=1))
+        if not len(counts):
+            continue
+        #running the Kachiyan Algorithm over all samples of the batch:
+        u, iterations = _khachiyan_batch(counts, X, tolerance, candidates)
+        iteration_counts.append(iterations)
+        # center of the ellipses and the A matrices for the ellipses, the inverse of the weighted scatter of the craters about the center
+        center, scatter = _weighted_scatter(u, F, first, second)
+        if d == 2: #closed form, much faster than linalg.inv for many small matrices
+            A = np.stack([scatter[:, 1, 1], -scatter[:, 0, 1], -scatter[:, 1, 0], scatter[:, 0, 0]], axis=1).reshape(-1, 2, 2)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                A /= d*_determinant(scatter)[:, None, None]
+        else:
+            A = linalg.inv(scatter) / d
+        valid = np.isfinite(A).all(axis=(1, 2)) #dropping samples of collinear craters
+        center = center[valid]
+        # Get radii and rotation matrices
+        U, s, rotation = linalg.svd(A[valid])
+        centres.append(center + origin)
+        radii.append(1.0/np.sqrt(s))
+        rotations.append(rotation)
+        if stop_tolerance is not None and start + batch_size >= min_bootstrap:
+            all_radii = np.concatenate(radii)
+            all_rotations = np.concatenate(rotations)
+            n = len(all_radii)
+            if n > 1 and (all_radii.std(axis=0) <= stop_tolerance*np.sqrt(n)*all_radii.mean(axis=0)).all() and \
+                    (all_rotations.std(axis=0) <= stop_tolerance*np.sqrt(n)).all():
+                converged = True
+                break
+    if not centres:
+        raise linalg.LinAlgError('all bootstrap samples are collinear')
+    if info is not None:
+        iteration_counts = np.concatenate(iteration_counts)
+        info.update({'samples': len(iteration_counts), 'mean_iterations': float(iteration_counts.mean()),
+                     'max_iterations': int(iteration_counts.max()), 'total_iterations': int(iteration_counts.sum())})
+        if hull:
+            info['mean_hull_points'] = float(np.concatenate(hull_points).mean())
+        if stop_tolerance is not None:
+            info['converged'] = converged
+    return _average_ellipse(np.concatenate(centres), np.concatenate(radii), np.concatenate(rotations))
+
+def _average_ellipse(centres, radii, rotations):
+    #average best fit ellipse of the bootstrap samples, returns the centre, radii, rotation matrix and angle
+    av_center = centres.mean(axis=0)
+    av_radii = radii.mean(axis=0)
+    av_rot = rotations.mean(axis=0)
+    #mapping the rotation output to the right place to create a standard rotation matrix [0,1] [1,1] [0,0] [1,0]
+    av_rotation = np.array([[av_rot[0,0], av_rot[0,1]], [av_rot[1,1], av_rot[1,0]]])
     #converting the rotation matrix to angle:
     if av_rotation[1,0] > 0:
         alpha = mt.acos(av_rotation[0,0]) *(180/np.pi)
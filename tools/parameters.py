@@ -1,12 +1,18 @@
-import functions as ct
+import sys
+import os
+if __package__ in (None, ''):
+    #run as a script (python tools/parameters.py), the modules are imported from the tools package
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    __package__ = 'tools'
+from . import functions as ct
+from .store import ExcelStore, open_store
+from .cache import ResultCache, seeded
+from .runlog import RunTimer, writeRunLog
+from .stream import iter_clusters, cluster_data
+from .cluster import Cluster
 import pandas as pd
-import matplotlib.pyplot as plt
-import matplotlib as mp
-from matplotlib.patches import Ellipse
 import numpy as np
-import math as mt
-import sys
-import argparse
+from collections import deque
 '''
 This program will calculate the main parameters for a Crater Cluster and add them to an excel spread sheet.
 It will also add the list of craters in a cluster to a main sheet of all measured clusters.
@@ -18,10 +24,14 @@ def vprint(output, verb):
     if verb == True:
         print(output)
 def getParameters():
+    import argparse
     parser = argparse.ArgumentParser(prog = 'ClusterParameters', description='Calculate Cluster Parameters and save data to main list and parameter sheet')
     parser.add_argument('-v' , '--verbose',action = 'store_true',help = 'will print the outputs and plot the cluster')
     parser.add_argument('-s' , '--save', action = 'store_true', help = 'will save the outputs to log files')
-    parser.add_argument('Path',type = str, help = 'Excel Sheet of raw Cluster Data, named after the HiRiseID of image')
+    parser.add_argument('--store', default = None, help = 'SQLite file (.sqlite/.db) to read the cluster from (if Path is not a file) and add it to instead of the excel sheets')
+    parser.add_argument('--runlog', default = None, help = 'json lines file to append the time of each stage to')
+    parser.add_argument('--index', default = None, help = 'spatial index file of the parameter sheet to add the cluster to, built from the sheet if it does not exist')
+    parser.add_argument('Path',type = str, help = 'Excel Sheet of raw Cluster Data, named after the HiRiseID of image, or with --store the HiRiseID of a cluster in the store')
     parser.add_argument('latitude', type= float, help = 'central latitude of image')
     parser.add_argument('longitude', type = float, help = 'central longitude of image')
 
@@ -31,25 +41,80 @@ def getParameters():
     lonc = args.longitude
     verb = args.verbose
     save = args.save
+    latc, lonc = checkCentre(latc, lonc)
+    store = None if args.store is None else open_store(args.store)
+    return cluster_file, latc, lonc, verb, save, store, args.runlog, args.index
+
+def checkCentre(latc, lonc):
+    """
+    Checks the central lat/lon of an image and moves the longitude to the range -180 to 180.
 
-    #checking the central lat/long:
+    :param latc: central latitude of image
+    :type latc: float
+    :param lonc: central longitude of image
+    :type lonc: float
+    """
     if latc > 180 or latc < -180:
         raise ValueError('central latitude is outside allowed range')
     if lonc > 180:
         lonc = lonc -360
     elif lonc >360:
         raise ValueError('central longitude is outside allowed range')
-    return cluster_file, latc, lonc, verb, save
+    return latc, lonc
+
+def getBatchParameters(argv = None):
+    """
+    Reads the arguments of the batch subcommand: 'ClusterParameters batch [-options] Manifest'.
+    """
+    import argparse
+    parser = argparse.ArgumentParser(prog = 'ClusterParameters batch', description='Calculate Cluster Parameters of all clusters in a manifest and save them to main list and parameter sheet')
+    parser.add_argument('-j', '--workers', type = int, default = os.cpu_count(), help = 'number of worker processes, defaults to the number of CPUs')
+    parser.add_argument('--main-list', default = 'DataTables/Testlist.xlsx', help = 'main list of all craters to add the clusters to')
+    parser.add_argument('--parameters-list', default = 'DataTables/TestParameters.xlsx', help = 'parameter sheet to add the clusters to')
+    parser.add_argument('--store', default = None, help = 'SQLite file (.sqlite/.db) to add the clusters to instead of the excel sheets')
+    parser.add_argument('--seed', type = int, default = None, help = 'seed of the bootstrap of the best fit ellipse, needed for --cache')
+    parser.add_argument('--cache', default = None, help = 'cache directory, clusters with unchanged data and parameters are not measured again')
+    parser.add_argument('--runlog', default = None, help = 'json lines file to append the time of each stage of each cluster to')
+    parser.add_argument('--index', default = None, help = 'spatial index file of the parameter sheet to add the clusters to, built from the sheet if it does not exist')
+    parser.add_argument('--catalog', default = None, help = 'csv or parquet crater catalog indexed by HiRiseID and crater_no to measure one cluster at a time instead of a manifest')
+    parser.add_argument('--centres', default = None, help = 'csv or excel table with the columns HiRise_ID, central_latitude, central_longitude for --catalog, defaults to the mean coordinates of each cluster')
+    parser.add_argument('--dispersion', choices = ['exact', 'sampled', 'auto'], default = 'exact', help = 'exact dispersion over all crater pairs, sampled pairs with a confidence interval, or auto: exact below --exact-below craters')
+    parser.add_argument('--exact-below', type = int, default = 2000, help = 'number of craters below which --dispersion auto is exact, defaults to 2000')
+    parser.add_argument('--ellipse', choices = ['khachiyan', 'hull'], default = 'khachiyan', help = 'best fit ellipse solved on all craters of each bootstrap sample (khachiyan) or only on the craters of its convex hull (hull, the same ellipse, used for clusters of more than 100000 craters)')
+    parser.add_argument('--stop-tolerance', type = float, default = None, help = 'stop the bootstrap once the mean radii and rotation are known to this relative standard error, i.e. 0.01, defaults to all samples')
+    parser.add_argument('Manifest', type = str, nargs = '?', help = 'csv file with the columns path, latitude, longitude for each cluster')
+    args = parser.parse_args(argv)
+    if (args.Manifest is None) == (args.catalog is None):
+        parser.error('give either a Manifest or a --catalog')
+    centres = None
+    if args.centres is not None:
+        centres = pd.read_csv(args.centres) if args.centres.endswith('.csv') else pd.read_excel(args.centres)
+    if args.cache is not None and args.seed is None:
+        parser.error('--cache needs a --seed, results of random bootstraps are not cached')
+    if args.store is None:
+        store = ExcelStore(args.main_list, args.parameters_list)
+    else:
+        store = open_store(args.store, args.parameters_list)
+    return (args.Manifest, args.workers, store, args.seed, args.cache, args.runlog, args.catalog, centres, args.dispersion, args.exact_below,
+            args.ellipse, args.stop_tolerance, args.index)
 
-def readClusterFile(cluster_file):
+def readClusterFile(cluster_file, store = None):
     """
     Reads in the cluster file and finds the HiRise Observation ID for the cluster.
     It assumes that the file is named after the HiRise Observation ID
+    If a store is given and cluster_file is not a file, the cluster is loaded from the store instead, with cluster_file giving its HiRise ID.
 
-    :param cluster_file: path to the cluster data, file named after the HiRise ID
+    :param cluster_file: path to the cluster data, file named after the HiRise ID, or the HiRise ID of a cluster in the store
     :type cluster_file: str
+    :param store: store (see store.py) to load the cluster from, defaults to None
+    :type store: ExcelStore or SQLiteStore
 
     """
+    if store is not None and not os.path.isfile(cluster_file):
+        ClusterData = cluster_data(store.read_craters(HiRiseIDs = [cluster_file]))
+        if ClusterData.empty:
+            raise KeyError('no cluster ' + cluster_file + ' in store')
+        return ClusterData, cluster_file
     if cluster_file.endswith('.xls') or cluster_file.endswith('.xlsx'):
         ClusterData = pd.read_excel(cluster_file) #creating the dataframe for the cluster
     elif cluster_file.endswith('.csv'):
@@ -63,7 +128,8 @@ def readClusterFile(cluster_file):
     print(input_list)
     HiRiseID = input_list[-1]
     return ClusterData, HiRiseID
-def measureCluster(ClusterData, HiRiseID, latc, lonc,verb = False, save = False):
+def measureCluster(ClusterData, HiRiseID, latc, lonc,verb = False, save = False, tolerance = None, n_bootstrap = 301, rng = None, cache = None, timer = None, dispersion_mode = 'exact', exact_below = 2000,
+                   ellipse_method = 'khachiyan', stop_tolerance = None):
     """
     This function will measure the relevant parameters and if the verbose or save option is turned on plot the cluster and its best fit ellipse.
 
@@ -79,16 +145,52 @@ def measureCluster(ClusterData, HiRiseID, latc, lonc,verb = False, save = False)
     :type verb: bool
     :param save: turns the saving function on to save plot of cluster and parameters to log files, defaults to False
     :type save: bool
+    :param tolerance: gives the tolerance for the Kachiyan algorithm of the best fit ellipse, defaults to None for 0.1
+    :type tolerance: float
+    :param n_bootstrap: number of bootstrap samples for the best fit ellipse, defaults to 301
+    :type n_bootstrap: int
+    :param rng: random generator or seed for the bootstrap samples, defaults to None
+    :type rng: numpy.random.Generator or int
+    :param cache: cache (see cache.py) to reuse results of unchanged clusters, only used with an integer seed as rng and without verbose or save, defaults to None
+    :type cache: ResultCache
+    :param timer: timer (see runlog.py) to record the time of each stage and the Kachiyan iteration counts in, defaults to None
+    :type timer: RunTimer
+    :param dispersion_mode: 'exact', 'sampled' or 'auto' (see functions.dispersion_auto), the mode used is saved as Dispersion_mode, defaults to 'exact'
+    :type dispersion_mode: str
+    :param exact_below: number of craters below which the 'auto' mode calculates the dispersion exactly, defaults to 2000
+    :type exact_below: int
+    :param ellipse_method: 'khachiyan' or 'hull' (see functions.BestFitEllipse), defaults to 'khachiyan'
+    :type ellipse_method: str
+    :param stop_tolerance: stops the bootstrap of the best fit ellipse early once the mean radii and rotation have settled, the number of samples used is saved as Bootstrap_samples, defaults to None
+    :type stop_tolerance: float
     """
+    if timer is None:
+        timer = RunTimer(HiRiseID)
     #Number of craters in cluster:
     crater_no = len(ClusterData.index)
-    ClusterData['Diam_m'] = ClusterData['Diam_km'].apply(lambda x: round(x*1000, 2) ) #converting diameter to meters and rounding
+    timer.note(Number_Craters = crater_no)
+    with timer.stage('unit_conversion'):
+        ClusterData['Diam_m'] = (ClusterData['Diam_km']*1000).round(2) #converting diameter to meters and rounding
+        cluster = Cluster.from_frame(ClusterData, latc, lonc, HiRiseID) #arrays of the craters used for all parameters
+
+    #Looking up unchanged clusters in the cache:
+    key = None
+    if cache is not None and not (verb or save) and seeded(rng):
+        with timer.stage('cache'):
+            key = cache.key('measureCluster', ClusterData[['x_coord', 'y_coord', 'Diam_km']], HiRiseID, latc, lonc, tolerance, n_bootstrap, rng, dispersion_mode, exact_below,
+                            ellipse_method, stop_tolerance)
+            cached = cache.get(key)
+        timer.note(cached = cached is not None)
+        if cached is not None:
+            return cached
 
     #Calculating effective diameter:
-    d_effective = ct.d_eff(ClusterData)
+    with timer.stage('d_eff'):
+        d_effective = ct.d_eff(cluster)
     vprint('effective diameter: ' + d_effective.astype(str), verb)
     #Finding largest crater, number of craters larger than D/2 and F value:
-    largest, N, F = ct.F_value(ClusterData)
+    with timer.stage('F_value'):
+        largest, N, F = ct.F_value(cluster)
     vprint('largest crater: ' + largest.astype(str), verb)
     vprint('N > D/2: ' + str(N), verb)
     vprint('F value: '+ str(F), verb)
@@ -98,97 +200,360 @@ def measureCluster(ClusterData, HiRiseID, latc, lonc,verb = False, save = False)
      'F_value': F, 'central_latitude': latc, 'central_longitude': lonc}
     #Calculating dispersion:
     if crater_no >3:
-        disp, sep_array = ct.dispersion(ClusterData)
-        vprint('dispersion: '+ disp.astype(str), verb)
+        with timer.stage('dispersion'):
+            disp, low, high, mode = ct.dispersion_auto(cluster, mode = dispersion_mode, exact_below = exact_below, rng = rng)
+        timer.note(dispersion_mode = mode)
+        vprint('dispersion: '+ disp.astype(str) + ('' if mode == 'exact' else ' (sampled, 95% interval ' + str(low) + ' to ' + str(high) + ')'), verb)
         new_cluster['Dispersion'] = disp #adding to dicitonary
+        new_cluster['Dispersion_mode'] = mode #exact or sampled
+        if mode == 'sampled':
+            new_cluster['Dispersion_low'] = low
+            new_cluster['Dispersion_high'] = high
 
     #Converting from degrees to metres for best fit ellipse calculations and plotting:
-    Rmars = 3390000 #radius of Mars in metres
-    ClusterData_copy = ClusterData.copy() #do conversion on a copy to avoid overwriting original coordinates
-    ClusterData_copy['x_coord'] = ClusterData_copy['x_coord'].apply(lambda a:(a - latc)*Rmars*(np.pi/180)) #converting coordinates from degrees to metres
-    ClusterData_copy['y_coord'] = ClusterData_copy['y_coord'].apply(lambda a:(a - lonc)*Rmars*(np.pi/180)*mt.sin(mt.radians(90 - a)))
+    with timer.stage('unit_conversion'):
+        ClusterData_copy = cluster.projected() #converted coordinates are kept apart from the original ones
 
     #Calclulating best Fit ellipse:
     if crater_no > 5:
-        centre , radii, rotation_matrix, rotation_angle = ct.BestFitEllipse(ClusterData_copy)
+        khachiyan = {'method': ellipse_method}
+        with timer.stage('ellipse'):
+            centre , radii, rotation_matrix, rotation_angle = ct.BestFitEllipse(ClusterData_copy, tolerance, n_bootstrap = n_bootstrap, rng = rng, info = khachiyan,
+                                                                                method = ellipse_method, stop_tolerance = stop_tolerance)
+        timer.note(khachiyan = khachiyan)
         new_cluster['R1'] = radii[0]
         new_cluster['R2'] = radii[1]
+        #centre (in metres from the central coordinates) and angle of the ellipse, so plots can draw it without fitting it again:
+        new_cluster['Ellipse_x'] = centre[0]
+        new_cluster['Ellipse_y'] = centre[1]
+        new_cluster['Ellipse_angle'] = rotation_angle
+        if stop_tolerance is not None:
+            vprint('bootstrap samples: ' + str(khachiyan['samples']), verb)
+            new_cluster['Bootstrap_samples'] = khachiyan['samples']
     if verb or save == True:
-        #Starting the Plot:
-        fig = plt.figure(figsize=(8, 6))
-        ax = fig.add_subplot(111, aspect = 'equal')
-        ax.scatter(ClusterData_copy['x_coord'], ClusterData_copy['y_coord'],marker = '.', color = 'k') #plotting crater locations using the converted coordinates
-        ax.set_title('Cluster of ' + HiRiseID)
-        #Calculating bestFit ellipse and plotting the Cluster:
-        if crater_no <=5:
-            ax.scatter(ClusterData_copy['x_coord'], ClusterData_copy['y_coord'], color = 'k', marker = '.') #plotting crater locations
+        with timer.stage('plotting'):
+            #matplotlib is only loaded when plotting, measuring does not need it:
+            import matplotlib.pyplot as plt
+            from matplotlib.patches import Ellipse
+            #Starting the Plot:
+            fig = plt.figure(figsize=(8, 6))
+            ax = fig.add_subplot(111, aspect = 'equal')
+            ax.scatter(ClusterData_copy['x_coord'], ClusterData_copy['y_coord'],marker = '.', color = 'k') #plotting crater locations using the converted coordinates
             ax.set_title('Cluster of ' + HiRiseID)
+            #Calculating bestFit ellipse and plotting the Cluster:
+            if crater_no <=5:
+                ax.scatter(ClusterData_copy['x_coord'], ClusterData_copy['y_coord'], color = 'k', marker = '.') #plotting crater locations
+                ax.set_title('Cluster of ' + HiRiseID)
 
-        else: #Still need to add ellipse plot!
-            ellipse1 = Ellipse(centre, 2*radii[0], 2*radii[1], rotation_angle, fill = False, color = 'r')
-            ellipse2 = Ellipse(centre, 2*radii[1], 2*radii[0], rotation_angle, fill = False, color = 'y') #plotting both possible ellipse orientations
-            #fig, ax = ct.plotellipse(centre, radii, rotation_matrix)
-            ax.add_patch(ellipse1)
-            ax.add_patch(ellipse2)
-            new_cluster['R1'] = radii[0] #adding to the dictionary
-            new_cluster['R2'] = radii[1]
+            else: #Still need to add ellipse plot!
+                ellipse1 = Ellipse(centre, 2*radii[0], 2*radii[1], angle = rotation_angle, fill = False, color = 'r')
+                ellipse2 = Ellipse(centre, 2*radii[1], 2*radii[0], angle = rotation_angle, fill = False, color = 'y') #plotting both possible ellipse orientations
+                #fig, ax = ct.plotellipse(centre, radii, rotation_matrix)
+                ax.add_patch(ellipse1)
+                ax.add_patch(ellipse2)
+                new_cluster['R1'] = radii[0] #adding to the dictionary
+                new_cluster['R2'] = radii[1]
 
         if verb == True:
             plt.show()
         else:
-            plt.savefig('plotlog.png')
+            with timer.stage('plotting'):
+                plt.savefig('plotlog.png')
 
     if save == True:
-        file = open('log.txt', 'w')
-        file.write(HiRiseID + '\n')
-        writtenlarge ='largest Diameter:'+ str(largest) +'\n'
-        file.write(writtenlarge)
-        writteneff = 'effective Diameter:' + str(d_effective)+'\n'
-        file.write(writteneff)
-        writtenF = 'F value:' + str(F)+'\n'
-        file.write(writtenF)
-        writtenN = 'N > D/2:' +str(N)+'\n'
-        file.write(writtenN)
-        if crater_no >3:
-            writtendisp = 'Dispersion(m):' +str(disp)+'\n'
-            file.write(writtendisp)
-        if crater_no >5:
-            writtenR = 'Radii of best fit Ellipse:' +str(radii[0]) +' ' +str(radii[1])
-            file.write(writtenR)
+        with timer.stage('write'):
+            file = open('log.txt', 'w')
+            file.write(HiRiseID + '\n')
+            writtenlarge ='largest Diameter:'+ str(largest) +'\n'
+            file.write(writtenlarge)
+            writteneff = 'effective Diameter:' + str(d_effective)+'\n'
+            file.write(writteneff)
+            writtenF = 'F value:' + str(F)+'\n'
+            file.write(writtenF)
+            writtenN = 'N > D/2:' +str(N)+'\n'
+            file.write(writtenN)
+            if crater_no >3:
+                writtendisp = 'Dispersion(m):' +str(disp)+'\n'
+                file.write(writtendisp)
+            if crater_no >5:
+                writtenR = 'Radii of best fit Ellipse:' +str(radii[0]) +' ' +str(radii[1])
+                file.write(writtenR)
+            file.close()
+    if key is not None:
+        cache.set(key, new_cluster)
     return new_cluster
-def writeClusterAttributes(HiRiseID, ClusterData, new_cluster, main_list = 'DataTables/Testlist.xlsx', parameters_list = 'DataTables/TestParameters.xlsx'):
-    #Adding the new Cluster to existing Main sheet and data to data sheet:
+def formatClusterData(HiRiseID, ClusterData):
+    """
+    Formats the craters of a cluster for the main list, indexed by (HiRiseID, crater_no) and without unnecessary columns.
+
+    :param HiRiseID: HiRise Observation ID of the cluster
+    :type HiRiseID: str
+    :param ClusterData: dataframe containing all craters of a cluster
+    :type ClusterData: pandas dataframe
+    """
     df_new = ClusterData.copy() #create copy to format
     #creating Multiindex and formatting to important data only
     df_new.drop(['Diam_km', 'FID', 'tag', 'D_cubed'], axis = 1, inplace=True, errors= 'ignore') #dropping unnecessary data
     df_new['HiRiseID'] = HiRiseID #adding HiRise ID to all craters
     df_new.set_index(['HiRiseID', 'crater_no'], inplace = True) #create the Multiindex
-    #saving the Multiindex in the same file for further use:
-    df_new.to_excel('DataTables/' + HiRiseID + 'formatted.xlsx')
-    df_main = pd.read_excel(main_list, index_col=[0, 1])
-    main = pd.concat([df_main, df_new])
-    main.to_excel(main_list) #saving the new version
+    return df_new
+
+def writeClusterTables(formatted_clusters, new_clusters, main_list = 'DataTables/Testlist.xlsx', parameters_list = 'DataTables/TestParameters.xlsx', store = None, index = None):
+    """
+    Adds any number of clusters to the main list and the parameter sheet, reading and writing each table once.
 
+    :param formatted_clusters: craters of each cluster as given by formatClusterData
+    :type formatted_clusters: list of pandas dataframes
+    :param new_clusters: parameters of each cluster as given by measureCluster
+    :type new_clusters: list of dict
+    :param main_list: path to the main list of all craters, defaults to 'DataTables/Testlist.xlsx'
+    :type main_list: str
+    :param parameters_list: path to the parameter sheet, defaults to 'DataTables/TestParameters.xlsx'
+    :type parameters_list: str
+    :param store: store (see store.py) to add the clusters to instead of the excel sheets, defaults to None
+    :type store: ExcelStore or SQLiteStore
+    :param index: path of a spatial index (see spatial.py) to add the clusters to, it is built from the parameter sheet first if it does not exist, defaults to None
+    :type index: str
+    """
+    new_clusters = list(new_clusters)
+    if store is None:
+        store = ExcelStore(main_list, parameters_list)
+    if index is not None:
+        from .spatial import open_index #loaded on first use, the index needs scipy
+        cluster_index = open_index(index, store) #before appending, so a new index does not get the clusters twice
+    store.append(formatted_clusters, new_clusters)
+    if index is not None:
+        cluster_index.append(new_clusters)
+        cluster_index.save_appended(index) #only the new clusters are written, the index file is rewritten when its tree is rebuilt
+
+def writeClusterAttributes(HiRiseID, ClusterData, new_cluster, main_list = 'DataTables/Testlist.xlsx', parameters_list = 'DataTables/TestParameters.xlsx', store = None, index = None):
+    #Adding the new Cluster to existing Main sheet and data to data sheet:
+    df_new = formatClusterData(HiRiseID, ClusterData)
+    if store is None:
+        #saving the Multiindex in the same file for further use:
+        df_new.to_excel('DataTables/' + HiRiseID + 'formatted.xlsx')
+    writeClusterTables([df_new], [new_cluster], main_list, parameters_list, store, index)
+
+def _measureFile(cluster_file, latc, lonc, seed = None, cache_dir = None, dispersion_mode = 'exact', exact_below = 2000, ellipse_method = 'khachiyan', stop_tolerance = None):
+    #worker of the batch mode, errors are returned instead of raised so one bad file does not stop the batch
+    timer = RunTimer()
+    timer.note(path = cluster_file)
+    try:
+        latc, lonc = checkCentre(latc, lonc)
+        with timer.stage('read'):
+            ClusterData, HiRiseID = readClusterFile(cluster_file)
+        timer.note(HiRise_ID = HiRiseID)
+        cache = None if cache_dir is None else ResultCache(cache_dir)
+        new_cluster = measureCluster(ClusterData, HiRiseID, latc, lonc, rng = seed, cache = cache, timer = timer, dispersion_mode = dispersion_mode, exact_below = exact_below,
+                                     ellipse_method = ellipse_method, stop_tolerance = stop_tolerance)
+        return cluster_file, formatClusterData(HiRiseID, ClusterData), new_cluster, None, timer.record
+    except Exception as err:
+        timer.note(error = repr(err))
+        return cluster_file, None, None, repr(err), timer.record
+
+def _measureStreamed(HiRiseID, ClusterData, latc, lonc, seed = None, cache_dir = None, dispersion_mode = 'exact', exact_below = 2000, ellipse_method = 'khachiyan', stop_tolerance = None):
+    #worker of measureStream, errors are returned instead of raised like in _measureFile
+    timer = RunTimer(HiRiseID)
+    try:
+        latc, lonc = checkCentre(latc, lonc)
+        cache = None if cache_dir is None else ResultCache(cache_dir)
+        new_cluster = measureCluster(ClusterData, HiRiseID, latc, lonc, rng = seed, cache = cache, timer = timer, dispersion_mode = dispersion_mode, exact_below = exact_below,
+                                     ellipse_method = ellipse_method, stop_tolerance = stop_tolerance)
+        return HiRiseID, formatClusterData(HiRiseID, ClusterData), new_cluster, None, timer.record
+    except Exception as err:
+        timer.note(error = repr(err))
+        return HiRiseID, None, None, repr(err), timer.record
+
+def measureStream(catalog, centres = None, workers = None, seed = None, cache_dir = None, chunksize = 100000, id_column = 'HiRiseID', dispersion_mode = 'exact', exact_below = 2000,
+                  ellipse_method = 'khachiyan', stop_tolerance = None):
+    """
+    Measures all clusters of a large crater catalog (csv or parquet, see stream.py), reading it one cluster at a time.
+    Yields (HiRiseID, formatted craters, parameters, error, run log record) for each cluster in the order of the catalog, error is None unless the cluster failed.
+    Only a few clusters per worker are read ahead, so the memory used does not grow with the size of the catalog.
+
+    :param catalog: path to the catalog, craters of a cluster on consecutive rows
+    :type catalog: str
+    :param centres: table with the columns 'HiRise_ID', 'central_latitude' and 'central_longitude' (i.e. the parameters sheet), defaults to None to use the mean coordinates of each cluster
+    :type centres: pandas dataframe
+    :param workers: number of worker processes, 1 measures in this process, defaults to None for the number of CPUs
+    :type workers: int
+    :param seed: seed of the bootstrap of the best fit ellipse, defaults to None
+    :type seed: int
+    :param cache_dir: directory of a ResultCache shared by all workers, only used with a seed, defaults to None
+    :type cache_dir: str
+    :param chunksize: number of rows of the catalog read at once, defaults to 100000
+    :type chunksize: int
+    :param id_column: column of the catalog giving the HiRise ID, defaults to 'HiRiseID'
+    :type id_column: str
+    :param dispersion_mode: 'exact', 'sampled' or 'auto', see measureCluster, defaults to 'exact'
+    :type dispersion_mode: str
+    :param exact_below: number of craters below which the 'auto' mode is exact, defaults to 2000
+    :type exact_below: int
+    :param ellipse_method: 'khachiyan' or 'hull', see measureCluster, defaults to 'khachiyan'
+    :type ellipse_method: str
+    :param stop_tolerance: tolerance to stop the bootstrap of the best fit ellipse early, see measureCluster, defaults to None
+    :type stop_tolerance: float
+    """
+    if centres is not None:
+        centres = centres.drop_duplicates('HiRise_ID').set_index('HiRise_ID')[['central_latitude', 'central_longitude']]
+        centres = dict(zip(centres.index, centres.itertuples(index = False, name = None)))
+
+    def jobs():
+        for HiRiseID, cluster in iter_clusters(catalog, id_column, chunksize = chunksize):
+            ClusterData = cluster_data(cluster)
+            if centres is None:
+                #latitude from y_coord and longitude from x_coord, as in the parameter sheet (see catalog.central_coordinates)
+                yield HiRiseID, ClusterData, (ClusterData['y_coord'].mean(), ClusterData['x_coord'].mean())
+            else:
+                yield HiRiseID, ClusterData, centres.get(HiRiseID)
+
+    if workers == 1:
+        for HiRiseID, ClusterData, centre in jobs():
+            yield _missingCentre(HiRiseID) if centre is None else _measureStreamed(HiRiseID, ClusterData, *centre, seed, cache_dir, dispersion_mode, exact_below, ellipse_method, stop_tolerance)
+        return
+    from concurrent.futures import ProcessPoolExecutor
+    workers = workers or os.cpu_count()
+    pending = deque()
+    with ProcessPoolExecutor(max_workers = workers) as pool:
+        for HiRiseID, ClusterData, centre in jobs():
+            pending.append(_missingCentre(HiRiseID) if centre is None else pool.submit(_measureStreamed, HiRiseID, ClusterData, *centre, seed, cache_dir, dispersion_mode, exact_below, ellipse_method, stop_tolerance))
+            while len(pending) > 2*workers: #bounding the number of clusters waiting in memory
+                job = pending.popleft()
+                yield job if isinstance(job, tuple) else job.result()
+        while pending:
+            job = pending.popleft()
+            yield job if isinstance(job, tuple) else job.result()
+
+def _missingCentre(HiRiseID):
+    #result of measureStream for a cluster that is not in the table of central coordinates
+    timer = RunTimer(HiRiseID)
+    error = repr(KeyError('no central coordinates for cluster ' + str(HiRiseID)))
+    timer.note(error = error)
+    return HiRiseID, None, None, error, timer.record
 
-    #reading in Paramaters sheet
-    df_parameters = pd.read_excel(parameters_list, index_col=0)
-    #adding the new values to the list:
-    df_parameters = df_parameters.append(new_cluster, ignore_index = True)
-    df_parameters.to_excel(parameters_list) #saving the updated version
+def measureBatch(manifest, workers = None, seed = None, cache_dir = None, dispersion_mode = 'exact', exact_below = 2000, ellipse_method = 'khachiyan', stop_tolerance = None):
+    """
+    Measures all clusters listed in a manifest using a pool of worker processes.
+    Returns the formatted craters and the parameters of all measured clusters in the order of the manifest, a list of (path, error) for the files that failed
+    and the run log records (see runlog.py) of all files.
+
+    :param manifest: path to a csv file with the columns path, latitude, longitude (central coordinates of the image) for each cluster
+    :type manifest: str
+    :param workers: number of worker processes, defaults to None for the number of CPUs
+    :type workers: int
+    :param seed: seed of the bootstrap of the best fit ellipse, defaults to None
+    :type seed: int
+    :param cache_dir: directory of a ResultCache shared by all workers, only used with a seed, defaults to None
+    :type cache_dir: str
+    :param dispersion_mode: 'exact', 'sampled' or 'auto', see measureCluster, defaults to 'exact'
+    :type dispersion_mode: str
+    :param exact_below: number of craters below which the 'auto' mode is exact, defaults to 2000
+    :type exact_below: int
+    :param ellipse_method: 'khachiyan' or 'hull', see measureCluster, defaults to 'khachiyan'
+    :type ellipse_method: str
+    :param stop_tolerance: tolerance to stop the bootstrap of the best fit ellipse early, see measureCluster, defaults to None
+    :type stop_tolerance: float
+    """
+    clusters = pd.read_csv(manifest, skipinitialspace = True).iloc[:, :3]
+    n_clusters = len(clusters)
+    jobs = (clusters.iloc[:, 0].astype(str).tolist(), clusters.iloc[:, 1].astype(float).tolist(), clusters.iloc[:, 2].astype(float).tolist(),
+            [seed]*n_clusters, [cache_dir]*n_clusters, [dispersion_mode]*n_clusters, [exact_below]*n_clusters,
+            [ellipse_method]*n_clusters, [stop_tolerance]*n_clusters)
+    if workers == 1:
+        results = list(map(_measureFile, *jobs))
+    else:
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(max_workers = workers) as pool:
+            results = list(pool.map(_measureFile, *jobs))
+    formatted_clusters = []
+    new_clusters = []
+    failed = []
+    records = []
+    for cluster_file, df_new, new_cluster, error, record in results:
+        if error is None:
+            formatted_clusters.append(df_new)
+            new_clusters.append(new_cluster)
+        else:
+            failed.append((cluster_file, error))
+        records.append(record)
+    return formatted_clusters, new_clusters, failed, records
+
+def ClusterParametersBatch(argv = None):
+    """
+    Runs the batch subcommand: measures all clusters of a manifest in parallel and adds them to the main list and parameter sheet at the end.
+    With --catalog the clusters of the catalog are streamed and added to the store every flush clusters.
+    """
+    manifest, workers, store, seed, cache_dir, runlog, catalog, centres, dispersion_mode, exact_below, ellipse_method, stop_tolerance, index = getBatchParameters(argv)
+    if catalog is not None:
+        return ClusterParametersStream(catalog, centres, workers, store, seed, cache_dir, runlog, dispersion_mode = dispersion_mode, exact_below = exact_below,
+                                       ellipse_method = ellipse_method, stop_tolerance = stop_tolerance, index = index)
+    formatted_clusters, new_clusters, failed, records = measureBatch(manifest, workers, seed, cache_dir, dispersion_mode, exact_below, ellipse_method, stop_tolerance)
+    timer = RunTimer()
+    timer.note(batch = manifest, clusters = len(new_clusters))
+    if new_clusters:
+        with timer.stage('write'):
+            writeClusterTables(formatted_clusters, new_clusters, store = store, index = index)
+    if runlog is not None:
+        writeRunLog(records + [timer], runlog)
+    print('measured ' + str(len(new_clusters)) + ' clusters, ' + str(len(failed)) + ' failed')
+    for cluster_file, error in failed:
+        print('failed: ' + cluster_file + ': ' + error, file = sys.stderr)
+    return failed
+
+def ClusterParametersStream(catalog, centres, workers, store, seed = None, cache_dir = None, runlog = None, flush = 1000, dispersion_mode = 'exact', exact_below = 2000,
+                            ellipse_method = 'khachiyan', stop_tolerance = None, index = None):
+    """
+    Measures all clusters of a catalog one at a time and adds them to the store (and the spatial index, if given) in groups of flush clusters,
+    returns the list of (HiRiseID, error) of the clusters that failed.
+    """
+    formatted_clusters, new_clusters, records, failed = [], [], [], []
+    n_measured = 0
+    def write():
+        if new_clusters:
+            writeClusterTables(formatted_clusters, new_clusters, store = store, index = index)
+        if runlog is not None:
+            writeRunLog(records, runlog)
+        del formatted_clusters[:], new_clusters[:], records[:]
+    for HiRiseID, df_new, new_cluster, error, record in measureStream(catalog, centres, workers, seed, cache_dir, dispersion_mode = dispersion_mode, exact_below = exact_below,
+                                                                               ellipse_method = ellipse_method, stop_tolerance = stop_tolerance):
+        if error is None:
+            formatted_clusters.append(df_new)
+            new_clusters.append(new_cluster)
+            n_measured += 1
+        else:
+            failed.append((str(HiRiseID), error))
+        records.append(record)
+        if len(records) >= flush:
+            write()
+    write()
+    print('measured ' + str(n_measured) + ' clusters, ' + str(len(failed)) + ' failed')
+    for HiRiseID, error in failed:
+        print('failed: ' + HiRiseID + ': ' + error, file = sys.stderr)
+    return failed
 
 def ClusterParameters():
     """
     Runs the functions from the parameters script.
+    Use 'ClusterParameters batch Manifest' to measure many clusters at once.
     """
+    if sys.argv[1:2] == ['batch']:
+        failed = ClusterParametersBatch(sys.argv[2:])
+        sys.exit(1 if failed else 0)
     # Get cluster parameters
-    cluster_file, latc, lonc, verb, save = getParameters()
+    cluster_file, latc, lonc, verb, save, store, runlog, index = getParameters()
+    timer = RunTimer()
     # Read the cluster file from ArcGIS
-    ClusterData, HiRiseID = readClusterFile(cluster_file)
+    with timer.stage('read'):
+        ClusterData, HiRiseID = readClusterFile(cluster_file, store)
     print(HiRiseID)
+    timer.note(HiRise_ID = HiRiseID)
     # Measure the cluster attributes
-    new_cluster = measureCluster(ClusterData, HiRiseID, latc, lonc, verb, save)
+    new_cluster = measureCluster(ClusterData, HiRiseID, latc, lonc, verb, save, timer = timer)
     # Store the cluster attributes to file
-    writeClusterAttributes(HiRiseID, ClusterData, new_cluster)
+    with timer.stage('write'):
+        writeClusterAttributes(HiRiseID, ClusterData, new_cluster, store = store, index = index)
+    if runlog is not None:
+        writeRunLog([timer], runlog)
 # To run this as a script
 if __name__ == '__main__':
     ClusterParameters()
@@ -0,0 +1,309 @@
+import sys
+import os
+if __package__ in (None, ''):
+    #run as a script (python tools/render.py), the modules are imported from the tools package
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    __package__ = 'tools'
+import argparse
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.patches import Ellipse
+from . import functions as ct
+from .cluster import Cluster
+from .catalog import central_coordinates
+'''
+Off-screen rendering of the cluster plots of measureCluster and the catalog plots of the ClusterPlotting notebook, to png files.
+The figures are drawn on the non-interactive Agg canvas without pyplot, so no window is opened and no figures are left open between plots.
+A renderer keeps one figure with all its artists and only changes their data for the next cluster or plot, instead of building a new figure every time.
+render_clusters plots every cluster of the main list to its own file in a pool of worker processes, render_catalog draws the plots comparing all clusters
+with those of Daubar et al. 2019, with the derived columns (N>D/2, aspect ratio) calculated for the whole table at once.
+Run it as a script to render the plots of a store (see store.py):
+
+    python tools/render.py catalog.sqlite --clusters plots --catalog . --seed 1
+'''
+
+#catalog plots of the ClusterPlotting notebook: file name, x and y column, x and y label, title and whether both axes are logarithmic
+CATALOG_PLOTS = [('DiametervsNoCraters.png', 'Number_Craters', 'd_eff', 'Number of Craters', 'effective Diameter (m)', 'effective Diameter vs Number of Craters', False),
+                 ('Fvalue.png', 'd_eff', 'F_value', 'effective Diameter(m)', 'F value', 'F value vs effective Diameter', False),
+                 ('Nlarger.png', 'd_eff', 'N>D/2', 'effective Diameter(m)', 'Craters larger half the max diameter', 'N > D/2 vs effective Diameter', False),
+                 ('Dispersion.png', 'd_eff', 'Dispersion', 'effective Diameter(m)', 'Dispersion', 'Dispersion vs effective Diameter', False),
+                 ('Dispersionlog.png', 'd_eff', 'Dispersion', 'effective Diameter(m)', 'Dispersion', 'Dispersion vs effective Diameter in loglog', True),
+                 ('Ellipticity.png', 'd_eff', 'aspect_ratio', 'effective Diameter(m)', 'Aspect Ratio', 'Ellipticity', False)]
+
+#columns of the supplemental table 2 of Daubar et al. 2019 and the parameter sheet columns they are
+DAUBAR_COLUMNS = {'HiRISE Observation ID': 'HiRise_ID', 'N craters': 'Number_Craters', 'Dispersion(m)': 'Dispersion', 'Effective Diameter (m)': 'd_eff',
+                  'R1': 'R1', 'R2': 'R2', 'F_value': 'F_value'}
+
+#columns of the parameter sheet giving the best fit ellipse of a cluster as measureCluster saves it
+ELLIPSE_COLUMNS = ['Ellipse_x', 'Ellipse_y', 'R1', 'R2', 'Ellipse_angle']
+
+class ClusterRenderer:
+    """
+    Figure for the plot of one cluster as measureCluster draws it: the craters in metres and both possible orientations of the best fit ellipse.
+    The same figure is used for every cluster rendered with it.
+
+    :param figsize: size of the figure in inches, defaults to (8, 6) as in measureCluster
+    :type figsize: tuple
+    :param dpi: resolution of the png files, defaults to 100
+    :type dpi: float
+    """
+    def __init__(self, figsize = (8, 6), dpi = 100):
+        self.figure = Figure(figsize = figsize, dpi = dpi)
+        FigureCanvasAgg(self.figure)
+        self.ax = self.figure.add_subplot(111, aspect = 'equal')
+        self.craters = self.ax.scatter([], [], marker = '.', color = 'k')
+        self.ellipses = [Ellipse((0, 0), 1, 1, fill = False, color = colour) for colour in ('r', 'y')] #plotting both possible ellipse orientations
+        for ellipse in self.ellipses:
+            self.ax.add_patch(ellipse)
+
+    def render(self, coord_array, HiRiseID, path, ellipse = None):
+        """
+        Plots a cluster and saves it as a png file.
+
+        :param coord_array: coordinates of the craters in metres, shape (N, 2)
+        :type coord_array: numpy array
+        :param HiRiseID: HiRise Observation ID of the cluster, used for the title
+        :type HiRiseID: str
+        :param path: path of the png file
+        :type path: str
+        :param ellipse: best fit ellipse as given by functions.BestFitEllipse, defaults to None to plot the craters only
+        :type ellipse: tuple
+        """
+        self.craters.set_offsets(coord_array)
+        low = coord_array.min(axis=0)
+        high = coord_array.max(axis=0)
+        for ellipse_patch in self.ellipses:
+            ellipse_patch.set_visible(ellipse is not None)
+        if ellipse is not None:
+            centre, radii, rotation_matrix, rotation_angle = ellipse
+            for ellipse_patch, (width, height) in zip(self.ellipses, (radii, radii[::-1])):
+                #the attributes of the patch, matplotlib 3.2 (requirements.txt) has no setters for them and recomputes the transform from them when drawing
+                ellipse_patch.center = centre
+                ellipse_patch.width = 2*width
+                ellipse_patch.height = 2*height
+                ellipse_patch.angle = rotation_angle
+                ellipse_patch.stale = True
+            low = np.minimum(low, centre - max(radii))
+            high = np.maximum(high, centre + max(radii))
+        margin = 0.05*np.maximum(high - low, 1) #as the default margins of matplotlib, at least 5 cm for a single crater
+        self.ax.set_xlim(low[0] - margin[0], high[0] + margin[0])
+        self.ax.set_ylim(low[1] - margin[1], high[1] + margin[1])
+        self.ax.set_title('Cluster of ' + str(HiRiseID))
+        self.figure.savefig(path)
+
+def _renderChunk(clusters, directory, tolerance, n_bootstrap, rng, ellipse_method, stop_tolerance):
+    #worker of render_clusters, one figure for all clusters of the chunk
+    renderer = ClusterRenderer()
+    paths = []
+    for HiRiseID, lon, lat, latc, lonc, stored in clusters:
+        metres = Cluster(lon, lat, latc = latc, lonc = lonc).projected()
+        ellipse = None
+        if stored is not None: #the ellipse saved by measureCluster
+            x, y, R1, R2, angle = stored
+            alpha = np.radians(angle)
+            ellipse = (np.array([x, y]), np.array([R1, R2]), np.array([[np.cos(alpha), -np.sin(alpha)], [np.sin(alpha), np.cos(alpha)]]), angle)
+        elif len(metres) > 5:
+            try: #the same ellipse as measureCluster with the same seed
+                ellipse = ct.BestFitEllipse(metres, tolerance, n_bootstrap = n_bootstrap, rng = rng, method = ellipse_method, stop_tolerance = stop_tolerance)
+            except np.linalg.LinAlgError: #all craters on one line
+                pass
+        path = os.path.join(directory, str(HiRiseID) + '.png')
+        renderer.render(metres[['x_coord', 'y_coord']], HiRiseID, path, ellipse)
+        paths.append(path)
+    return paths
+
+def _stored_ellipses(centres, HiRiseIDs):
+    #best fit ellipses of the clusters in the parameter sheet (see ELLIPSE_COLUMNS), None for clusters without one
+    if centres is None or not set(ELLIPSE_COLUMNS) <= set(centres.columns):
+        return [None]*len(HiRiseIDs)
+    centres = centres.drop_duplicates('HiRise_ID').set_index('HiRise_ID') if 'HiRise_ID' in centres.columns else centres
+    ellipses = centres[ELLIPSE_COLUMNS].reindex(HiRiseIDs).to_numpy(dtype=float)
+    return [ellipse if np.isfinite(ellipse).all() else None for ellipse in ellipses]
+
+def render_clusters(main_df, directory = 'plots', centres = None, workers = None, seed = None, tolerance = None, n_bootstrap = 301, ellipse_method = 'khachiyan',
+                    stop_tolerance = None, x = 'x_coord', y = 'y_coord'):
+    """
+    Plots every cluster of the main list with its best fit ellipse to directory/HiRiseID.png, using a pool of worker processes.
+    The ellipses saved in the parameter sheet (see ELLIPSE_COLUMNS) are drawn as they are, only clusters without one are fitted again.
+    The clusters are split into a few chunks per worker, each worker draws all clusters of a chunk on one figure.
+    Returns the paths of the png files in the order of the main list.
+
+    :param main_df: main list of all craters, indexed by (HiRiseID, crater_no)
+    :type main_df: pandas dataframe
+    :param directory: directory to save the plots in, created if it does not exist, defaults to 'plots'
+    :type directory: str
+    :param centres: table of the central coordinates and the best fit ellipses (i.e. the parameters sheet), defaults to None to use the mean coordinates of each cluster
+    :type centres: pandas dataframe
+    :param workers: number of worker processes, 1 renders in this process, defaults to None for the number of CPUs
+    :type workers: int
+    :param seed: seed of the bootstrap of the ellipses fitted again, the seed used for measuring gives the same ellipses, defaults to None
+    :type seed: int
+    :param tolerance: gives the tolerance for the Kachiyan algorithm, defaults to None for 0.1
+    :type tolerance: float
+    :param n_bootstrap: number of bootstrap samples for the best fit ellipse, defaults to 301
+    :type n_bootstrap: int
+    :param ellipse_method: 'khachiyan' or 'hull' (see functions.BestFitEllipse), defaults to 'khachiyan'
+    :type ellipse_method: str
+    :param stop_tolerance: stops the bootstrap of the best fit ellipse early (see functions.BestFitEllipse), defaults to None
+    :type stop_tolerance: float
+    :param x: column name giving the longitude, defaults to 'x_coord'
+    :type x: str
+    :param y: column name giving the latitude, defaults to 'y_coord'
+    :type y: str
+    """
+    os.makedirs(directory, exist_ok = True)
+    coordinates = central_coordinates(main_df, centres, x, y)
+    grouped = main_df[[x, y]].groupby(level=0, sort=False)
+    lon = main_df[x].to_numpy(dtype=float)
+    lat = main_df[y].to_numpy(dtype=float)
+    clusters = [(HiRiseID, lon[positions], lat[positions], latc, lonc, stored) for (HiRiseID, positions), latc, lonc, stored
+                in zip(grouped.indices.items(), coordinates['central_latitude'], coordinates['central_longitude'], _stored_ellipses(centres, list(grouped.indices)))]
+    workers = workers or os.cpu_count()
+    n_chunks = min(len(clusters), 1 if workers == 1 else 4*workers) #a few chunks per worker, so they finish at about the same time
+    chunks = [clusters[i::n_chunks] for i in range(n_chunks)]
+    jobs = (chunks, [directory]*n_chunks, [tolerance]*n_chunks, [n_bootstrap]*n_chunks, [seed]*n_chunks, [ellipse_method]*n_chunks, [stop_tolerance]*n_chunks)
+    if workers == 1:
+        results = list(map(_renderChunk, *jobs))
+    else:
+        with ProcessPoolExecutor(max_workers = workers) as pool:
+            results = list(pool.map(_renderChunk, *jobs))
+    #back to the order of the main list, chunk i has the clusters i, i + n_chunks, ...
+    paths = [None]*len(clusters)
+    for i, chunk_paths in enumerate(results):
+        paths[i::n_chunks] = chunk_paths
+    return paths
+
+def catalog_columns(parameters):
+    """
+    Adds the derived columns of the catalog plots to a parameter sheet: N>D/2 (from the F value if it is missing) and the aspect ratio R1/R2.
+
+    :param parameters: parameter sheet or the table of read_daubar
+    :type parameters: pandas dataframe
+    """
+    parameters = parameters.copy()
+    if 'N>D/2' not in parameters.columns:
+        parameters['N>D/2'] = parameters['Number_Craters']*parameters['F_value']
+    parameters['aspect_ratio'] = parameters['R1']/parameters['R2']
+    return parameters
+
+def read_daubar(path = 'DataTables/DataDaubar2019.xlsx'):
+    """
+    Reads the clusters of Daubar et al. 2019 (supplemental table 2) with the column names of the parameter sheet and the derived columns of catalog_columns.
+
+    :param path: path of the table, defaults to 'DataTables/DataDaubar2019.xlsx'
+    :type path: str
+    """
+    daubar = pd.read_excel(path, sheet_name = 'Supplemental Table 2')
+    return catalog_columns(daubar.rename(columns = DAUBAR_COLUMNS)[list(DAUBAR_COLUMNS.values())])
+
+class CatalogRenderer:
+    """
+    Figure for the catalog plots (see CATALOG_PLOTS), the new clusters as red and the clusters of Daubar et al. 2019 as black stars.
+    The same figure and lines are used for all plots.
+
+    :param figsize: size of the figure in inches, defaults to (8, 6) as in the ClusterPlotting notebook
+    :type figsize: tuple
+    :param dpi: resolution of the png files, defaults to 100
+    :type dpi: float
+    """
+    def __init__(self, figsize = (8, 6), dpi = 100):
+        self.figure = Figure(figsize = figsize, dpi = dpi)
+        FigureCanvasAgg(self.figure)
+        self.ax = self.figure.add_subplot(111)
+        self.new, = self.ax.plot([], [], 'r*', label = 'New Clusters') #plotting new clusters
+        self.daubar, = self.ax.plot([], [], 'k*', label = 'Clusters from Daubar 2019')
+        self.ax.grid(True)
+
+    def render(self, parameters, daubar, path, x, y, xlabel, ylabel, title, log = False):
+        """
+        Draws one catalog plot and saves it as a png file.
+
+        :param parameters: parameter sheet with the columns of catalog_columns, or None
+        :type parameters: pandas dataframe
+        :param daubar: clusters of Daubar et al. 2019 as given by read_daubar, or None
+        :type daubar: pandas dataframe
+        :param path: path of the png file
+        :type path: str
+        :param x: column plotted on the x axis
+        :type x: str
+        :param y: column plotted on the y axis
+        :type y: str
+        :param xlabel: label of the x axis
+        :type xlabel: str
+        :param ylabel: label of the y axis
+        :type ylabel: str
+        :param title: title of the plot
+        :type title: str
+        :param log: logarithmic axes, defaults to False
+        :type log: bool
+        """
+        for line, table in ((self.new, parameters), (self.daubar, daubar)):
+            line.set_visible(table is not None)
+            if table is not None:
+                line.set_data(table[x].to_numpy(dtype=float), table[y].to_numpy(dtype=float))
+        self.ax.set_xscale('log' if log else 'linear')
+        self.ax.set_yscale('log' if log else 'linear')
+        self.ax.relim(visible_only = True)
+        self.ax.autoscale_view()
+        self.ax.set_xlabel(xlabel)
+        self.ax.set_ylabel(ylabel)
+        self.ax.set_title(title)
+        self.ax.legend(handles = [line for line in (self.new, self.daubar) if line.get_visible()], loc = 'best')
+        self.figure.savefig(path)
+
+def render_catalog(parameters = None, directory = '.', daubar = 'DataTables/DataDaubar2019.xlsx'):
+    """
+    Draws all catalog plots of the ClusterPlotting notebook (see CATALOG_PLOTS) to directory, comparing the clusters of a parameter sheet with those of Daubar et al. 2019.
+    Returns the paths of the png files.
+
+    :param parameters: parameter sheet of the new clusters, i.e. store.read_parameters(), defaults to None to plot the clusters of Daubar et al. 2019 only
+    :type parameters: pandas dataframe
+    :param directory: directory to save the plots in, created if it does not exist, defaults to '.'
+    :type directory: str
+    :param daubar: path of the table of Daubar et al. 2019 or the table as given by read_daubar, None leaves them out, defaults to 'DataTables/DataDaubar2019.xlsx'
+    :type daubar: str or pandas dataframe
+    """
+    os.makedirs(directory, exist_ok = True)
+    if parameters is not None:
+        parameters = catalog_columns(parameters)
+    if isinstance(daubar, str):
+        daubar = read_daubar(daubar)
+    renderer = CatalogRenderer()
+    paths = []
+    for filename, x, y, xlabel, ylabel, title, log in CATALOG_PLOTS:
+        path = os.path.join(directory, filename)
+        renderer.render(parameters, daubar, path, x, y, xlabel, ylabel, title, log)
+        paths.append(path)
+    return paths
+
+def main(argv = None):
+    """
+    Renders the plots of all clusters in a store and the catalog plots from the command line.
+    """
+    from .store import open_store
+    parser = argparse.ArgumentParser(prog = 'render', description = 'Render the plots of all clusters in a store and the catalog plots to png files')
+    parser.add_argument('store', help = 'SQLite file (.sqlite, .db) or excel main list of the clusters')
+    parser.add_argument('--parameters-list', default = 'DataTables/TestParameters.xlsx', help = 'parameter sheet used with an excel main list')
+    parser.add_argument('--clusters', default = None, help = 'directory for the plot of each cluster, defaults to no cluster plots')
+    parser.add_argument('--catalog', default = None, help = 'directory for the catalog plots, defaults to no catalog plots')
+    parser.add_argument('--daubar', default = 'DataTables/DataDaubar2019.xlsx', help = 'table of Daubar et al. 2019 shown in the catalog plots')
+    parser.add_argument('-j', '--workers', type = int, default = os.cpu_count(), help = 'number of worker processes, defaults to the number of CPUs')
+    parser.add_argument('--seed', type = int, default = None, help = 'seed of the bootstrap of the ellipses not saved in the parameter sheet, the seed used for measuring gives the same ellipses')
+    parser.add_argument('--ellipse', choices = ['khachiyan', 'hull'], default = 'khachiyan', help = 'method of the best fit ellipse, defaults to khachiyan')
+    parser.add_argument('--stop-tolerance', type = float, default = None, help = 'stop the bootstrap once the mean radii and rotation are known to this relative standard error, use the value used for measuring, defaults to all samples')
+    args = parser.parse_args(argv)
+    store = open_store(args.store, args.parameters_list)
+    parameters = store.read_parameters()
+    if args.clusters is not None:
+        paths = render_clusters(store.read_craters(), args.clusters, parameters, args.workers, args.seed, ellipse_method = args.ellipse,
+                                stop_tolerance = args.stop_tolerance)
+        print('rendered ' + str(len(paths)) + ' clusters to ' + args.clusters)
+    if args.catalog is not None:
+        render_catalog(parameters, args.catalog, args.daubar)
+        print('rendered the catalog plots to ' + args.catalog)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+import json
+import time
+from contextlib import contextmanager
+'''
+Timing of the stages of measuring a cluster and a structured run log.
+A RunTimer collects the time spent in each stage (read, unit conversion, d_eff, F value, dispersion, ellipse, plotting, write)
+and other values of one cluster, i.e. the Kachiyan iteration counts of the best fit ellipse.
+writeRunLog appends one json line per cluster to a log file, keyed by the HiRise ID.
+'''
+
+class RunTimer:
+    """
+    Collects the timings and values of one cluster as a dictionary in record.
+
+    :param HiRiseID: HiRise Observation ID of the cluster, defaults to None
+    :type HiRiseID: str
+    """
+    def __init__(self, HiRiseID = None):
+        self.record = {'HiRise_ID': HiRiseID, 'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'), 'stages': {}}
+
+    @contextmanager
+    def stage(self, name):
+        """
+        Context manager timing a stage, times of stages with the same name are added up.
+
+        :param name: name of the stage
+        :type name: str
+        """
+        start = time.perf_counter()
+        try:
+            yield self
+        finally:
+            stages = self.record['stages']
+            stages[name] = stages.get(name, 0.0) + time.perf_counter() - start
+
+    def note(self, **values):
+        """
+        Adds values to the record, i.e. timer.note(Number_Craters = 50).
+        """
+        self.record.update(values)
+
+    def total(self):
+        """
+        Returns the time spent in all stages in seconds.
+        """
+        return sum(self.record['stages'].values())
+
+def writeRunLog(records, path):
+    """
+    Appends records (RunTimers or their record dictionaries) to a json lines file, one line per cluster.
+
+    :param records: records to write
+    :type records: list of RunTimer or dict
+    :param path: path of the log file
+    :type path: str
+    """
+    lines = []
+    for record in records:
+        if isinstance(record, RunTimer):
+            record = record.record
+        record = dict(record, total_seconds = sum(record['stages'].values()))
+        lines.append(json.dumps(record, default = _toJSON) + '\n')
+    with open(path, 'a') as file:
+        file.write(''.join(lines)) #one write per call, so records of different runs do not interleave
+
+def _toJSON(value):
+    #numpy numbers in the records
+    if hasattr(value, 'item'):
+        return value.item()
+    if hasattr(value, 'tolist'):
+        return value.tolist()
+    raise TypeError('can not write ' + type(value).__name__ + ' to the run log')
@@ -0,0 +1,260 @@
+import os
+import numpy as np
+import pandas as pd
+from scipy.spatial import cKDTree
+from concurrent.futures import ProcessPoolExecutor
+from . import functions as ct
+from .cluster import Cluster
+from .catalog import central_coordinates
+'''
+Significance of the spatial pattern of the craters in a cluster, testing them against complete spatial randomness inside the best fit ellipse of the cluster,
+the minimum volume ellipse enclosing all its craters as BestFitEllipse finds it for each bootstrap sample.
+Ripley's K and L functions and the Clark-Evans ratio of the nearest neighbour distances are calculated with a KD-tree on the coordinates in metres, as measureCluster uses them.
+The null model is given by Monte Carlo simulations of as many craters placed at random inside the ellipse: all simulations of a chunk are drawn at once,
+and the chunks are run by a pool of worker processes. Every chunk has its own seed spawned from one seed, so the results do not depend on the number of workers.
+No edge correction is used, the simulations see the same edge as the cluster, so the envelopes and p-values take it into account.
+
+L(r) above the envelope means more crater pairs at distance r than random craters would give (clustering, i.e. subclusters), below it fewer (regular spacing).
+A Clark-Evans ratio below 1 means the craters are closer to their nearest neighbour than random ones, above 1 that they are spaced more regularly.
+'''
+
+#results of spatial_statistics for each cluster, the columns of significance_catalog
+SUMMARY_COLUMNS = ['Number_Craters', 'window_major', 'window_minor', 'area', 'n_simulations', 'clark_evans', 'clark_evans_low', 'clark_evans_high', 'clark_evans_p_value',
+                   'L_deviation', 'L_deviation_r', 'L_p_value']
+
+def ellipse_window(X, tolerance = 0.001):
+    """
+    Minimum volume ellipse enclosing all craters of a cluster, the area the simulations place their craters in.
+    It is found from the convex hull of all craters with the away steps of functions._mvee_batch instead of averaging bootstrap samples:
+    the average ellipse of the bootstrap is smaller than the area the craters are in, so random craters inside it would be closer together than those of any cluster.
+    Returns the centre, the matrix mapping the unit circle onto the ellipse and the radii, largest first.
+
+    :param X: array of shape (N, 2) of the crater coordinates in metres
+    :type X: numpy array
+    :param tolerance: tolerance of the minimum volume ellipse (see functions._mvee_batch), defaults to 0.001
+    :type tolerance: float
+    """
+    from scipy.spatial import ConvexHull, QhullError
+    try:
+        hull = X[ConvexHull(X).vertices] #the ellipse only depends on the craters on the hull
+    except (QhullError, ValueError):
+        raise np.linalg.LinAlgError('all craters are on one line')
+    u = ct._mvee_batch(hull[None], np.ones((1, len(hull)), dtype=bool), tolerance)[0][0]
+    centre = u @ hull
+    A = np.linalg.inv((hull*u[:, None]).T @ hull - np.outer(centre, centre))/2 #(x - centre)^T A (x - centre) <= 1 inside the ellipse
+    eigenvalues, axes = np.linalg.eigh(A)
+    if not (np.isfinite(eigenvalues).all() and (eigenvalues > 0).all()):
+        raise np.linalg.LinAlgError('all craters are on one line')
+    radii = 1/np.sqrt(eigenvalues)
+    return centre, axes*radii, radii
+
+def random_in_ellipse(centre, M, n_points, n_simulations, rng = None):
+    """
+    Places craters uniformly at random inside an ellipse, for all simulations at once.
+    Returns an array of shape (n_simulations, n_points, 2).
+
+    :param centre: centre of the ellipse
+    :type centre: numpy array
+    :param M: matrix mapping the unit circle onto the ellipse, as given by ellipse_window
+    :type M: numpy array
+    :param n_points: number of craters in each simulation
+    :type n_points: int
+    :param n_simulations: number of simulations
+    :type n_simulations: int
+    :param rng: random generator or seed, defaults to None
+    :type rng: numpy.random.Generator or int
+    """
+    rng = np.random.default_rng(rng)
+    u = rng.random((2, n_simulations, n_points))
+    radius = np.sqrt(u[0]) #uniform in area of the unit circle
+    phi = 2*np.pi*u[1]
+    disc = np.stack([radius*np.cos(phi), radius*np.sin(phi)], axis=-1)
+    return disc @ M.T + centre
+
+def ripley_k(X, r, area, tree = None):
+    """
+    Ripley's K function of the craters without edge correction: the area times the number of ordered crater pairs at most r apart, divided by N(N-1).
+
+    :param X: array of shape (N, 2) of the crater coordinates in metres
+    :type X: numpy array
+    :param r: distances in metres
+    :type r: numpy array
+    :param area: area the craters are in, in square metres
+    :type area: float
+    :param tree: KD-tree of X, defaults to None to build it
+    :type tree: scipy.spatial.cKDTree
+    """
+    n = len(X)
+    r = np.asarray(r, dtype=float)
+    tree = cKDTree(X) if tree is None else tree
+    pairs = tree.query_pairs(r.max(), output_type='ndarray') #all pairs up to the largest r, counted for every r from the sorted distances
+    distances = np.sort(np.sqrt(((X[pairs[:, 0]] - X[pairs[:, 1]])**2).sum(axis=1)))
+    return area*2*np.searchsorted(distances, r, side='right')/(n*(n - 1))
+
+def ripley_l(X, r, area, tree = None):
+    """
+    Ripley's L function sqrt(K/pi), which is r for craters placed at random.
+
+    :param X: array of shape (N, 2) of the crater coordinates in metres
+    :type X: numpy array
+    :param r: distances in metres
+    :type r: numpy array
+    :param area: area the craters are in, in square metres
+    :type area: float
+    :param tree: KD-tree of X, defaults to None to build it
+    :type tree: scipy.spatial.cKDTree
+    """
+    return np.sqrt(ripley_k(X, r, area, tree)/np.pi)
+
+def clark_evans(X, area, tree = None):
+    """
+    Clark-Evans ratio: the mean nearest neighbour distance of the craters divided by 1/(2 sqrt(N/area)), its expectation for craters placed at random.
+
+    :param X: array of shape (N, 2) of the crater coordinates in metres
+    :type X: numpy array
+    :param area: area the craters are in, in square metres
+    :type area: float
+    :param tree: KD-tree of X, defaults to None to build it
+    :type tree: scipy.spatial.cKDTree
+    """
+    tree = cKDTree(X) if tree is None else tree
+    nearest = tree.query(X, k=2)[0][:, 1] #the nearest crater apart from itself
+    return nearest.mean()*2*np.sqrt(len(X)/area)
+
+def _statistics(X, r, area):
+    #L function and Clark-Evans ratio with one tree
+    tree = cKDTree(X)
+    return ripley_l(X, r, area, tree), clark_evans(X, area, tree)
+
+def _simulate(seed, n_simulations, n_points, centre, M, r, area):
+    #worker of spatial_statistics, statistics of one chunk of simulations
+    L = np.empty((n_simulations, len(r)))
+    R = np.empty(n_simulations)
+    for i, points in enumerate(random_in_ellipse(centre, M, n_points, n_simulations, seed)):
+        L[i], R[i] = _statistics(points, r, area)
+    return L, R
+
+def _p_value(observed, simulated):
+    #Monte Carlo p-value, the observed value counts as one of the simulations
+    return (1 + (simulated >= observed).sum())/(len(simulated) + 1)
+
+def spatial_statistics(ClusterData, latc = None, lonc = None, r = None, n_simulations = 999, level = 0.05, seed = None, workers = None, chunk_size = 100,
+                       x = 'x_coord', y = 'y_coord'):
+    """
+    Tests the craters of a cluster against craters placed at random inside its best fit ellipse (see ellipse_window) with Ripley's L function and the Clark-Evans ratio.
+    Returns a dictionary of the results and a dataframe of K and L for every r with the pointwise envelope of the simulations.
+    The dictionary gives the number of craters, the radii of the ellipse in metres (window_major and window_minor, largest first unlike R1 and R2 of the parameter sheet) and its area, the Clark-Evans ratio with the range of the simulations and its p-value (two-sided),
+    and for L the largest deviation from the mean of the simulations, the r it is at and its p-value (global test over all r, two-sided).
+    Needs more than 5 craters, as the best fit ellipse in measureCluster.
+
+    :param ClusterData: Dataframe containing all craters in clusters, coordinates in degrees, or a Cluster (see cluster.py) with the central coordinates
+    :type ClusterData: pandas dataframe or Cluster
+    :param latc: central latitude of image, not needed for a Cluster, defaults to None
+    :type latc: float
+    :param lonc: central longitude of image, not needed for a Cluster, defaults to None
+    :type lonc: float
+    :param r: distances in metres to calculate K and L at, defaults to None for 50 values up to half the smaller radius of the ellipse (a quarter of its width)
+    :type r: numpy array
+    :param n_simulations: number of Monte Carlo simulations, defaults to 999
+    :type n_simulations: int
+    :param level: significance level of the envelope, which gives the level/2 and 1 - level/2 quantiles of the simulations, defaults to 0.05
+    :type level: float
+    :param seed: seed of the simulations, defaults to None
+    :type seed: int or numpy.random.SeedSequence
+    :param workers: number of worker processes, 1 runs in this process, defaults to None for the number of CPUs
+    :type workers: int
+    :param chunk_size: number of simulations drawn together and given to a worker at once, the results depend on it for a given seed, defaults to 100
+    :type chunk_size: int
+    :param x: column name giving the longitude, defaults to 'x_coord'
+    :type x: str
+    :param y: column name giving the latitude, defaults to 'y_coord'
+    :type y: str
+    """
+    cluster = ClusterData if isinstance(ClusterData, Cluster) else Cluster.from_frame(ClusterData, latc, lonc, x = x, y = y)
+    metres = cluster.projected()
+    X = np.ascontiguousarray(metres[['x_coord', 'y_coord']])
+    n = len(X)
+    if n <= 5:
+        raise ValueError('the spatial statistics need more than 5 craters')
+    centre, M, radii = ellipse_window(X)
+    area = np.pi*radii[0]*radii[1]
+    if r is None:
+        r = np.linspace(0, radii[1]/2, 51)[1:]
+    r = np.asarray(r, dtype=float)
+
+    #simulations in chunks, each with its own seed:
+    sequence = seed if isinstance(seed, np.random.SeedSequence) else np.random.SeedSequence(seed)
+    sizes = [min(chunk_size, n_simulations - start) for start in range(0, n_simulations, chunk_size)]
+    seeds = sequence.spawn(len(sizes))
+    n_chunks = len(sizes)
+    jobs = (seeds, sizes, [n]*n_chunks, [centre]*n_chunks, [M]*n_chunks, [r]*n_chunks, [area]*n_chunks)
+    if workers == 1 or n_chunks == 1:
+        results = list(map(_simulate, *jobs))
+    else:
+        with ProcessPoolExecutor(max_workers = min(workers or os.cpu_count(), n_chunks)) as pool:
+            results = list(pool.map(_simulate, *jobs))
+    L_sim = np.concatenate([result[0] for result in results])
+    R_sim = np.concatenate([result[1] for result in results])
+
+    #observed statistics against the simulations:
+    L, R = _statistics(X, r, area)
+    L_mean = L_sim.mean(axis=0)
+    deviation = L - L_mean
+    largest = np.argmax(np.abs(deviation))
+    R_mean = R_sim.mean()
+    summary = {'Number_Craters': n, 'window_major': radii[0], 'window_minor': radii[1], 'area': area, 'n_simulations': n_simulations,
+               'clark_evans': R, 'clark_evans_low': np.quantile(R_sim, level/2), 'clark_evans_high': np.quantile(R_sim, 1 - level/2),
+               'clark_evans_p_value': _p_value(abs(R - R_mean), np.abs(R_sim - R_mean)),
+               'L_deviation': deviation[largest], 'L_deviation_r': r[largest],
+               'L_p_value': _p_value(np.abs(deviation).max(), np.abs(L_sim - L_mean).max(axis=1))}
+    curves = pd.DataFrame({'r': r, 'K': np.pi*L**2, 'L': L, 'L_low': np.quantile(L_sim, level/2, axis=0), 'L_mean': L_mean,
+                           'L_high': np.quantile(L_sim, 1 - level/2, axis=0)})
+    return summary, curves
+
+def _testCluster(HiRiseID, lon, lat, latc, lonc, n_simulations, level, seed):
+    #worker of significance_catalog, runs the simulations of one cluster in this process
+    row = {'HiRise_ID': HiRiseID, 'Number_Craters': len(lon)}
+    if len(lon) > 5:
+        try:
+            row.update(spatial_statistics(Cluster(lon, lat, latc = latc, lonc = lonc), n_simulations = n_simulations, level = level, seed = seed, workers = 1)[0])
+        except np.linalg.LinAlgError: #all craters on one line
+            pass
+    return row
+
+def significance_catalog(main_df, centres = None, n_simulations = 999, level = 0.05, seed = None, workers = None, x = 'x_coord', y = 'y_coord'):
+    """
+    Tests every cluster in the main list with spatial_statistics, using a pool of worker processes over the clusters.
+    Returns a dataframe with one row per cluster, clusters of 5 craters or less give NaN.
+
+    :param main_df: main list of all craters, indexed by (HiRiseID, crater_no)
+    :type main_df: pandas dataframe
+    :param centres: table of the central coordinates (i.e. the parameters sheet), defaults to None to use the mean coordinates of each cluster
+    :type centres: pandas dataframe
+    :param n_simulations: number of Monte Carlo simulations for each cluster, defaults to 999
+    :type n_simulations: int
+    :param level: significance level of the envelopes, defaults to 0.05
+    :type level: float
+    :param seed: seed of all simulations, each cluster gets its own seed spawned from it, defaults to None
+    :type seed: int
+    :param workers: number of worker processes, 1 runs in this process, defaults to None for the number of CPUs
+    :type workers: int
+    :param x: column name giving the longitude, defaults to 'x_coord'
+    :type x: str
+    :param y: column name giving the latitude, defaults to 'y_coord'
+    :type y: str
+    """
+    coordinates = central_coordinates(main_df, centres, x, y)
+    grouped = main_df[[x, y]].groupby(level=0, sort=False)
+    IDs = list(grouped.groups)
+    lon = main_df[x].to_numpy(dtype=float)
+    lat = main_df[y].to_numpy(dtype=float)
+    positions = list(grouped.indices.values())
+    n_clusters = len(IDs)
+    jobs = (IDs, [lon[p] for p in positions], [lat[p] for p in positions], coordinates['central_latitude'].to_numpy(), coordinates['central_longitude'].to_numpy(),
+            [n_simulations]*n_clusters, [level]*n_clusters, np.random.SeedSequence(seed).spawn(n_clusters))
+    if workers == 1:
+        results = list(map(_testCluster, *jobs))
+    else:
+        with ProcessPoolExecutor(max_workers = workers) as pool:
+            results = list(pool.map(_testCluster, *jobs, chunksize = max(1, n_clusters//64)))
+    return pd.DataFrame(results, columns = ['HiRise_ID'] + SUMMARY_COLUMNS)
@@ -0,0 +1,278 @@
+import os
+import pickle
+import tempfile
+import numpy as np
+import pandas as pd
+from scipy.spatial import cKDTree
+from . import functions as ct
+'''
+Spatial index of the clusters in the parameter sheet, to find clusters by the central coordinates of their images without scanning the whole table.
+The centres are kept as points on the unit sphere in a KD-tree: the straight line (chord) distance between two points on the sphere grows with their great circle distance,
+so the tree finds exactly the clusters within a radius or the nearest clusters, and their distances are then calculated with the haversine formula on the radius of Mars.
+Clusters appended after the tree was built are kept in a small buffer that is searched directly, the tree is rebuilt once the buffer grows too large.
+All queries return the rows of the parameter sheet, with their distance in km for radius and nearest queries.
+The index can be saved to a file with its tree and is kept up to date by parameters.writeClusterTables with an index path (--index in the command line),
+which only adds the new clusters to a journal next to the file (save_appended) until the tree is rebuilt.
+'''
+
+def _unit_vectors(lat, lon):
+    #points on the unit sphere of the given latitudes and longitudes in degrees
+    lat = np.radians(lat)
+    lon = np.radians(lon)
+    return np.column_stack([np.cos(lat)*np.cos(lon), np.cos(lat)*np.sin(lon), np.sin(lat)])
+
+def haversine(lat1, lon1, lat2, lon2):
+    """
+    Great circle distance in km between points given in degrees, on the radius of Mars.
+
+    :param lat1: latitude of the first points
+    :type lat1: float or array
+    :param lon1: longitude of the first points
+    :type lon1: float or array
+    :param lat2: latitude of the second points
+    :type lat2: float or array
+    :param lon2: longitude of the second points
+    :type lon2: float or array
+    """
+    lat1, lon1, lat2, lon2 = np.radians(lat1), np.radians(lon1), np.radians(lat2), np.radians(lon2)
+    h = np.sin((lat2 - lat1)/2)**2 + np.cos(lat1)*np.cos(lat2)*np.sin((lon2 - lon1)/2)**2
+    return 2*ct.Rmars/1000*np.arcsin(np.sqrt(np.clip(h, 0, 1)))
+
+class ClusterIndex:
+    """
+    Spatial index of the parameter sheet by the central coordinates of the images.
+    Rows without central coordinates are kept in the sheet but never found.
+
+    :param parameters: parameter sheet, i.e. store.read_parameters(), defaults to None for an empty index
+    :type parameters: pandas dataframe
+    :param lat: column giving the latitude of each cluster, defaults to 'central_latitude'
+    :type lat: str
+    :param lon: column giving the longitude of each cluster, defaults to 'central_longitude'
+    :type lon: str
+    :param buffer_size: largest number of appended clusters searched without the tree, the tree is rebuilt when more are appended, defaults to 1024
+    :type buffer_size: int
+    """
+    def __init__(self, parameters = None, lat = 'central_latitude', lon = 'central_longitude', buffer_size = 1024):
+        self.lat = lat
+        self.lon = lon
+        self.buffer_size = buffer_size
+        self.parameters = pd.DataFrame(columns = [lat, lon]) if parameters is None else parameters.reset_index(drop = True)
+        self._pending = [] #clusters appended since the index was last written, see save_appended
+        self._generation = None #of the saved index the journal belongs to
+        self._build()
+
+    @classmethod
+    def from_store(cls, store, **kwargs):
+        """
+        Builds the index of all clusters in a store (see store.py).
+
+        :param store: store to read the parameter sheet from
+        :type store: ExcelStore or SQLiteStore
+        """
+        return cls(store.read_parameters(), **kwargs)
+
+    def _build(self):
+        #rebuilding the tree from all rows, which empties the buffer
+        lat = self.parameters[self.lat].to_numpy(dtype = float)
+        lon = self.parameters[self.lon].to_numpy(dtype = float)
+        self._rows = np.flatnonzero(np.isfinite(lat) & np.isfinite(lon)) #rows of the sheet in the tree
+        self._lat = lat[self._rows]
+        self._lon = lon[self._rows]
+        self._tree = cKDTree(_unit_vectors(self._lat, self._lon))
+        #latitudes in increasing order for the bounding box queries:
+        self._by_lat = np.argsort(self._lat, kind = 'stable')
+        self._sorted_lat = self._lat[self._by_lat]
+        self._buffer = np.zeros(0, dtype = int) #rows appended since the tree was built
+        self._buffer_lat = np.zeros(0)
+        self._buffer_lon = np.zeros(0)
+        self._rebuilt = True #the saved tree is out of date, save_appended writes the whole index
+
+    def __len__(self):
+        return len(self.parameters)
+
+    def append(self, new_clusters):
+        """
+        Adds clusters to the index, clusters already in it are replaced (as by the stores) and the tree is rebuilt.
+
+        :param new_clusters: parameters of each cluster as given by measureCluster, or a dataframe of parameter rows
+        :type new_clusters: list of dict or pandas dataframe
+        """
+        new = new_clusters if isinstance(new_clusters, pd.DataFrame) else pd.DataFrame(list(new_clusters))
+        if not len(new):
+            return
+        self._pending.append(new)
+        if 'HiRise_ID' in new.columns and 'HiRise_ID' in self.parameters.columns and self.parameters['HiRise_ID'].isin(new['HiRise_ID']).any():
+            old = self.parameters[~self.parameters['HiRise_ID'].isin(new['HiRise_ID'])]
+            self.parameters = pd.concat([old, new], ignore_index = True)
+            self._build()
+            return
+        start = len(self.parameters)
+        self.parameters = pd.concat([self.parameters, new], ignore_index = True) if start else new.reset_index(drop = True)
+        lat = new[self.lat].to_numpy(dtype = float)
+        lon = new[self.lon].to_numpy(dtype = float)
+        valid = np.isfinite(lat) & np.isfinite(lon)
+        self._buffer = np.concatenate([self._buffer, start + np.flatnonzero(valid)])
+        self._buffer_lat = np.concatenate([self._buffer_lat, lat[valid]])
+        self._buffer_lon = np.concatenate([self._buffer_lon, lon[valid]])
+        if len(self._buffer) > max(self.buffer_size, len(self._rows)//8):
+            self._build()
+
+    def _result(self, rows, distances = None):
+        #parameter rows, sorted by distance if there is one
+        if distances is not None:
+            order = np.argsort(distances, kind = 'stable')
+            rows, distances = rows[order], distances[order]
+        result = self.parameters.iloc[rows]
+        if distances is not None:
+            result.insert(len(result.columns), 'distance_km', distances)
+        return result
+
+    def radius(self, lat, lon, radius):
+        """
+        Returns the clusters within a distance of a point, nearest first, with their distance in the column distance_km.
+
+        :param lat: latitude of the point in degrees
+        :type lat: float
+        :param lon: longitude of the point in degrees
+        :type lon: float
+        :param radius: distance from the point in km
+        :type radius: float
+        """
+        angle = min(radius*1000/ct.Rmars, np.pi)
+        chord = 2*np.sin(angle/2) + 1e-9 #a few metres more, rounding must not lose clusters on the edge
+        found = np.asarray(self._tree.query_ball_point(_unit_vectors(lat, lon)[0], chord), dtype = int)
+        rows = np.concatenate([self._rows[found], self._buffer])
+        distances = np.concatenate([haversine(lat, lon, self._lat[found], self._lon[found]), haversine(lat, lon, self._buffer_lat, self._buffer_lon)])
+        inside = distances <= radius
+        return self._result(rows[inside], distances[inside])
+
+    def nearest(self, lat, lon, k = 5):
+        """
+        Returns the k clusters nearest to a point, nearest first, with their distance in the column distance_km.
+
+        :param lat: latitude of the point in degrees
+        :type lat: float
+        :param lon: longitude of the point in degrees
+        :type lon: float
+        :param k: number of clusters, defaults to 5
+        :type k: int
+        """
+        n_tree = min(k, len(self._rows))
+        found = np.zeros(0, dtype = int)
+        if n_tree > 0:
+            found = np.atleast_1d(self._tree.query(_unit_vectors(lat, lon)[0], k = n_tree)[1])
+        rows = np.concatenate([self._rows[found], self._buffer])
+        distances = np.concatenate([haversine(lat, lon, self._lat[found], self._lon[found]), haversine(lat, lon, self._buffer_lat, self._buffer_lon)])
+        order = np.argsort(distances, kind = 'stable')[:k]
+        return self._result(rows[order], distances[order])
+
+    def bbox(self, lat_min, lat_max, lon_min, lon_max):
+        """
+        Returns the clusters inside a latitude/longitude box, in the order of the parameter sheet.
+        A box with lon_min larger than lon_max crosses the 180 degree meridian, longitudes may be given from -180 to 180 or 0 to 360.
+        A box at least 360 degrees wide (i.e. -180 to 180) covers all longitudes.
+
+        :param lat_min: southern edge of the box in degrees
+        :type lat_min: float
+        :param lat_max: northern edge of the box in degrees
+        :type lat_max: float
+        :param lon_min: western edge of the box in degrees
+        :type lon_min: float
+        :param lon_max: eastern edge of the box in degrees
+        :type lon_max: float
+        """
+        first = np.searchsorted(self._sorted_lat, lat_min, side = 'left')
+        last = np.searchsorted(self._sorted_lat, lat_max, side = 'right')
+        band = self._by_lat[first:last] #clusters of the tree in the latitude range
+        full = lon_max - lon_min >= 360 #the modulo below would give a width of 0 for the whole globe
+        width = (lon_max - lon_min) % 360
+        rows = []
+        for positions, lat, lon in ((self._rows[band], self._lat[band], self._lon[band]), (self._buffer, self._buffer_lat, self._buffer_lon)):
+            inside = (lat >= lat_min) & (lat <= lat_max)
+            if not full:
+                inside &= (lon - lon_min) % 360 <= width
+            rows.append(positions[inside])
+        return self._result(np.sort(np.concatenate(rows)))
+
+    def save(self, path):
+        """
+        Saves the whole index with its tree to a file, so it is not rebuilt when it is loaded, and starts a new journal (see save_appended).
+
+        :param path: path of the index file
+        :type path: str
+        """
+        self._generation = os.urandom(8).hex() #journal entries of an older index are ignored, even if removing the journal fails
+        state = {'parameters': self.parameters, 'lat': self.lat, 'lon': self.lon, 'buffer_size': self.buffer_size, 'generation': self._generation,
+                 'tree': (self._rows, self._tree, self._by_lat, self._buffer, self._buffer_lat, self._buffer_lon)}
+        #writing to a temporary file first, so an interrupted save does not destroy the old index
+        handle, temp = tempfile.mkstemp(dir = os.path.dirname(os.path.abspath(path)), suffix = '.tmp')
+        with os.fdopen(handle, 'wb') as file:
+            pickle.dump(state, file, protocol = pickle.HIGHEST_PROTOCOL)
+        os.replace(temp, path)
+        if os.path.exists(path + '.journal'):
+            os.remove(path + '.journal')
+        self._pending = []
+        self._rebuilt = False
+
+    def save_appended(self, path):
+        """
+        Adds the clusters appended since the index was loaded or saved to the journal of the index file (path + '.journal') without rewriting the file.
+        The whole index is saved instead if its tree was rebuilt since, which also empties the journal.
+
+        :param path: path of the index file, saved with save
+        :type path: str
+        """
+        if self._rebuilt or self._generation is None or not os.path.exists(path):
+            self.save(path)
+            return
+        with open(path + '.journal', 'ab') as file:
+            for new in self._pending:
+                pickle.dump((self._generation, new), file, protocol = pickle.HIGHEST_PROTOCOL)
+        self._pending = []
+
+    @classmethod
+    def load(cls, path):
+        """
+        Loads an index saved with save, with the clusters of its journal (see save_appended).
+
+        :param path: path of the index file
+        :type path: str
+        """
+        with open(path, 'rb') as file:
+            state = pickle.load(file)
+        index = cls.__new__(cls)
+        index.parameters, index.lat, index.lon, index.buffer_size = state['parameters'], state['lat'], state['lon'], state['buffer_size']
+        index._rows, index._tree, index._by_lat, index._buffer, index._buffer_lat, index._buffer_lon = state['tree']
+        lat = index.parameters[index.lat].to_numpy(dtype = float)
+        lon = index.parameters[index.lon].to_numpy(dtype = float)
+        index._lat, index._lon = lat[index._rows], lon[index._rows]
+        index._sorted_lat = index._lat[index._by_lat]
+        index._generation = state['generation']
+        index._rebuilt = False
+        index._pending = []
+        if os.path.exists(path + '.journal'):
+            with open(path + '.journal', 'rb') as file:
+                while True:
+                    try:
+                        generation, new = pickle.load(file)
+                    except (EOFError, pickle.UnpicklingError): #the end, or an entry cut off by an interrupted append
+                        break
+                    if generation == state['generation']:
+                        index.append(new)
+            index._pending = [] #already in the journal
+        return index
+
+def open_index(path, store = None):
+    """
+    Loads the index saved at path, or builds it from the parameter sheet of a store and saves it there if the file does not exist yet.
+
+    :param path: path of the index file
+    :type path: str
+    :param store: store to build a new index from, defaults to None for an empty index
+    :type store: ExcelStore or SQLiteStore
+    """
+    if os.path.exists(path):
+        return ClusterIndex.load(path)
+    index = ClusterIndex() if store is None else ClusterIndex.from_store(store)
+    index.save(path)
+    return index
@@ -0,0 +1,222 @@
+from contextlib import contextmanager
+import pandas as pd
+'''
+Storage backends for the main list of all craters and the parameter sheet.
+Both backends have the same methods, so the parameters script and the notebooks can use either of them:
+append() adds clusters (replacing the rows of clusters already stored), read_craters() and read_parameters() load (parts of) the tables.
+The SQLiteStore appends a cluster without rewriting the tables, the ExcelStore keeps the original spreadsheets.
+Use export_excel to write a SQLiteStore out to the spreadsheets.
+'''
+
+#columns of the parameter sheet, as given by parameters.measureCluster
+PARAMETER_COLUMNS = ['HiRise_ID', 'Number_Craters', 'd_eff', 'd_max', 'N>D/2', 'F_value', 'central_latitude', 'central_longitude', 'Dispersion', 'Dispersion_mode', 'R1', 'R2',
+                     'Ellipse_x', 'Ellipse_y', 'Ellipse_angle']
+
+def _quote(name):
+    #column names like N>D/2 have to be quoted in SQL
+    return '"' + str(name).replace('"', '""') + '"'
+
+def _latest(formatted_clusters, new_clusters):
+    #the craters and parameters to append, a cluster given more than once is kept as given last, as if it was appended again
+    seen = set()
+    craters = []
+    for frame in reversed(formatted_clusters):
+        IDs = frame.index.get_level_values(0)
+        craters.append(frame[~IDs.isin(seen)])
+        seen.update(IDs.unique())
+    parameters = pd.DataFrame(new_clusters)
+    if 'HiRise_ID' in parameters.columns:
+        parameters = parameters.drop_duplicates('HiRise_ID', keep = 'last')
+    return craters[::-1], parameters
+
+def _select(frame, columns, HiRiseIDs, id_column):
+    #selecting rows and columns of a table read into memory
+    if HiRiseIDs is not None:
+        frame = frame[frame.index.get_level_values(id_column).isin(list(HiRiseIDs))] if id_column in frame.index.names else frame[frame[id_column].isin(list(HiRiseIDs))]
+    if columns is not None:
+        frame = frame[list(columns)]
+    return frame
+
+class ExcelStore:
+    """
+    Main list and parameter sheet kept as excel spreadsheets.
+    Every append reads and rewrites both sheets, use a SQLiteStore for large catalogs.
+
+    :param main_list: path to the main list of all craters, defaults to 'DataTables/Testlist.xlsx'
+    :type main_list: str
+    :param parameters_list: path to the parameter sheet, defaults to 'DataTables/TestParameters.xlsx'
+    :type parameters_list: str
+    """
+    def __init__(self, main_list = 'DataTables/Testlist.xlsx', parameters_list = 'DataTables/TestParameters.xlsx'):
+        self.main_list = main_list
+        self.parameters_list = parameters_list
+
+    def append(self, formatted_clusters, new_clusters):
+        """
+        Adds clusters to the main list and the parameter sheet, reading and writing each sheet once.
+        Clusters already in the sheets are replaced, so a batch can be run again, a cluster given twice is stored as given last.
+
+        :param formatted_clusters: craters of each cluster, indexed by (HiRiseID, crater_no)
+        :type formatted_clusters: list of pandas dataframes
+        :param new_clusters: parameters of each cluster
+        :type new_clusters: list of dict
+        """
+        formatted_clusters, df_new = _latest(list(formatted_clusters), list(new_clusters))
+        df_main = pd.read_excel(self.main_list, index_col=[0, 1])
+        if formatted_clusters: #dropping the old rows of clusters measured again
+            new_IDs = pd.concat(formatted_clusters).index.get_level_values(0).unique()
+            df_main = df_main[~df_main.index.get_level_values(0).isin(new_IDs)]
+        main = pd.concat([df_main] + formatted_clusters)
+        main.to_excel(self.main_list) #saving the new version
+        #reading in Paramaters sheet and adding the new values:
+        df_parameters = pd.read_excel(self.parameters_list, index_col=0)
+        if 'HiRise_ID' in df_new.columns:
+            df_parameters = df_parameters[~df_parameters['HiRise_ID'].isin(df_new['HiRise_ID'])]
+        df_parameters = pd.concat([df_parameters, df_new], ignore_index = True)
+        df_parameters.to_excel(self.parameters_list) #saving the updated version
+
+    def read_craters(self, columns = None, HiRiseIDs = None):
+        """
+        Reads the main list, indexed by (HiRiseID, crater_no).
+
+        :param columns: columns to read, defaults to None for all
+        :type columns: list of str
+        :param HiRiseIDs: clusters to read, defaults to None for all
+        :type HiRiseIDs: list of str
+        """
+        return _select(pd.read_excel(self.main_list, index_col=[0, 1]), columns, HiRiseIDs, 'HiRiseID')
+
+    def read_parameters(self, columns = None, HiRiseIDs = None):
+        """
+        Reads the parameter sheet.
+
+        :param columns: columns to read, defaults to None for all
+        :type columns: list of str
+        :param HiRiseIDs: clusters to read, defaults to None for all
+        :type HiRiseIDs: list of str
+        """
+        return _select(pd.read_excel(self.parameters_list, index_col=0), columns, HiRiseIDs, 'HiRise_ID')
+
+class SQLiteStore:
+    """
+    Main list and parameter sheet kept as the tables 'craters' and 'parameters' of a local SQLite file.
+    Appending a cluster only replaces its own rows, reads only load the requested columns and clusters.
+    The tables have a unique index on (HiRiseID, crater_no) and on HiRise_ID, so a cluster is never stored twice.
+
+    :param path: path to the SQLite file, created if it does not exist
+    :type path: str
+    """
+    def __init__(self, path):
+        self.path = path
+
+    @contextmanager
+    def _connect(self):
+        #one transaction per connection, committed at the end unless an error occurs
+        import sqlite3 #loaded on first use, the excel sheets do not need it
+        con = sqlite3.connect(self.path)
+        try:
+            with con:
+                yield con
+        finally:
+            con.close()
+
+    def _columns(self, con, table):
+        return [row[1] for row in con.execute('PRAGMA table_info(' + _quote(table) + ')')]
+
+    def _insert(self, con, table, frame, key):
+        #the rows of the clusters in frame replace any stored before, key gives the columns of the unique index, the HiRise ID first
+        #new columns (i.e. R1 and R2 after a first cluster of less than 6 craters) are added to the table
+        existing = self._columns(con, table)
+        if not existing:
+            frame.iloc[:0].to_sql(table, con, index = False)
+            con.execute('CREATE UNIQUE INDEX ' + _quote(table + '_' + '_'.join(key)) + ' ON ' + _quote(table) + ' (' + ', '.join(_quote(c) for c in key) + ')')
+        else:
+            for column in frame.columns:
+                if column not in existing:
+                    con.execute('ALTER TABLE ' + _quote(table) + ' ADD COLUMN ' + _quote(column))
+            con.executemany('DELETE FROM ' + _quote(table) + ' WHERE ' + _quote(key[0]) + ' = ?', [(ID,) for ID in frame[key[0]].unique()])
+        frame.to_sql(table, con, index = False, if_exists = 'append')
+
+    def append(self, formatted_clusters, new_clusters):
+        """
+        Adds clusters to the craters and parameters tables in one transaction.
+        Clusters already in the tables are replaced, so a batch can be run again, a cluster given twice is stored as given last (the unique indexes allow only one).
+
+        :param formatted_clusters: craters of each cluster, indexed by (HiRiseID, crater_no)
+        :type formatted_clusters: list of pandas dataframes
+        :param new_clusters: parameters of each cluster
+        :type new_clusters: list of dict
+        """
+        formatted_clusters, df_parameters = _latest(list(formatted_clusters), list(new_clusters))
+        with self._connect() as con:
+            if formatted_clusters:
+                self._insert(con, 'craters', pd.concat(formatted_clusters).reset_index(), ['HiRiseID', 'crater_no'])
+            if len(df_parameters):
+                columns = PARAMETER_COLUMNS + [column for column in df_parameters.columns if column not in PARAMETER_COLUMNS]
+                self._insert(con, 'parameters', df_parameters.reindex(columns = columns), ['HiRise_ID'])
+
+    def _read(self, table, columns, HiRiseIDs, id_column, default_columns):
+        with self._connect() as con:
+            existing = self._columns(con, table)
+            if not existing: #nothing stored yet
+                return pd.DataFrame(columns = default_columns if columns is None else list(columns))
+            query = 'SELECT ' + ('*' if columns is None else ', '.join(_quote(c) for c in columns)) + ' FROM ' + _quote(table)
+            params = []
+            if HiRiseIDs is not None:
+                params = list(HiRiseIDs)
+                query += ' WHERE ' + _quote(id_column) + ' IN (' + ', '.join('?'*len(params)) + ')'
+            return pd.read_sql_query(query, con, params = params)
+
+    def read_craters(self, columns = None, HiRiseIDs = None):
+        """
+        Reads the craters table, indexed by (HiRiseID, crater_no).
+
+        :param columns: columns to read, defaults to None for all
+        :type columns: list of str
+        :param HiRiseIDs: clusters to read, defaults to None for all
+        :type HiRiseIDs: list of str
+        """
+        index = ['HiRiseID', 'crater_no']
+        columns = None if columns is None else index + [c for c in columns if c not in index]
+        return self._read('craters', columns, HiRiseIDs, 'HiRiseID', index).set_index(index)
+
+    def read_parameters(self, columns = None, HiRiseIDs = None):
+        """
+        Reads the parameters table.
+
+        :param columns: columns to read, defaults to None for all
+        :type columns: list of str
+        :param HiRiseIDs: clusters to read, defaults to None for all
+        :type HiRiseIDs: list of str
+        """
+        return self._read('parameters', columns, HiRiseIDs, 'HiRise_ID', PARAMETER_COLUMNS)
+
+    def export_excel(self, main_list, parameters_list):
+        """
+        Writes the whole store to a main list and parameter sheet in excel format.
+
+        :param main_list: path of the main list to write
+        :type main_list: str
+        :param parameters_list: path of the parameter sheet to write
+        :type parameters_list: str
+        """
+        self.read_craters().to_excel(main_list)
+        self.read_parameters().to_excel(parameters_list)
+
+def open_store(location = None, parameters_list = 'DataTables/TestParameters.xlsx'):
+    """
+    Opens the store at a location: a .sqlite/.db file gives a SQLiteStore, an excel main list an ExcelStore with the given parameter sheet.
+
+    :param location: path to the SQLite file or the excel main list, defaults to None for 'DataTables/Testlist.xlsx'
+    :type location: str
+    :param parameters_list: parameter sheet used with an excel main list, defaults to 'DataTables/TestParameters.xlsx'
+    :type parameters_list: str
+    """
+    if location is None:
+        return ExcelStore(parameters_list = parameters_list)
+    if location.endswith('.sqlite') or location.endswith('.db'):
+        return SQLiteStore(location)
+    elif location.endswith('.xls') or location.endswith('.xlsx'):
+        return ExcelStore(location, parameters_list)
+    else:
+        raise TypeError('Store must be a SQLite (.sqlite, .db) or excel file')
@@ -0,0 +1,83 @@
+import pandas as pd
+'''
+Streaming reader of large crater catalogs, i.e. a csv or parquet export of the main list of all craters.
+The catalog is read in chunks and the craters are handed out one cluster at a time as (HiRiseID, cluster),
+so only one chunk and the cluster being collected are held in memory, whatever the size of the catalog.
+The craters of a cluster have to be on consecutive rows, as in the main list written by parameters.writeClusterAttributes.
+Rows with an empty HiRise ID belong to the cluster above them, like the merged cells of the excel main list.
+'''
+
+def _read_chunks(source, columns, chunksize):
+    #dataframes of at most chunksize rows from a csv or parquet file
+    if str(source).endswith('.parquet') or str(source).endswith('.pq'):
+        try:
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise ImportError('reading parquet catalogs needs pyarrow, install it with pip install pyarrow')
+        for batch in pq.ParquetFile(source).iter_batches(batch_size = chunksize, columns = columns):
+            yield batch.to_pandas()
+    else:
+        yield from pd.read_csv(source, usecols = columns, chunksize = chunksize)
+
+def iter_clusters(source, id_column = 'HiRiseID', columns = None, chunksize = 100000):
+    """
+    Reads a crater catalog in chunks and yields (HiRiseID, cluster) for one cluster at a time, in the order of the catalog.
+    Each cluster is a dataframe indexed by (HiRiseID, crater_no) like the main list, use cluster_data to pass it to measureCluster.
+    Raises a ValueError if the craters of a cluster are not on consecutive rows.
+
+    :param source: path to a csv file (may be compressed, i.e. .csv.gz) or a parquet file (.parquet, needs pyarrow)
+    :type source: str
+    :param id_column: column giving the HiRise ID of each crater, defaults to 'HiRiseID'
+    :type id_column: str
+    :param columns: columns to read, the HiRise ID and crater_no are always read, defaults to None for all
+    :type columns: list of str
+    :param chunksize: number of rows read at once, defaults to 100000
+    :type chunksize: int
+    """
+    if columns is not None:
+        columns = [id_column, 'crater_no'] + [column for column in columns if column not in (id_column, 'crater_no')]
+    finished = set()
+    current = None #HiRise ID of the cluster being collected
+    parts = [] #rows of the current cluster from the chunks read so far
+    for chunk in _read_chunks(source, columns, chunksize):
+        IDs = chunk[id_column].ffill()
+        if current is not None:
+            IDs = IDs.fillna(current) #first rows of the chunk continuing the cluster of the previous chunk
+        if IDs.isna().any():
+            raise ValueError('the first rows of the catalog have no ' + id_column)
+        chunk = chunk.assign(**{id_column: IDs})
+        #positions in the chunk where a new cluster starts:
+        starts = (IDs != IDs.shift()).to_numpy().nonzero()[0].tolist()
+        if starts and IDs.iloc[0] == current:
+            starts = starts[1:]
+        bounds = starts + [len(chunk)]
+        if bounds[0] > 0:
+            parts.append(chunk.iloc[:bounds[0]])
+        for start, stop in zip(bounds[:-1], bounds[1:]):
+            if current is not None:
+                yield current, _finish(parts, id_column)
+                finished.add(current)
+            current = IDs.iloc[start]
+            if current in finished:
+                raise ValueError('craters of cluster ' + str(current) + ' are not on consecutive rows, sort the catalog by ' + id_column + ' first')
+            parts = [chunk.iloc[start:stop]]
+    if current is not None:
+        yield current, _finish(parts, id_column)
+
+def _finish(parts, id_column):
+    #joining the rows of a cluster read from several chunks
+    cluster = pd.concat(parts) if len(parts) > 1 else parts[0]
+    return cluster.rename(columns = {id_column: 'HiRiseID'}).set_index(['HiRiseID', 'crater_no'])
+
+def cluster_data(cluster):
+    """
+    Turns the craters of one cluster from the main list, indexed by (HiRiseID, crater_no), into the form read from a cluster file:
+    crater_no as a column and the diameter in km, as expected by measureCluster and formatClusterData.
+
+    :param cluster: craters of one cluster, indexed by (HiRiseID, crater_no)
+    :type cluster: pandas dataframe
+    """
+    ClusterData = cluster.reset_index(level = 'crater_no').reset_index(drop = True)
+    if 'Diam_km' not in ClusterData.columns:
+        ClusterData['Diam_km'] = ClusterData['Diam_m']/1000 #measureCluster expects the diameter in km
+    return ClusterData
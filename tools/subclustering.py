@@ -0,0 +1,234 @@
+import pandas as pd
+import numpy as np
+from scipy.spatial import cKDTree
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+from concurrent.futures import ProcessPoolExecutor
+from . import functions as ct
+from .catalog import central_coordinates
+'''
+Tools to find subclustering in crater clusters with density based spatial clustering (DBSCAN), as demonstrated in the Density_Based_Clustering notebook.
+The neighbours of all craters are found once with a KD-tree up to the largest eps of a sweep,
+the DBSCAN labels for every smaller eps are then derived from that neighbour graph without searching again.
+The cluster quality scores (silhouette, Davies-Bouldin, Calinski-Harabasz) of all eps are calculated from one distance matrix.
+
+To read up on DBSCAN: https://en.wikipedia.org/wiki/DBSCAN and https://scikit-learn.org/stable/auto_examples/cluster/plot_dbscan.html
+'''
+
+class NeighbourGraph:
+    """
+    Graph of all crater pairs closer than max_eps, built once with a KD-tree.
+    The labels it gives are the same as sklearn.cluster.DBSCAN(eps, min_samples) for any eps up to max_eps.
+
+    :param X: array of shape (N, 2) of the crater coordinates in metres
+    :type X: numpy array
+    :param max_eps: largest eps the graph is used for in metres
+    :type max_eps: float
+    """
+    def __init__(self, X, max_eps):
+        self.X = np.asarray(X, dtype=float)
+        self.max_eps = max_eps
+        self.n = len(self.X)
+        pairs = cKDTree(self.X).query_pairs(max_eps, output_type='ndarray')
+        distances = np.sqrt(((self.X[pairs[:, 0]] - self.X[pairs[:, 1]])**2).sum(axis=1))
+        order = np.argsort(distances, kind='stable') #sorted, so the edges within eps are a prefix
+        self.i = pairs[order, 0]
+        self.j = pairs[order, 1]
+        self.distances = distances[order]
+        self._D = None
+
+    def labels(self, eps, min_samples = 3):
+        '''
+        DBSCAN labels of all craters for eps, -1 for noise.
+        Subclusters are numbered in the order of their first core crater, border craters belong to the first subcluster reaching them, as in sklearn.
+
+        :param eps: largest distance between craters to be considered neighbours in metres
+        :type eps: float
+        :param min_samples: smallest number of craters (including itself) within eps of a core crater, defaults to 3
+        :type min_samples: int
+        '''
+        if eps > self.max_eps:
+            raise ValueError('eps is larger than the max_eps of the graph')
+        n_edges = np.searchsorted(self.distances, eps, side='right')
+        i = self.i[:n_edges]
+        j = self.j[:n_edges]
+        degree = 1 + np.bincount(i, minlength=self.n) + np.bincount(j, minlength=self.n)
+        core = degree >= min_samples
+        labels = np.full(self.n, -1)
+        if not core.any():
+            return labels
+        #subclusters are the connected components of the core craters:
+        both = core[i] & core[j]
+        graph = coo_matrix((np.ones(both.sum()), (i[both], j[both])), shape=(self.n, self.n))
+        n_components, components = connected_components(graph, directed=False)
+        first_core = np.full(n_components, self.n)
+        np.minimum.at(first_core, components[core], np.flatnonzero(core))
+        order = np.argsort(first_core) #numbering in order of the first core crater
+        number = np.empty(n_components, dtype=int)
+        number[order] = np.arange(n_components)
+        labels[core] = number[components[core]]
+        #border craters take the lowest label of their core neighbours:
+        border = np.full(self.n, self.n)
+        for a, b in ((i, j), (j, i)):
+            edge = core[a] & ~core[b]
+            np.minimum.at(border, b[edge], labels[a[edge]])
+        is_border = border < self.n
+        labels[is_border] = border[is_border]
+        return labels
+
+    def distance_matrix(self):
+        '''
+        Distances between all craters, calculated once and reused for the scores of every eps.
+        '''
+        if self._D is None:
+            diff = self.X[:, None, :] - self.X[None, :, :]
+            self._D = np.sqrt((diff**2).sum(axis=2))
+        return self._D
+
+    def sweep(self, eps_values, min_samples = 3):
+        '''
+        Runs DBSCAN for every eps and scores the subclustering.
+        Returns a dataframe with the columns eps, n_clusters, n_noise, silhouette, davies_bouldin and calinski_harabasz,
+        the scores are NaN for eps giving less than two subclusters. Noise counts as one more label for the scores, as in the notebook.
+
+        :param eps_values: values of eps in metres, at most max_eps
+        :type eps_values: list of float
+        :param min_samples: smallest number of craters (including itself) within eps of a core crater, defaults to 3
+        :type min_samples: int
+        '''
+        rows = []
+        for eps in eps_values:
+            labels = self.labels(eps, min_samples)
+            n_clusters = len(set(labels)) - (1 if -1 in labels else 0)
+            row = {'eps': eps, 'n_clusters': n_clusters, 'n_noise': int((labels == -1).sum()),
+                   'silhouette': np.nan, 'davies_bouldin': np.nan, 'calinski_harabasz': np.nan}
+            if n_clusters > 1:
+                row.update(scores(self.X, labels, self.distance_matrix()))
+            rows.append(row)
+        return pd.DataFrame(rows, columns=['eps', 'n_clusters', 'n_noise', 'silhouette', 'davies_bouldin', 'calinski_harabasz'])
+
+def scores(X, labels, D = None):
+    '''
+    Calculates the silhouette coefficient, Davies-Bouldin and Calinski-Harabasz score of a labelling, with the same definitions as sklearn.metrics.
+    Returns a dictionary of the three scores, all NaN if the number of labels is not between 2 and N-1.
+
+    :param X: array of shape (N, 2) of the crater coordinates in metres
+    :type X: numpy array
+    :param labels: label of each crater
+    :type labels: numpy array
+    :param D: distances between all craters, defaults to None to calculate them
+    :type D: numpy array
+    '''
+    X = np.asarray(X, dtype=float)
+    n = len(X)
+    unique, codes, counts = np.unique(labels, return_inverse=True, return_counts=True)
+    k = len(unique)
+    if not 1 < k < n:
+        return {'silhouette': np.nan, 'davies_bouldin': np.nan, 'calinski_harabasz': np.nan}
+    if D is None:
+        D = np.sqrt(((X[:, None, :] - X[None, :, :])**2).sum(axis=2))
+    onehot = np.zeros((n, k))
+    onehot[np.arange(n), codes] = 1
+    #silhouette: mean distance to the own and to the nearest other label
+    sums = D @ onehot
+    own = counts[codes]
+    a = sums[np.arange(n), codes]/np.maximum(own - 1, 1)
+    means = sums/counts
+    means[np.arange(n), codes] = np.inf
+    b = means.min(axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        s = np.where(own > 1, (b - a)/np.maximum(a, b), 0)
+    silhouette = np.nan_to_num(s).mean()
+    #Davies-Bouldin: spread of each label against the distance between the centroids
+    centroids = (onehot.T @ X)/counts[:, None]
+    spread = (onehot.T @ np.sqrt(((X - centroids[codes])**2).sum(axis=1)))/counts
+    centroid_distances = np.sqrt(((centroids[:, None, :] - centroids[None, :, :])**2).sum(axis=2))
+    if np.allclose(spread, 0) or np.allclose(centroid_distances, 0):
+        davies = 0.0
+    else:
+        centroid_distances[centroid_distances == 0] = np.inf
+        davies = np.mean(np.max((spread[:, None] + spread[None, :])/centroid_distances, axis=1))
+    #Calinski-Harabasz: dispersion between and within the labels
+    extra = (counts*((centroids - X.mean(axis=0))**2).sum(axis=1)).sum()
+    intra = ((X - centroids[codes])**2).sum()
+    calinski = 1.0 if intra == 0 else extra*(n - k)/(intra*(k - 1))
+    return {'silhouette': silhouette, 'davies_bouldin': davies, 'calinski_harabasz': calinski}
+
+def find_subclustering(ClusterData, latc, lonc, eps = 11, min_samples = 3, x = 'x_coord', y = 'y_coord'):
+    '''
+    Finds subclusters in a crater cluster with DBSCAN, the library version of find_subclustering in the notebook without plotting.
+    Returns the number of subclusters, the number of noise craters, the silhouette, Davies-Bouldin and Calinski-Harabasz scores and the label of each crater.
+
+    :param ClusterData: Dataframe containing all craters in clusters, coordinates in degrees
+    :type ClusterData: pandas dataframe
+    :param latc: central latitude of image
+    :type latc: float
+    :param lonc: central longitude of image
+    :type lonc: float
+    :param eps: largest distance between craters to be considered part of a subcluster in metres, defaults to 11
+    :type eps: float
+    :param min_samples: smallest number of craters in a subcluster, defaults to 3
+    :type min_samples: int
+    '''
+    X = ct.to_metres(ClusterData, latc, lonc, x, y)[[x, y]].to_numpy()
+    graph = NeighbourGraph(X, eps)
+    labels = graph.labels(eps, min_samples)
+    result = graph.sweep([eps], min_samples).iloc[0]
+    return int(result['n_clusters']), int(result['n_noise']), result['silhouette'], result['davies_bouldin'], result['calinski_harabasz'], labels
+
+def eps_sweep(ClusterData, latc, lonc, eps_values, min_samples = 3, x = 'x_coord', y = 'y_coord'):
+    '''
+    Runs DBSCAN on a cluster for all values of eps, searching the neighbours only once.
+    Returns a dataframe with the columns eps, n_clusters, n_noise, silhouette, davies_bouldin and calinski_harabasz.
+
+    :param ClusterData: Dataframe containing all craters in clusters, coordinates in degrees
+    :type ClusterData: pandas dataframe
+    :param latc: central latitude of image
+    :type latc: float
+    :param lonc: central longitude of image
+    :type lonc: float
+    :param eps_values: values of eps in metres
+    :type eps_values: list of float
+    :param min_samples: smallest number of craters in a subcluster, defaults to 3
+    :type min_samples: int
+    '''
+    X = ct.to_metres(ClusterData, latc, lonc, x, y)[[x, y]].to_numpy()
+    return NeighbourGraph(X, max(eps_values)).sweep(eps_values, min_samples)
+
+def _sweepCluster(HiRiseID, X, eps_values, min_samples):
+    #worker of subclustering_catalog
+    result = NeighbourGraph(X, max(eps_values)).sweep(eps_values, min_samples)
+    result.insert(0, 'HiRise_ID', HiRiseID)
+    return result
+
+def subclustering_catalog(main_df, eps_values, centres = None, min_samples = 3, workers = None, x = 'x_coord', y = 'y_coord'):
+    '''
+    Runs the eps sweep for every cluster in the main list, using a pool of worker processes.
+    Returns a dataframe with one row per cluster and eps.
+
+    :param main_df: main list of all craters, indexed by (HiRiseID, crater_no)
+    :type main_df: pandas dataframe
+    :param eps_values: values of eps in metres
+    :type eps_values: list of float
+    :param centres: table of the central coordinates (i.e. the parameters sheet), defaults to None to use the mean coordinates of each cluster
+    :type centres: pandas dataframe
+    :param min_samples: smallest number of craters in a subcluster, defaults to 3
+    :type min_samples: int
+    :param workers: number of worker processes, 1 runs in this process, defaults to None for the number of CPUs
+    :type workers: int
+    '''
+    coordinates = central_coordinates(main_df, centres, x, y)
+    grouped = main_df[[x, y]].groupby(level=0, sort=False)
+    IDs = list(grouped.groups)
+    clusters = []
+    for HiRiseID, positions in grouped.indices.items():
+        latc, lonc = coordinates.loc[HiRiseID]
+        clusters.append(ct.to_metres(main_df.iloc[positions], latc, lonc, x, y)[[x, y]].to_numpy())
+    n_clusters = len(IDs)
+    jobs = (IDs, clusters, [list(eps_values)]*n_clusters, [min_samples]*n_clusters)
+    if workers == 1:
+        results = list(map(_sweepCluster, *jobs))
+    else:
+        with ProcessPoolExecutor(max_workers = workers) as pool:
+            results = list(pool.map(_sweepCluster, *jobs, chunksize = max(1, n_clusters//64)))
+    return pd.concat(results, ignore_index=True)